@@ -0,0 +1,62 @@
+import sys
+
+import numpy as np
+
+import dispersive
+
+#
+# Python version of calculateNSensitivity.m: the signal, the sensitivity to the atom number and
+# the power scattered by a thermal cloud for several probe waists, and the approximate heating
+# rate. The whole grid of atom numbers and waists is evaluated by one call to dispersive.sweep
+# instead of one dispersivemod object and loop iteration per point. The results are plotted if
+# matplotlib is installed, and printed otherwise
+#
+R = np.linspace(0,1000e-6,1000)
+N = np.logspace(4,7,100)
+WAISTS = np.array([400,200,100,50,25])*1e-6
+T = 1e-6
+FREQ = 2*np.pi*160          #Trap frequency [rad/s]
+POWER = 100e-6
+FMOD = 2*np.pi*4e9
+SBFRAC = 0.05
+DETUNING = 2*np.pi*2000e6
+APERTURE = 1000e-6
+
+
+def calculate(workers=None):
+    #Returns the dict from dispersive.sweep, with arrays of shape (len(N),len(WAISTS)), and the heating rate in K/s
+    n0 = dispersive.thermal_profile(R,T,FREQ)
+    values = dispersive.sweep(R,n0,*np.ix_(N,WAISTS),POWER,FMOD,SBFRAC,DETUNING,aperture=APERTURE,workers=workers)
+    dT = dispersive.heating_rate(values["scattpower"],N[:,None])
+    return values,dT
+
+def plot(values):
+    import matplotlib.pyplot as plt
+    labels = ["{:d} um".format(int(round(w*1e6))) for w in WAISTS]
+    fig,(ax1,ax2) = plt.subplots(1,2,figsize=(10,4))
+    ax1.loglog(N,values["signal"]*1e6,".-")
+    ax1.set_xlabel("Number of atoms")
+    ax1.set_ylabel("Signal power [uW]")
+    ax1.legend(labels,loc="upper left")
+    ax2.loglog(N,np.abs(values["sensN"])/values["scattpower"]*1e6,".-")
+    ax2.set_xlabel("Number of atoms")
+    ax2.set_ylabel("Sensitivity [uW signal/10^6 atoms/uW absorbed]")
+    ax2.legend(labels,loc="upper left")
+    fig.tight_layout()
+    plt.show()
+
+def report(values,dT):
+    print("{:>10} {:>8} {:>14} {:>14} {:>14} {:>14}".format("N","waist","signal [uW]","sensN","Psc [uW]","dT/dt [K/s]"))
+    for m in range(0,len(N),11):
+        for k,w in enumerate(WAISTS):
+            print("{:>10.3g} {:>5.0f} um {:>14.4g} {:>14.4g} {:>14.4g} {:>14.4g}".format(N[m],w*1e6,values["signal"][m,k]*1e6,
+                  values["sensN"][m,k],values["scattpower"][m,k]*1e6,dT[m,k]))
+
+
+if __name__ == "__main__":
+    values,dT = calculate()
+    try:
+        plot(values)
+    except ImportError:
+        print("matplotlib is not installed, printing every 11th atom number instead",file=sys.stderr)
+        report(values,dT)
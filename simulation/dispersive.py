@@ -0,0 +1,265 @@
+import os
+import concurrent.futures
+
+import numpy as np
+
+#
+# NumPy port of dispersive.m and dispersivemod.m. The parameters of both classes can be arrays,
+# and every method broadcasts them against each other, so one call evaluates a whole grid of
+# probe settings instead of one object per grid point. The spatial grid (r, or x and y) is the
+# last axis (or two axes) of every array that depends on position:
+#   parameters:          shape G, any shapes that broadcast together
+#   density n:           shape G + (len(r),), or (len(r),) if it is the same for all points
+#   signal, sensN, ...:  shape G
+# Frequencies are angular frequencies in rad/s, as in the MATLAB classes. sweep() evaluates
+# grids that do not fit in memory in chunks, optionally on a pool of processes
+#
+HBAR = 1.054571817e-34      #[J s]
+C = 299792458.0             #[m/s]
+KB = 1.380649e-23           #[J/K]
+M_RB = 1.443160648e-25      #Mass of Rb-87 [kg]
+GAMMA = 2*np.pi*6e6         #Linewidth used by the calculate*.m scripts [rad/s]
+WAVELENGTH = 780e-9         #[m]
+
+QUANTITIES = ("signal","sensN","scattpower")
+CHUNK_ELEMENTS = 2**20      #Grid points times radial points evaluated at once by sweep()
+
+_trapz = getattr(np,"trapezoid",None) or np.trapz
+
+
+def _expand(x,ndim):
+    #Appends ndim axes of length 1 so that a parameter broadcasts against the spatial grid
+    x = np.asarray(x)
+    return x.reshape(x.shape + (1,)*ndim)
+
+def _dot(a,b):
+    #Sum over the last axis of a*b without storing the product
+    return np.einsum("...i,...i->...",a,b)
+
+def thermal_profile(r,T,freq,mass=M_RB):
+    #Column density per atom of a thermal cloud in a harmonic trap with angular frequency freq,
+    #as used by the calculate*.m scripts. Multiply by the atom number to get n
+    s2 = KB*_expand(T,1)/(mass*_expand(freq,1)**2)
+    return 1/(2*np.pi*s2)*np.exp(-np.asarray(r)**2/(2*s2))
+
+def heating_rate(psc,N,wavelength=WAVELENGTH,mass=M_RB):
+    #Approximate heating rate in K/s from the scattered power, see calculateNSensitivity.m
+    k = 2*np.pi/wavelength
+    return psc*HBAR*k/(mass*C)/(3*np.asarray(N)*KB)
+
+
+class Dispersive:
+    #Single-sideband probe integrated over a square grid (dispersive.m)
+    def __init__(self,waist,power,sbfrac,detuning,gamma=GAMMA,wavelength=WAVELENGTH,aperture=np.inf):
+        self.waist = waist
+        self.power = power
+        self.sbfrac = sbfrac
+        self.detuning = detuning
+        self.gamma = gamma
+        self.k = 2*np.pi/wavelength
+        self.aperture = aperture
+
+    def _p(self,name):
+        return _expand(getattr(self,name),2)
+
+    def intensity(self,x,y):
+        w = self._p("waist")
+        return 2*self._p("power")/(np.pi*w**2)*np.exp(-2*(x**2 + y**2)/w**2)
+
+    def saturation(self,x,y):
+        return self._p("sbfrac")*self.intensity(x,y)/self._p("gamma")*12*np.pi/(HBAR*C*self.k**3)
+
+    def excitedpop(self,x,y):
+        s = self.saturation(x,y)
+        return 0.5*s/(1 + 4*self._p("detuning")**2/self._p("gamma")**2 + s)
+
+    def scattphotons(self,x,y,dt):
+        return self.excitedpop(x,y)*self._p("gamma")*dt
+
+    def prepOverlap(self,x,y,n):
+        X,Y = np.meshgrid(x,y)
+        gamma = self._p("gamma")
+        susc = -n*(3*np.pi/self.k**3*gamma)/(self._p("detuning") + 1j*gamma/2)
+        mask = np.sqrt(X**2 + Y**2) < self._p("aperture")
+        return X,Y,susc,mask
+
+    def _integrate(self,f,dx):
+        return dx**2*_trapz(_trapz(f,axis=-1),axis=-1)
+
+    def getOverlap(self,X,Y,dx,susc,mask):
+        weight = self.intensity(X,Y)*mask
+        amp = np.sqrt(self.sbfrac)
+        Sred = amp*self._integrate(np.exp(1j*self.k/2*susc)*weight,dx)
+        Sblue = amp*self._integrate(weight,dx)
+        return Sred,Sblue
+
+    def signal(self,x,y,n,iq=False):
+        #Signal amplitude, or the quadratures (I, Q) if iq is set
+        X,Y,susc,mask = self.prepOverlap(x,y,n)
+        Sred,Sblue = self.getOverlap(X,Y,x[1] - x[0],susc,mask)
+        if iq:
+            return Sred.real - Sblue.real,-Sred.imag + Sblue.imag
+        return np.abs(Sred - Sblue)
+
+    def sensN(self,x,y,n,N):
+        #Derivative of the signal with respect to the atom number N
+        X,Y,susc,mask = self.prepOverlap(x,y,n)
+        dx = x[1] - x[0]
+        Sred,Sblue = self.getOverlap(X,Y,dx,susc,mask)
+        phase = 1j*self.k/2*susc
+        dSred = np.sqrt(self.sbfrac)*self._integrate(phase/_expand(N,2)*np.exp(phase)*self.intensity(X,Y)*mask,dx)
+        S = Sred - Sblue
+        return np.real(dSred*np.conj(S))/np.abs(S)
+
+    def scattpower(self,x,y,n):
+        X,Y,susc,mask = self.prepOverlap(x,y,n)
+        dx = x[1] - x[0]
+        I = self.intensity(X,Y)
+        return self.sbfrac*(self._integrate(I,dx) - self._integrate(np.exp(np.real(1j*self.k/2*susc))*I,dx))
+
+
+class DispersiveMod:
+    #Carrier with two sidebands at +/- fmod integrated over a radially symmetric cloud
+    #(dispersivemod.m). The carrier is detuned by detuning + fmod from the atoms
+    def __init__(self,waist,power,fmod,sbfrac,detuning,gamma=GAMMA,wavelength=WAVELENGTH,aperture=np.inf):
+        self.waist = waist
+        self.power = power
+        self.fmod = fmod
+        self.sbfrac = sbfrac
+        self.detuning = detuning
+        self.gamma = gamma
+        self.k = 2*np.pi/wavelength
+        self.aperture = aperture
+
+    def _p(self,name):
+        return _expand(getattr(self,name),1)
+
+    def intensity(self,r):
+        w = self._p("waist")
+        return 2*self._p("power")/(np.pi*w**2)*np.exp(-2*r**2/w**2)
+
+    def saturation(self,r):
+        return self.intensity(r)/self._p("gamma")*12*np.pi/(HBAR*C*self.k**3)
+
+    def excitedpop(self,r):
+        s = self.saturation(r)
+        sb = self._p("sbfrac")*s
+        detuning,fmod,gamma2 = self._p("detuning"),self._p("fmod"),self._p("gamma")**2
+        return (0.5*sb/(1 + 4*detuning**2/gamma2)
+                + 0.5*s/(1 + 4*(detuning + fmod)**2/gamma2)
+                + 0.5*sb/(1 + 4*(detuning + 2*fmod)**2/gamma2))
+
+    def scattphotons(self,r,dt):
+        return self.excitedpop(r)*self._p("gamma")*dt
+
+    def _susceptibility(self,order):
+        #Susceptibility per unit density for the sideband of the given order (0 red, 1 carrier,
+        #2 blue), shape G + (1,)
+        gamma = self._p("gamma")
+        return -(3*np.pi/self.k**3*gamma)/(self._p("detuning") + order*self._p("fmod") + 1j*gamma/2)
+
+    def prepOverlap(self,r,n,order):
+        return n*self._susceptibility(order),r < self._p("aperture")
+
+    def evaluate(self,r,n,N=None,quantities=QUANTITIES):
+        #Returns a dict with the requested quantities, which share the intensity and
+        #susceptibilities. sensN needs the atom number N. The susceptibilities are the density
+        #times a factor for each grid point, so the derivatives with respect to N are sums over
+        #the same exponentials and only the exponentials are computed for every radial point
+        r = np.asarray(r,dtype=float)
+        n = np.asarray(n,dtype=float)
+        dr = r[1] - r[0]
+        weights = np.full(len(r),2*np.pi*dr)       #Trapezoidal rule times 2 pi dr
+        weights[[0,-1]] /= 2
+        rI = r*weights*self.intensity(r)
+        suscR,suscC,suscB = (self._susceptibility(order) for order in (0,1,2))
+        result = {}
+        if "signal" in quantities or "sensN" in quantities:
+            w = rI*(r < self._p("aperture"))
+            amp = np.sqrt(self.sbfrac)
+            phaseR = 1j*self.k/2*(suscR + suscC)
+            phaseB = 1j*self.k/2*(suscB + suscC)
+            expR,expB = np.exp(n*phaseR),np.exp(n*phaseB)
+            S = amp*(_dot(w,expR) - _dot(w,expB))
+            if "signal" in quantities:
+                result["signal"] = np.abs(S)
+            if "sensN" in quantities:
+                if N is None:
+                    raise ValueError("sensN needs the atom number N")
+                wn = w*n
+                dS = amp*(phaseR[...,0]*_dot(wn,expR) - phaseB[...,0]*_dot(wn,expB))/np.asarray(N)
+                result["sensN"] = np.real(dS*np.conj(S))/np.abs(S)
+        if "scattpower" in quantities:
+            sbfrac = self._p("sbfrac")[...,0]
+            absorbed = (sbfrac*_dot(rI,1 - np.exp(-self.k/2*n*suscR.imag)) + _dot(rI,1 - np.exp(-self.k/2*n*suscC.imag))
+                        + sbfrac*_dot(rI,1 - np.exp(-self.k/2*n*suscB.imag)))
+            result["scattpower"] = absorbed
+        return result
+
+    def signal(self,r,n,iq=False):
+        #Signal amplitude, or the quadratures (I, Q) if iq is set
+        if iq:
+            suscR,mask = self.prepOverlap(r,n,0)
+            suscC,_ = self.prepOverlap(r,n,1)
+            suscB,_ = self.prepOverlap(r,n,2)
+            weight = r*self.intensity(r)*mask
+            amp = np.sqrt(self.sbfrac)*2*np.pi*(r[1] - r[0])
+            Sred = amp*_trapz(weight*np.exp(1j*self.k/2*(suscR + suscC)),axis=-1)
+            Sblue = amp*_trapz(weight*np.exp(1j*self.k/2*(suscB + suscC)),axis=-1)
+            return Sred.real - Sblue.real,-Sred.imag + Sblue.imag
+        return self.evaluate(r,n,quantities=("signal",))["signal"]
+
+    def sensN(self,r,n,N):
+        #Derivative of the signal with respect to the atom number N
+        return self.evaluate(r,n,N,("sensN",))["sensN"]
+
+    def scattpower(self,r,n):
+        return self.evaluate(r,n,quantities=("scattpower",))["scattpower"]
+
+
+#
+# Sweeps over large parameter grids
+#
+SWEEP_PARAMETERS = ("N","waist","power","fmod","sbfrac","detuning","gamma","aperture")
+
+def _sweep_chunk(r,profile,params,shape,wavelength,quantities,start,stop):
+    #Evaluates the flat grid points start to stop. Runs in the worker processes
+    idx = np.unravel_index(np.arange(start,stop),shape)
+    values = dict((name,np.broadcast_to(params[name],shape)[idx]) for name in SWEEP_PARAMETERS)
+    dp = DispersiveMod(values["waist"],values["power"],values["fmod"],values["sbfrac"],values["detuning"],
+                       values["gamma"],wavelength,values["aperture"])
+    return dp.evaluate(r,values["N"][:,None]*profile,values["N"],quantities)
+
+def sweep(r,profile,N,waist,power,fmod,sbfrac,detuning,gamma=GAMMA,wavelength=WAVELENGTH,aperture=np.inf,
+          quantities=QUANTITIES,workers=None,chunk_elements=CHUNK_ELEMENTS):
+    #Evaluates DispersiveMod for n = N*profile on the grid given by broadcasting the parameters
+    #against each other. Use np.ix_ for the outer product of 1-D axes, e.g.
+    #   sweep(r,n0,*np.ix_(N,waists,powers,[2*pi*4e9],sbfracs,detunings))
+    #gives arrays of shape (len(N),len(waists),len(powers),1,len(sbfracs),len(detunings)).
+    #The grid is split into chunks of about chunk_elements values per array, which are
+    #evaluated on 'workers' processes (one per CPU if None, or in this process if 1).
+    #Returns a dict of quantity -> array with the shape of the grid
+    r = np.asarray(r,dtype=float)
+    profile = np.asarray(profile,dtype=float)
+    params = dict(zip(SWEEP_PARAMETERS,(np.asarray(p) for p in (N,waist,power,fmod,sbfrac,detuning,gamma,aperture))))
+    shape = np.broadcast_shapes(*(p.shape for p in params.values()))
+    total = int(np.prod(shape))
+    step = max(1,chunk_elements // len(r))
+    chunks = [(start,min(start + step,total)) for start in range(0,total,step)]
+    results = dict((q,np.empty(total)) for q in quantities)
+
+    def store(chunk,values):
+        for q in quantities:
+            results[q][chunk[0]:chunk[1]] = values[q]
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            store(chunk,_sweep_chunk(r,profile,params,shape,wavelength,quantities,*chunk))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(min(workers,len(chunks))) as pool:
+            futures = [pool.submit(_sweep_chunk,r,profile,params,shape,wavelength,quantities,*chunk) for chunk in chunks]
+            for chunk,future in zip(chunks,futures):
+                store(chunk,future.result())
+    return dict((q,v.reshape(shape)) for q,v in results.items())
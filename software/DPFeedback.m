@@ -342,13 +342,9 @@ classdef DPFeedback < handle
             %   FB = FB.UPLOAD() uploads register values associated with
             %   object FB
             self.check;
-            self.sharedReg.write;
-            self.pulseRegs.write;
-            self.avgRegs.write;
-            self.integrateRegs.write;
-            self.signalComputeRegs.write;
-            self.fbComputeRegs.write;
-            self.fbPulseRegs.write;
+            regs = [self.sharedReg,self.pulseRegs,self.avgRegs,self.integrateRegs,...
+                self.signalComputeRegs,self.fbComputeRegs,self.fbPulseRegs];
+            regs.write;
         end
         
         function self = fetch(self)
@@ -356,14 +352,11 @@ classdef DPFeedback < handle
             %
             %   FB = FB.FETCH() retrieves values and stores them in object
             %   FB
-            %Read registers
-            self.sharedReg.read;
-            self.pulseRegs.read;
-            self.avgRegs.read;
-            self.integrateRegs.read;
-            self.signalComputeRegs.read;
-            self.fbComputeRegs.read;
-            self.fbPulseRegs.read;
+            %Read registers, including the read-only registers
+            regs = [self.sharedReg,self.pulseRegs,self.avgRegs,self.integrateRegs,...
+                self.signalComputeRegs,self.fbComputeRegs,self.fbPulseRegs,...
+                self.sampleRegs,self.pulsesRegs];
+            regs.read;
             
             %Read parameters
             self.enableDP.get;
@@ -407,8 +400,12 @@ classdef DPFeedback < handle
             self.mwPulsePeriod.get;
             
             %Get number of collected samples
-            self.samplesCollected.read;
-            self.pulsesCollected.read;
+            for nn=1:numel(self.samplesCollected)
+                self.samplesCollected(nn).get;
+            end
+            for nn=1:numel(self.pulsesCollected)
+                self.pulsesCollected(nn).get;
+            end
             
             %Manual signals
             self.manualFlag.get;
@@ -84,9 +84,10 @@ classdef DPFeedbackRegister < handle
                 data = [self.addr,self.value];
                 self.conn.write(data,'mode','write');
             else
-                for nn=1:numel(self)
-                    self(nn).write;
-                end
+                %Write all registers in one request as (address,value) pairs,
+                %sent as a row vector as DPFeedbackClient.write expects
+                data = [self.addr;self.value];
+                self(1).conn.write(reshape(data,1,[]),'mode','write batch');
             end
         end
         
@@ -97,8 +98,10 @@ classdef DPFeedbackRegister < handle
                 self.conn.write(self.addr,'mode','read');
                 self.value = self.conn.recvMessage;
             else
+                %Read all registers in one request
+                self(1).conn.write([self.addr],'mode','read batch');
                 for nn=1:numel(self)
-                    self(nn).read;
+                    self(nn).value = self(1).conn.recvMessage(nn);
                 end
             end
         end
@@ -1,22 +1,128 @@
 import types
 import subprocess
 import warnings
+import contextlib
 
-MEM_ADDR = 0x40000000
+import hardware
+import acquisition
+import registermap
 
+MEM_ADDR = hardware.MEM_ADDR
+
+#######################################################################################################
+#####################################  Register File Class  ###########################################
+#######################################################################################################
+
+class RegisterFile:
+    # Shadow copy of the 32-bit registers shared by all Parameters at the same address.
+    # Reads are served from the cache once a word has been read, and writes only change the
+    # cache until they are flushed.  With autoFlush set, each write is sent to the device
+    # straight away; inside deferred() the writes are collected and each changed word is
+    # written once at the end.  Volatile registers (triggers, status) always go to the device
+    
+    def __init__(self,autoFlush=True,volatile=()):
+        self.autoFlush = autoFlush
+        self.__values = {}
+        self.__dirty = set()
+        self.__volatile = set(volatile)
+        
+    def markVolatile(self,addr):
+        self.__volatile.add(addr)
+        self.__values.pop(addr,None)
+        self.__dirty.discard(addr)
+        
+    def isVolatile(self,addr):
+        return addr in self.__volatile
+        
+    def isDirty(self,addr):
+        return addr in self.__dirty
+        
+    def read(self,addr):
+        if addr in self.__volatile or addr not in self.__values:
+            value = self.__readDevice(addr)
+            if addr in self.__volatile:
+                return value
+            self.__values[addr] = value
+        return self.__values[addr]
+    
+    def write(self,addr,value):
+        value &= 0xFFFFFFFF
+        if addr in self.__volatile:
+            self.__writeDevice(addr,value)
+            return
+        self.__values[addr] = value
+        self.__dirty.add(addr)
+        if self.autoFlush:
+            self.flush(addr)
+            
+    def invalidate(self,addr=None):
+        # Forgets cached values so that they are read from the device next time.  Unwritten
+        # changes are discarded
+        if addr is None:
+            self.__values.clear()
+            self.__dirty.clear()
+        else:
+            self.__values.pop(addr,None)
+            self.__dirty.discard(addr)
+            
+    def sync(self):
+        # Re-reads every cached word that has no unwritten changes
+        for addr in list(self.__values):
+            if addr not in self.__dirty:
+                self.__values[addr] = self.__readDevice(addr)
+                
+    def flush(self,addr=None):
+        # Writes changed words to the device, one write per word
+        addrs = sorted(self.__dirty) if addr is None else [a for a in [addr] if a in self.__dirty]
+        for a in addrs:
+            self.__writeDevice(a,self.__values[a])
+            self.__dirty.discard(a)
+            
+    @contextlib.contextmanager
+    def deferred(self):
+        # Collects writes made inside a with-block and flushes them when it ends
+        autoFlush = self.autoFlush
+        self.autoFlush = False
+        try:
+            yield self
+        finally:
+            self.autoFlush = autoFlush
+        self.flush()
+    
+    def __readDevice(self,addr):
+        try:
+            return hardware.get_device().read(addr)
+        except (OSError,ValueError):
+            raise ValueError("Unable to read from address " + '0x' + '{:0>8x}'.format(MEM_ADDR + addr))
+        
+    def __writeDevice(self,addr,value):
+        try:
+            hardware.get_device().write(addr,value)
+        except (OSError,ValueError):
+            raise ValueError("Unable to write to address " + '0x' + '{:0>8x}'.format(MEM_ADDR + addr))
+            
+            
 #######################################################################################################
 #####################################  Parameter Class  ###############################################
 #######################################################################################################
 
 class Parameter:
+    # A bit range of one register.  The shift, mask and address string are computed when the
+    # address and bit range are set, so reading and writing a value only masks and shifts
     
-    def __init__(self,addr,bitRange):
+    def __init__(self,addr,bitRange,registers=None):
         self.addr = addr
         self.bitRange = bitRange
-        self.__value = 0
+        self.registers = registers if registers is not None else RegisterFile(volatile=registermap.VOLATILE)
+        
+    @classmethod
+    def fromMap(cls,name,registers=None):
+        # Creates the parameter with the address and bit range given in registermap.py
+        k = registermap.index(name)
+        return cls(registermap.ADDR[k],list(registermap.BITS[k]),registers)
         
     def reset(self):
-        self.__value = 0
+        self.registers.invalidate(self.addr)
         
     def format(self,radix):
         if radix == 2:
@@ -30,8 +136,7 @@ class Parameter:
         return s
     
     def globalAddress(self):
-        globalAddress = MEM_ADDR + self.addr
-        return '0x' + '{:0>8x}'.format(globalAddress)
+        return self.__globalAddress
         
     @property
     def length(self):
@@ -47,6 +152,7 @@ class Parameter:
             raise ValueError("Address must be between 0 and 0x3FFFFFFF")
         else:
             self.__addr = a
+            self.__globalAddress = '0x' + '{:0>8x}'.format(MEM_ADDR + a)
             
     @property
     def bitRange(self):
@@ -58,52 +164,44 @@ class Parameter:
             raise ValueError("Bit range must be a two element list!")
         else:
             self.__bitRange = b
+            self.__shift = b[0]
+            self.__mask = (1 << (b[1] - b[0] + 1)) - 1
     
     def get(self,bitRange):
-        self.read()
+        value = self.read()
         length = bitRange[1] - bitRange[0] + 1
         mask = ((1 << length) - 1) << bitRange[0]
-        return (self.__value & mask) >> bitRange[0]
+        return (value & mask) >> bitRange[0]
     
     @property
     def value(self):
-        self.read()
-        length = self.bitRange[1] - self.bitRange[0] + 1
-        mask = ((1 << length) - 1) << self.bitRange[0]
-        return (self.__value & mask) >> self.bitRange[0]
+        return (self.read() >> self.__shift) & self.__mask
     
     @value.setter
     def value(self,v):
-        self.read()
-        length = self.bitRange[1] - self.bitRange[0] + 1
-        mask = ((1 << length) - 1) << self.bitRange[0]
+        value = self.read()
         
         v = round(abs(v))
-        if v > (2**length - 1):
+        if v > self.__mask:
             warnings.warn("Value exceeds the allocated bit range of the register")
         
-        self.__value &= ~mask
-        self.__value |= ((v << self.bitRange[0]) & mask)
-        self.write()
+        value &= ~(self.__mask << self.__shift)
+        value |= (v & self.__mask) << self.__shift
+        self.registers.write(self.addr,value)
         
     
     def write(self):
-        result = subprocess.run(['monitor',self.globalAddress(),'0x' + '{:0>8x}'.format(self.__value)],stdout=subprocess.PIPE)
-        if result.returncode != 0:
-            raise ValueError("Monitor code returned error!")
-        return result
+        # Sends the register to the device if it has unwritten changes
+        self.registers.flush(self.addr)
         
     def read(self):
-        result = subprocess.run(['monitor',self.globalAddress()],stdout=subprocess.PIPE)
-        if result.returncode != 0:
-            raise ValueError("Monitor code returned error!")
-        self.__value = int(result.stdout.decode('ascii').rstrip(),16)
-        return result
+        # Returns the whole register, from the cache unless the register is volatile
+        return self.registers.read(self.addr)
     
     def display(self,name,value=None,units=""):
         fmt = '{:0>8x}'
         addrString = fmt.format(self.addr)
-        self.read()
+        registerValue = self.read()
         if value != None:
             if isinstance(value,int):
                 valueString = "{:d}".format(value) + " " + units
@@ -112,7 +210,7 @@ class Parameter:
             print(name + "\n  " + "Address: 0x" + addrString + ", Bits: " + format(self.bitRange))
             print("  Value:   " + valueString)
         else:
-            valueString = fmt.format(self.__value)
+            valueString = fmt.format(registerValue)
             print(name + "\n  " + "Address: 0x" + addrString)
             print("  Value:   0x" + valueString)
             
@@ -125,106 +223,120 @@ class Configuration:
     CLK = 125000000
     
     def __init__(self):
-        ## Triggers
-        self.__pulseTrig = Parameter(0x0,[0,0])
-        
-        ## Pulse Generation    
-        self.__pulseWidth = Parameter(0x4,[0,15])
-        self.__numPulses = Parameter(0x4,[16,31])
-        self.__pulsePeriod = Parameter(0x8,[0,31])  
-        
-        ## Initial Data Processing
-        self.__delay = Parameter(0xc,[0,13])
-        self.__samplesPerPulse = Parameter(0xc,[14,27])
-        self.__log2Avgs = Parameter(0xc,[28,31])       
-        self.__lastSample = Parameter(0x10,[0,14])
-
-        ## Secondary Data Processing
-        self.__sumStart = Parameter(0x14,[0,7])
-        self.__subStart = Parameter(0x14,[8,15])
-        self.__width = Parameter(0x14,[16,23])
+        ## Registers shared by the parameters.  Registers with side effects on the device are never cached
+        self.registers = RegisterFile(volatile=registermap.VOLATILE)
         
+        ## Parameters are created from registermap.py when they are first used
+        self.__parameters = {}
         
+    def parameter(self,name):
+        # Returns the Parameter for a name in registermap.py, which uses the names in DPFeedback.m
+        if name not in self.__parameters:
+            self.__parameters[name] = Parameter.fromMap(name,self.registers)
+        return self.__parameters[name]
         
-    def setDefaults(self):
-        self.pulsePeriod = 5e-6
-        self.pulseWidth = 1e-6
-        self.numPulses = 500
+    def get(self,name):
+        # Returns the value of any parameter in registermap.py in physical units
+        k = registermap.index(name)
+        return registermap.FROM_REGISTER[k](self.parameter(name).value)
+        
+    def set(self,name,value):
+        k = registermap.index(name)
+        if registermap.ADDR[k] in registermap.READONLY:
+            raise ValueError("Parameter " + name + " is read-only")
+        #The setter checks the range and warns before the value is truncated
+        self.parameter(name).value = registermap.TO_REGISTER[k](value)
         
-        self.delay = 0
-        self.samplesPerPulse = 31
-        self.log2Avgs = 1
         
-        self.sumStart = 5
-        self.subStart = 15
-        self.width = 5
+    def setDefaults(self):
+        with self.registers.deferred():
+            self.pulsePeriod = 5e-6
+            self.pulseWidth = 1e-6
+            self.numPulses = 500
+            
+            self.delay = 0
+            self.samplesPerPulse = 31
+            self.log2Avgs = 1
+            
+            self.sumStart = 5
+            self.subStart = 15
+            self.width = 5
+            
+    def sync(self):
+        # Re-reads the cached registers from the device
+        self.registers.sync()
+        
+    def flush(self):
+        # Writes registers changed inside registers.deferred() or with autoFlush turned off
+        self.registers.flush()
 
         
     def display(self):
         ## Full registers
         print("~~~~  Full Registers  ~~~~")
-        self.__pulseWidth.display("Pulse Register 0")
-        self.__pulsePeriod.display("Pulse Register 1")
-        self.__delay.display("Initial Data Processing")
-        self.__sumStart.display("Secondary Data Processing")
+        self.parameter("width").display("Pulse Register 0")
+        self.parameter("period").display("Pulse Register 1")
+        self.parameter("delaySignal").display("Initial Data Processing")
+        self.parameter("sumStart").display("Secondary Data Processing")
         
         ## Individual parameters
         print("~~~~  Parameters  ~~~~")
-        self.__pulseWidth.display("Pulse width",self.pulseWidth*1e6,"us")
-        self.__numPulses.display("Num pulses",self.numPulses)
-        self.__pulsePeriod.display("Pulse period",self.pulsePeriod*1e6,"us")
-        
-        self.__delay.display("Trigger delay",self.delay*1e6,"us")
-        self.__samplesPerPulse.display("Samples per pulse",self.samplesPerPulse)
-        self.__samplesPerPulse.display("Time per pulse",self.timePerPulse*1e6,"us")
-        self.__log2Avgs.display("log2(Number of averages)",self.log2Avgs)
+        self.parameter("width").display("Pulse width",self.pulseWidth*1e6,"us")
+        self.parameter("numpulses").display("Num pulses",self.numPulses)
+        self.parameter("period").display("Pulse period",self.pulsePeriod*1e6,"us")
+        
+        self.parameter("delaySignal").display("Trigger delay",self.delay*1e6,"us")
+        self.parameter("samplesPerPulse").display("Samples per pulse",self.samplesPerPulse)
+        self.parameter("samplesPerPulse").display("Time per pulse",self.timePerPulse*1e6,"us")
+        self.parameter("log2Avgs").display("log2(Number of averages)",self.log2Avgs)
 
-        self.__lastSample.display("Number of acquired samples",self.lastSample)
+        self.parameter("samplesCollected0").display("Number of acquired samples",self.lastSample)
 
     ## Triggers
     def pulseTrig(self):
-        self.__pulseTrig.value = 1
+        self.parameter("pulseTrig").value = 1
         
-    def begin(self):
-        self.startTrig()
-        result = subprocess.run(['./checkStatus'],stdout=subprocess.PIPE)
-        if result.returncode != 0:
-            raise ValueError("Monitor code returned error!")
-        else:
-            print(result.stdout.decode('ascii').rstrip())
+    def begin(self,timeout=10):
+        # Starts an acquisition and waits for it to finish.  The counters are watched with an
+        # adaptive polling interval (acquisition.ShotWatcher) instead of spinning in checkStatus
+        shot = acquisition.wait_for_shot(acquisition.ShotWatcher(),timeout,self.pulseTrig)
+        if shot is None:
+            raise ValueError("Timed out waiting for the acquisition to finish!")
+        print("Acquired {:d} samples and {:d} pulses".format(shot.counts[0],shot.counts[4]))
+        return shot.counts
         
         
     ## Pulse Generation
     @property
     def pulsePeriod(self):
-        return self.__pulsePeriod.value/self.CLK
+        return self.parameter("period").value/self.CLK
     
     @pulsePeriod.setter
     def pulsePeriod(self,v):
-        self.__pulsePeriod.value = v*self.CLK
+        self.parameter("period").value = v*self.CLK
         
     @property
     def pulseWidth(self):
-        return self.__pulseWidth.value/self.CLK
+        return self.parameter("width").value/self.CLK
     
     @pulseWidth.setter
     def pulseWidth(self,v):
-        self.__pulseWidth.value = v*self.CLK
+        self.parameter("width").value = v*self.CLK
     
     @property
     def numPulses(self):
-        return self.__numPulses.value
+        return self.parameter("numpulses").value
     
     @numPulses.setter
     def numPulses(self,v):
         if v > 512:
             raise ValueError("Number of pulses cannot be larger than 512!")
-        self.__numPulses.value = v
+        self.parameter("numpulses").value = v
         
     ## Memory                      
     @property
     def lastSample(self):
-        return self.__lastSample.value
+        return self.parameter("samplesCollected0").value
     
     def saveData(self):
         result = subprocess.run(['./saveData',format(self.lastSample)],stdout=subprocess.PIPE)
@@ -243,21 +355,21 @@ class Configuration:
     ## Initial Data Processing
     @property
     def delay(self):
-        return self.__delay.value/self.CLK
+        return self.parameter("delaySignal").value/self.CLK
     
     @delay.setter
     def delay(self,v):
-        self.__delay.value = v*self.CLK
+        self.parameter("delaySignal").value = v*self.CLK
         
     @property
     def samplesPerPulse(self):
-        return self.__samplesPerPulse.value
+        return self.parameter("samplesPerPulse").value
     
     @samplesPerPulse.setter
     def samplesPerPulse(self,v):
         if v < (self.subStart + self.width):
             warnings.warn("Number of samples per pulse is smaller than the subtraction window!")
-        self.__samplesPerPulse.value = v
+        self.parameter("samplesPerPulse").value = v
         
     @property
     def timePerPulse(self):
@@ -269,27 +381,27 @@ class Configuration:
         
     @property
     def log2Avgs(self):
-        return self.__log2Avgs.value
+        return self.parameter("log2Avgs").value
     
     @log2Avgs.setter
     def log2Avgs(self,v):
-        self.__log2Avgs.value = v
+        self.parameter("log2Avgs").value = v
         
     
     ## Secondary Data Processing
     @property
     def sumStart(self):
-        return self.__sumStart.value
+        return self.parameter("sumStart").value
     
     @sumStart.setter
     def sumStart(self,v):
         if (v + self.width) >= self.samplesPerPulse:
             warnings.warn("Summation window is larger than the number of samples per pulse!")
-        self.__sumStart.value = v
+        self.parameter("sumStart").value = v
         
     @property
     def subStart(self):
-        return self.__subStart.value
+        return self.parameter("subStart").value
     
     @subStart.setter
     def subStart(self,v):
@@ -300,11 +412,11 @@ class Configuration:
         if (v + self.width) >= self.samplesPerPulse:
             warnings.warn("Subtraction window is larger than the number of samples per pulse!")
             
-        self.__subStart.value = v
+        self.parameter("subStart").value = v
         
     @property
     def width(self):
-        return self.__width.value
+        return self.parameter("sumWidth").value
     
     @width.setter
     def width(self,v):
@@ -312,7 +424,7 @@ class Configuration:
             warnings.warn("Start of subtraction window must be after the summation window")
         if (self.subStart + v) >= self.samplesPerPulse:
             warnings.warn("Subtraction window must end before sampling does!")
-        self.__width.value = v
+        self.parameter("sumWidth").value = v
         
 
     def upload(self):
@@ -0,0 +1,205 @@
+import time
+import array
+
+import hardware
+
+#
+# Read-only registers holding the number of words written to each block RAM. They are
+# indexed in the same way as fetchType: 0: raw signal, 1: integrated signal, 2: raw auxiliary,
+# 3: integrated auxiliary, 4: ratio
+#
+COUNT_ADDR = [0x01000000,0x01000004,0x01000008,0x0100000C,0x01000010]
+RAW_TYPES = [0,2]
+PROCESSED_TYPES = [4,1,3]
+
+
+class Shot:
+    #Data from one completed acquisition. buffers is indexed by fetchType and holds an
+    #array('I') for each block RAM that was read, or None
+    def __init__(self,index,timestamp,counts,buffers):
+        self.index = index
+        self.time = timestamp
+        self.counts = counts
+        self.buffers = buffers
+
+    def fetch_types(self):
+        return [k for k in PROCESSED_TYPES + RAW_TYPES if self.buffers[k] is not None]
+
+    def header(self,types=None):
+        #Fields describing the shot, used when the shot is sent to clients
+        if types is None:
+            types = self.fetch_types()
+        return {"shot":self.index,"time":self.time,"counts":self.counts,"fetchTypes":types,"lengths":[4*len(self.buffers[k]) for k in types]}
+
+
+def read_counts(dev):
+    return [dev.read(a) for a in COUNT_ADDR]
+
+
+class ShotWatcher:
+    #Detects the end of each acquisition by watching the read-only counter registers.
+    #The counters do not reset at the start of a shot, so the watcher also keeps the first
+    #words of the integrated signal memory in its signature. A shot is complete when the
+    #signature has changed since the last shot and has been stable for at least 'settle' seconds.
+    #The polling interval adapts: it drops to min_interval while the signature is changing or
+    #after wake(), and doubles on every idle poll up to 'interval'
+    def __init__(self,device=None,interval=10e-3,settle=5e-3,min_interval=1e-3):
+        self.device = device
+        self.interval = interval
+        self.min_interval = min_interval
+        self.settle = settle
+        self.include_raw = 0            #Number of listeners that want the raw buffers
+        self.shot_count = 0
+        self.last_shot = None
+        self._listeners = []
+        self._pollers = []
+        self._waiters = []              #[fn, deadline] for each waiter
+        self._last_signature = None
+        self._candidate = None
+        self._candidate_time = 0
+        self._next_poll = 0
+        self._interval = min_interval
+
+    def add_listener(self,fn,raw=False):
+        if not self._listeners and not self._waiters:
+            #Memory contents from while nobody was listening are not reported as a new shot
+            self._last_signature = None
+        self._listeners.append(fn)
+        if raw:
+            self.include_raw += 1
+
+    def remove_listener(self,fn,raw=False):
+        if fn in self._listeners:
+            self._listeners.remove(fn)
+            if raw:
+                self.include_raw -= 1
+
+    def add_poller(self,fn):
+        #Registers a function that is called with the current time on every poll, after
+        #any new shot has been passed to the listeners
+        self._pollers.append(fn)
+
+    def remove_poller(self,fn):
+        if fn in self._pollers:
+            self._pollers.remove(fn)
+
+    def add_waiter(self,fn,timeout,after=None):
+        #Calls fn once with the next completed shot, or with None if no shot completes within
+        #timeout seconds. If the last shot found is newer than shot number 'after', fn is called
+        #with it straight away and False is returned. Any number of waiters share the same polls
+        if after is not None and self.last_shot is not None and self.last_shot.index > after:
+            fn(self.last_shot)
+            return False
+        if not self._listeners and not self._waiters:
+            self._last_signature = None
+        self._waiters.append([fn,time.time() + timeout])
+        return True
+
+    def remove_waiter(self,fn):
+        self._waiters = [w for w in self._waiters if w[0] != fn]
+
+    def arm(self):
+        #Takes the current memory contents as the reference for the next shot, so that a shot
+        #started after this returns is found even if it ends before the next poll
+        if self._last_signature is None:
+            dev = self.device if self.device is not None else hardware.get_device()
+            self._last_signature = self._signature(dev)
+
+    def wake(self):
+        #Polls at the shortest interval again, e.g. after an acquisition has been started
+        self._interval = self.min_interval
+        self._next_poll = min(self._next_poll,time.time() + self.min_interval)
+
+    def active(self):
+        return len(self._listeners) > 0 or len(self._pollers) > 0 or len(self._waiters) > 0
+
+    def timeout(self,now=None):
+        #Time until the next poll is due, for use as a select() timeout
+        if now is None:
+            now = time.time()
+        return max(0,self._next_poll - now)
+
+    def _signature(self,dev):
+        counts = read_counts(dev)
+        if counts[1] >= 2:
+            return tuple(counts) + tuple(dev.read_block(hardware.FETCH_ADDR[1],2))
+        return tuple(counts)
+
+    def poll(self,now=None):
+        #Checks the counters and returns a new Shot if an acquisition has just completed, calling
+        #every listener with it. Returns None otherwise
+        if now is None:
+            now = time.time()
+        if now < self._next_poll:
+            return None
+        busy = self._candidate is not None or self._last_signature is None
+        shot = self._check(now)
+        if busy or self._candidate is not None:
+            self._interval = self.min_interval
+        else:
+            self._interval = min(2*self._interval,self.interval)
+        self._next_poll = now + self._interval
+        for fn in list(self._pollers):
+            fn(now)
+        if self._waiters:
+            expired = [w for w in self._waiters if w[1] <= now]
+            if expired:
+                self._waiters = [w for w in self._waiters if w[1] > now]
+                for fn,deadline in expired:
+                    fn(None)
+        return shot
+
+    def _check(self,now):
+        dev = self.device if self.device is not None else hardware.get_device()
+        signature = self._signature(dev)
+        if self._last_signature is None:
+            #Whatever is in memory when the watcher starts is not a new shot
+            self._last_signature = signature
+            return None
+        if signature == self._last_signature or max(signature[:len(COUNT_ADDR)]) == 0:
+            self._candidate = None
+            return None
+        if signature != self._candidate:
+            self._candidate = signature
+            self._candidate_time = now
+            return None
+        if now - self._candidate_time < self.settle:
+            return None
+
+        self._last_signature = signature
+        self._candidate = None
+        shot = self.read_shot(dev,now,len(self._listeners) > 0)
+        self.last_shot = shot
+        for fn in list(self._listeners):
+            fn(shot)
+        waiters,self._waiters = self._waiters,[]
+        for fn,deadline in waiters:
+            fn(shot)
+        return shot
+
+    def read_shot(self,dev,now=None,data=True):
+        #Reads the buffers of the most recent shot from the block RAMs. Without data only the
+        #counters are read, which is all that waiters need
+        counts = read_counts(dev)
+        types = (PROCESSED_TYPES + (RAW_TYPES if self.include_raw > 0 else [])) if data else []
+        buffers = [None]*len(COUNT_ADDR)
+        for k in types:
+            buffers[k] = dev.read_block(hardware.FETCH_ADDR[k],min(counts[k],hardware.MAX_FETCH))
+        self.shot_count += 1
+        return Shot(self.shot_count,now if now is not None else time.time(),counts,buffers)
+
+
+def wait_for_shot(watcher,timeout,start=None):
+    #Blocks until the watcher finds the next shot and returns it, or returns None after timeout
+    #seconds. start() is called once the watcher is armed, e.g. to trigger the acquisition.
+    #Only for use where nothing else polls the watcher
+    result = []
+    watcher.add_waiter(result.append,timeout)
+    watcher.arm()
+    if start is not None:
+        start()
+        watcher.wake()
+    while not result:
+        watcher.poll()
+        time.sleep(watcher.timeout())
+    return result[0]
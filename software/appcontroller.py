@@ -1,42 +1,478 @@
 # from bitstring import BitArray
 # import serial
-import time
-import types
-import subprocess
-import warnings
+import sys
+import logging
 
-MEM_ADDR = 0x40000000
+import array
 
-def write(data,header):
-    if len(data) > 0:
-        addr = MEM_ADDR + data[0]
-    
-    if header["mode"] == "write":
-        cmd = ['monitor',format(addr),'0x' + '{:0>8x}'.format(data[1])]
-    elif header["mode"] == "read":
-        cmd = ['monitor',format(addr)]
-    elif header["mode"] == "fetch data":
-        cmd = ['./fetchData',format(header["numFetch"]),format(header["fetchType"])]
-    # elif header["mode"] == "fetch raw":
-    #     cmd = ['./fetchData',format(header["numFetch"]),'0']
-    # elif header["mode"] == "fetch processed":
-    #     cmd = ['./fetchData',format(header["numFetch"]),'1']
+import hardware
+import acquisition
+import shothistory
+import shotarchive
+import codec
+import registermap
+import binheader
+import profiles
+import feedbackstats
+import metrics
+try:
+    import dpdata
+    import transition
+except ImportError:
+    #Decoding on the device needs NumPy, the other modes work without it
+    dpdata = None
+    transition = None
 
-    if ("print" in header) and (header["print"]):
-        print("Command: ",cmd)
-    result = subprocess.run(cmd,stdout=subprocess.PIPE)
-    if result.returncode != 0:
-        response = {"err":True,"errMsg":"Bus error"}
+MEM_ADDR = hardware.MEM_ADDR
+TRIGGER_ADDR = registermap.ADDR[registermap.index("pulseTrig")]
+COUNTER_NAMES = [n for k,n in enumerate(registermap.NAMES) if registermap.ADDR[k] in registermap.READONLY]
+MAX_WAIT = 3600             #Longest timeout in seconds accepted by the 'wait for shot' mode
+#Header fields selecting shots from the history, with the types they can have
+HISTORY_FIELDS = (("first",int),("last",int),("since",(int,float)),("until",(int,float)),("maxShots",int))
+
+log = logging.getLogger(__name__)
+
+_watcher = None
+_history = None
+_archive = None
+_profiles = None
+_feedback = None
+
+def open_device(filename="/dev/mem",base=MEM_ADDR):
+    #Opens the memory-mapped device once when the server starts
+    return hardware.open_device(filename,base)
+
+def get_watcher():
+    #Returns the watcher that detects completed shots, shared by all clients
+    global _watcher
+    if _watcher is None:
+        _watcher = acquisition.ShotWatcher()
+    return _watcher
+
+def enable_history(max_shots=1000,max_bytes=64*2**20,raw=False):
+    #Stores every completed shot in memory so that it can be retrieved with the 'history' mode
+    global _history
+    disable_history()
+    _history = shothistory.ShotHistory(max_shots,max_bytes,raw)
+    get_watcher().add_listener(_history.add,raw)
+    return _history
+
+def disable_history():
+    global _history
+    if _history is not None:
+        get_watcher().remove_listener(_history.add,_history.raw)
+        _history = None
+
+def get_history():
+    return _history
+
+def enable_archive(directory,segment_bytes=shotarchive.SEGMENT_BYTES,raw=False):
+    #Appends every completed shot to the archive in 'directory', see shotarchive.py
+    global _archive
+    disable_archive()
+    _archive = shotarchive.ArchiveWriter(directory,segment_bytes,raw)
+    get_watcher().add_listener(_archive.add,raw)
+    return _archive
+
+def disable_archive():
+    global _archive
+    if _archive is not None:
+        get_watcher().remove_listener(_archive.add,_archive.raw)
+        _archive.close()
+        _archive = None
+
+def enable_feedback_stats(max_tau=feedbackstats.MAX_TAU):
+    #Updates the feedback statistics (see feedbackstats.py) from every completed shot so that
+    #they can be read with the 'feedback stats' mode
+    global _feedback
+    disable_feedback_stats()
+    _feedback = feedbackstats.FeedbackStats(max_tau=max_tau)
+    get_watcher().add_listener(_feedback.add)
+    return _feedback
+
+def disable_feedback_stats():
+    global _feedback
+    if _feedback is not None:
+        get_watcher().remove_listener(_feedback.add)
+        _feedback = None
+
+def read_feedback_stats(header):
+    #Returns the feedback statistics in the field 'stats'. With 'reset' set they start again
+    if _feedback is None:
+        return {"err":True,"errMsg":"Feedback statistics are not enabled on the server","data":[]}
+    response = {"err":False,"errMsg":"","stats":_feedback.snapshot(),"data":[]}
+    if header.get("reset",False):
+        _feedback.reset()
+    return response
+
+def enable_profiles(filename=None):
+    #Keeps the profiles in a JSON file. Without this they only last until the server stops
+    global _profiles
+    _profiles = profiles.ProfileStore(filename)
+    return _profiles
+
+def get_profiles():
+    if _profiles is None:
+        enable_profiles()
+    return _profiles
+
+def read_image(dev,addrs=registermap.PARAMETER_REGISTERS):
+    return dict((a,dev.read(a)) for a in addrs)
+
+def save_profile(dev,header):
+    #Stores the profile 'name'. It starts from the profile 'base', or by default from the current
+    #register values, and the raw words in 'registers' (a list of (address, value) pairs) and
+    #the parameters in 'values' are applied to it. The result is checked before it is stored
+    store = get_profiles()
+    try:
+        base = store.get(header["base"]) if "base" in header else read_image(dev)
+        registers = header.get("registers")
+        if registers is not None and not (isinstance(registers,list) and all(isinstance(r,list) and len(r) == 2 for r in registers)):
+            raise ValueError("Registers must be a list of [address, value] pairs")
+        regs = profiles.build(base,None if registers is None else dict(registers),header.get("values"))
+        store.save(header.get("name"),regs)
+    except (ValueError,TypeError) as e:
+        return {"err":True,"errMsg":str(e),"data":[]}
+    return {"err":False,"errMsg":"","name":header["name"],"data":[]}
+
+def activate_profile(dev,header):
+    #Writes the words of profile 'name' that differ from the device, and returns their
+    #addresses in 'changed'
+    try:
+        regs = get_profiles().get(header.get("name"))
+    except ValueError as e:
+        return {"err":True,"errMsg":str(e),"data":[]}
+    changed = profiles.diff(regs,read_image(dev,regs))
+    for a in changed:
+        dev.write(a,regs[a])
+    return {"err":False,"errMsg":"","name":header["name"],"changed":changed,"data":[]}
+
+def list_profiles(header):
+    #Returns the stored profiles in 'profiles' as a dict of name -> parameter values in physical
+    #units, or as a list of names if 'values' is false
+    store = get_profiles()
+    if not header.get("values",True):
+        return {"err":False,"errMsg":"","profiles":store.names(),"data":[]}
+    names = [n for k,n in enumerate(registermap.NAMES) if registermap.ADDR[k] in registermap.PARAMETER_REGISTERS]
+    return {"err":False,"errMsg":"","profiles":dict((p,registermap.unpack(names,store.get(p))) for p in store.names()),"data":[]}
+
+def delete_profile(header):
+    try:
+        get_profiles().delete(header.get("name"))
+    except ValueError as e:
+        return {"err":True,"errMsg":str(e),"data":[]}
+    return {"err":False,"errMsg":"","data":[]}
+
+def is_number(x,kind=(int,float)):
+    return isinstance(x,kind) and not isinstance(x,bool)
+
+def select_history(header):
+    #Returns the shots in the history selected by the header fields in HISTORY_FIELDS, or an
+    #error message as a str
+    if _history is None:
+        return "Shot history is not enabled"
+    limits = []
+    for name,kind in HISTORY_FIELDS:
+        value = header.get(name)
+        if value is not None and not is_number(value,kind):
+            return "'{}' must be {}".format(name,"an integer" if kind is int else "a number")
+        limits.append(value)
+    return _history.select(*limits)
+
+def read_history(header):
+    #Returns stored shots selected by the header fields 'first'/'last' (shot numbers) and
+    #'since'/'until' (times). The buffers of all shots are concatenated into the data, and
+    #'shots' describes each shot in the same way as a pushed shot
+    shots = select_history(header)
+    if isinstance(shots,str):
+        return {"err":True,"errMsg":shots,"data":[]}
+    raw = bool(header.get("raw",False))
+    data = array.array("I")
+    info = []
+    for shot in shots:
+        fetch_types = [k for k in shot.fetch_types() if raw or k not in acquisition.RAW_TYPES]
+        for k in fetch_types:
+            data.extend(shot.buffers[k])
+        info.append(shot.header(fetch_types))
+    return {"err":False,"errMsg":"","shots":info,"first":_history.first(),"last":_history.last(),"data":data}
+
+def fetch_decoded(dev,header):
+    #Returns decoded data as 32-bit floats, described by the fields 'shape' and 'dt'
+    if dpdata is None:
+        return {"err":True,"errMsg":"Decoding data requires NumPy on the device","data":[]}
+    if header.get("method","float") not in ("int","float"):
+        return {"err":True,"errMsg":"Method can only be 'int' or 'float'","data":[]}
+    if not isinstance(header.get("quantity"),str) or header["quantity"] not in dpdata.QUANTITIES:
+        return {"err":True,"errMsg":"Quantity must be one of {}".format(", ".join(dpdata.QUANTITIES)),"data":[]}
+    values,dt = dpdata.read_quantity(dev,header["quantity"],header.get("method","float"))
+    data = array.array("I")
+    data.frombytes(values.astype("float32").tobytes())
+    return {"err":False,"errMsg":"","quantity":header["quantity"],"dtype":"float32","shape":list(values.shape),"dt":dt,"data":data}
+
+def find_transition(header):
+    #Locates the transition in a ramp scan (see transition.py) in the shot in memory, or in each
+    #shot in the history selected by 'first', 'last', 'since', 'until' and 'maxShots' as for the
+    #'history' mode. Pulse k is at frequency 'start' + k*'step'. Only the frequencies and their
+    #uncertainties are sent back, as numbers for the shot in memory and as lists for the history
+    if transition is None:
+        return {"err":True,"errMsg":"Finding transitions requires NumPy on the device","data":[]}
+    method = header.get("method","midpoint")
+    edge = header.get("edge","falling")
+    quantity = header.get("quantity","ratio")
+    channel = header.get("channel",0)
+    if method not in transition.METHODS:
+        return {"err":True,"errMsg":"Method must be one of {}".format(", ".join(transition.METHODS)),"data":[]}
+    if edge not in transition.EDGES:
+        return {"err":True,"errMsg":"Edge must be 'falling' or 'rising'","data":[]}
+    if not isinstance(quantity,str) or quantity not in transition.TRACES or channel not in (0,1):
+        return {"err":True,"errMsg":"Quantity must be one of {} and channel 0 or 1".format(", ".join(transition.TRACES)),"data":[]}
+    if not is_number(header.get("start",0)) or not is_number(header.get("step",1)):
+        return {"err":True,"errMsg":"'start' and 'step' must be numbers","data":[]}
+    from_history = any(name in header for name,kind in HISTORY_FIELDS)
+    if from_history:
+        shots = select_history(header)
+        if isinstance(shots,str):
+            return {"err":True,"errMsg":shots,"data":[]}
+        traces = [transition.trace(shot.buffers,quantity,channel) for shot in shots]
     else:
-        response = {"err":False,"errMsg":""}
-        if len(result.stdout) > 0:
-            response["data"] = result.stdout.decode('ascii').rstrip().split("\n")
-        else:
-            response["data"] = []
+        dev = hardware.get_device()
+        k = transition.TRACES[quantity]
+        try:
+            num = min(acquisition.read_counts(dev)[k],hardware.MAX_FETCH)
+            traces = [transition.trace({k:dpdata.view_block(dev,k,num)},quantity,channel)]
+        except (OSError,ValueError,IndexError):
+            return {"err":True,"errMsg":"Bus error","data":[]}
+    freq,err = transition.find(transition.stack(traces),method,edge,header.get("start",0),header.get("step",1))
+    #NaN, where no transition was found, is sent as null
+    freq = [float(f) if f == f else None for f in freq]
+    err = [float(e) if e == e else None for e in err]
+    if from_history:
+        return {"err":False,"errMsg":"","shots":[shot.index for shot in shots],"frequency":freq,"uncertainty":err,"data":[]}
+    return {"err":False,"errMsg":"","frequency":freq[0],"uncertainty":err[0],"data":[]}
+
+def encode_block(values,header):
+    #Compresses fetched block RAM contents. The reply describes how to decode the data: the
+    #encoding, the element size and stride used by the filters, and the length before encoding
+    size,stride = codec.layout(header["fetchType"])
+    if sys.byteorder != "little":
+        values.byteswap()
+    data = codec.encode(memoryview(values).cast("B"),header["encoding"],size,stride,header.get("level"))
+    return {"err":False,"errMsg":"","encoding":header["encoding"],"rawLength":4*len(values),
+            "elementSize":size,"stride":stride,"data":data}
+
+def shot_counts(shot):
+    #Reply to a 'wait for shot' request: the shot number and time, and the final values of the
+    #counters as register values in 'counts' (indexed by fetchType) and in physical units in 'values'
+    if shot is None:
+        return {"err":True,"errMsg":"Timed out waiting for a shot","timedOut":True,"data":[]}
+    values = registermap.unpack(COUNTER_NAMES,dict(zip(acquisition.COUNT_ADDR,shot.counts)))
+    return {"err":False,"errMsg":"","shot":shot.index,"time":shot.time,"counts":shot.counts,"values":values,"data":[]}
 
+def wait_for_shot(header,fn):
+    #Registers fn to be called with the next completed shot, or with None once 'timeout' seconds
+    #have passed; shot_counts() turns either into the reply. With 'start' set the acquisition is
+    #also triggered, after the watcher has taken note of the memory contents, and with 'after' a
+    #shot newer than that shot number that has already been found is passed at once. Returns an
+    #error reply if the request is invalid, and None otherwise. All waiters share the watcher,
+    #so the registers are polled once however many clients are waiting. Cancel with
+    #get_watcher().remove_waiter(fn)
+    timeout = header.get("timeout",10)
+    after = header.get("after")
+    if not isinstance(timeout,(int,float)) or timeout <= 0 or timeout > MAX_WAIT:
+        return {"err":True,"errMsg":"Timeout must be between 0 and {:d} s".format(MAX_WAIT),"data":[]}
+    if after is not None and not isinstance(after,int):
+        return {"err":True,"errMsg":"'after' must be a shot number","data":[]}
+    watcher = get_watcher()
+    if not watcher.add_waiter(fn,timeout,after):
+        return None
+    if header.get("start",False):
+        try:
+            watcher.arm()
+            hardware.get_device().write(TRIGGER_ADDR,1)
+        except (OSError,ValueError,IndexError):
+            watcher.remove_waiter(fn)
+            return {"err":True,"errMsg":"Bus error","data":[]}
+        watcher.wake()
+    return None
+
+def read_stats(header):
+    #Returns the server metrics as JSON in the field 'stats', or as Prometheus text in the data
+    #if 'format' is 'prometheus'. With 'reset' set the counters start again from zero
+    m = metrics.get_metrics()
+    if header.get("format","json") == "prometheus":
+        response = {"err":False,"errMsg":"","format":"prometheus","data":m.prometheus().encode('ascii')}
+    else:
+        response = {"err":False,"errMsg":"","stats":m.snapshot(),"data":[]}
+    if header.get("reset",False):
+        m.reset()
     return response
-        
 
+def read_parameters(dev,header):
+    #Returns the parameters listed in 'names', or all of them, in physical units in the field
+    #'values'. Each register is read once, see registermap.py
+    names = header.get("names",list(registermap.NAMES))
+    try:
+        addrs = registermap.registers_for(names)
+    except (ValueError,TypeError):
+        return {"err":True,"errMsg":"Names must be a list of parameters in the register map","data":[]}
+    regs = dict((a,dev.read(a)) for a in addrs)
+    return {"err":False,"errMsg":"","values":registermap.unpack(names,regs),"data":[]}
+
+def write_parameters(dev,header):
+    #Sets the parameters in the dict 'values', given in physical units. Each register involved
+    #is read and written once
+    values = header.get("values")
+    if not isinstance(values,dict):
+        return {"err":True,"errMsg":"Values must be a dict of parameter name and value","data":[]}
+    try:
+        addrs = registermap.registers_for(values)
+    except ValueError as e:
+        return {"err":True,"errMsg":str(e),"data":[]}
+    regs = dict((a,dev.read(a)) for a in addrs)
+    try:
+        registermap.pack(values,regs)
+    except (ValueError,TypeError) as e:
+        return {"err":True,"errMsg":str(e),"data":[]}
+    for a in addrs:
+        dev.write(a,regs[a])
+    return {"err":False,"errMsg":"","data":[]}
+
+def write_register(dev,addr,value):
+    dev.write(addr,value)
+    if addr == TRIGGER_ADDR and _watcher is not None:
+        #A shot may have been started, so look for its end without waiting for the back-off
+        _watcher.wake()
+
+def check_fetch(fetch_type,num_fetch):
+    #Returns an error message if a block RAM read is out of range, and None otherwise
+    if not is_number(fetch_type,int) or fetch_type < 0 or fetch_type >= len(hardware.FETCH_ADDR):
+        return "Invalid fetch type {}".format(fetch_type)
+    if not is_number(num_fetch,int) or num_fetch < 0 or num_fetch > hardware.MAX_FETCH:
+        return "Number of samples to fetch must be between 0 and {}".format(hardware.MAX_FETCH)
+    return None
+
+
+#
+# Handlers for requests with a binary header (see binheader.py), called with the device, the
+# data and the fields fetchType and numFetch. They return the data of the reply or an error
+# message as a str
+#
+def _binary_read(dev,data,fetch_type,num_fetch):
+    if len(data) == 0:
+        return "Reads need an address"
+    return [dev.read(data[0])]
+
+def _binary_write(dev,data,fetch_type,num_fetch):
+    if len(data) < 2:
+        return "Writes need an address and a value"
+    write_register(dev,data[0],data[1])
+    return []
+
+def _binary_read_batch(dev,data,fetch_type,num_fetch):
+    return [dev.read(a) for a in data]
 
-    
-        
+def _binary_write_batch(dev,data,fetch_type,num_fetch):
+    if len(data) % 2 != 0:
+        return "Batch writes need (address, value) pairs"
+    for n in range(0,len(data),2):
+        write_register(dev,data[n],data[n + 1])
+    return []
+
+def _binary_fetch(dev,data,fetch_type,num_fetch):
+    err = check_fetch(fetch_type,num_fetch)
+    if err is not None:
+        return err
+    return dev.read_block(hardware.FETCH_ADDR[fetch_type],num_fetch)
+
+BINARY_HANDLERS = {
+    binheader.OPCODES["read"]:          _binary_read,
+    binheader.OPCODES["write"]:         _binary_write,
+    binheader.OPCODES["read batch"]:    _binary_read_batch,
+    binheader.OPCODES["write batch"]:   _binary_write_batch,
+    binheader.OPCODES["fetch data"]:    _binary_fetch,
+}
+
+def write_binary(data,opcode,fetch_type=0,num_fetch=0):
+    #Handles a request with a binary header by looking up its opcode. Returns a response in the
+    #same form as write()
+    handler = BINARY_HANDLERS.get(opcode)
+    if handler is None:
+        return {"err":True,"errMsg":"Unknown opcode {}".format(opcode),"data":[]}
+    try:
+        values = handler(hardware.get_device(),data,fetch_type,num_fetch)
+    except (OSError,ValueError,IndexError):
+        return {"err":True,"errMsg":"Bus error","data":[]}
+    if isinstance(values,str):
+        return {"err":True,"errMsg":values,"data":[]}
+    return {"err":False,"errMsg":"","data":values}
+
+def write(data,header):
+    if ("print" in header) and (header["print"]):
+        log.info("Mode: %s",header["mode"])
+
+    if header["mode"] == "history":
+        #Served from memory without touching the hardware
+        return read_history(header)
+    elif header["mode"] == "find transition":
+        return find_transition(header)
+    elif header["mode"] == "stats":
+        return read_stats(header)
+    elif header["mode"] == "feedback stats":
+        return read_feedback_stats(header)
+    elif header["mode"] == "list profiles":
+        return list_profiles(header)
+    elif header["mode"] == "delete profile":
+        return delete_profile(header)
+
+    dev = hardware.get_device()
+    try:
+        if header["mode"] == "write":
+            if len(data) < 2:
+                return {"err":True,"errMsg":"Writes need an address and a value","data":[]}
+            write_register(dev,data[0],data[1])
+            values = []
+        elif header["mode"] == "read":
+            if len(data) == 0:
+                return {"err":True,"errMsg":"Reads need an address","data":[]}
+            values = [dev.read(data[0])]
+        elif header["mode"] == "write batch":
+            #Data is a packed array of (address, value) pairs
+            if len(data) % 2 != 0:
+                return {"err":True,"errMsg":"Batch writes need (address, value) pairs","data":[]}
+            for n in range(0,len(data),2):
+                write_register(dev,data[n],data[n + 1])
+            values = []
+        elif header["mode"] == "read batch":
+            #Data is a packed array of addresses
+            values = [dev.read(a) for a in data]
+        elif header["mode"] == "read parameters":
+            return read_parameters(dev,header)
+        elif header["mode"] == "write parameters":
+            return write_parameters(dev,header)
+        elif header["mode"] == "save profile":
+            return save_profile(dev,header)
+        elif header["mode"] == "activate profile":
+            return activate_profile(dev,header)
+        elif header["mode"] == "fetch data":
+            #Block RAM contents are copied straight from the memory map into an array
+            err = check_fetch(header.get("fetchType"),header.get("numFetch"))
+            if err is not None:
+                return {"err":True,"errMsg":err,"data":[]}
+            if "encoding" in header:
+                try:
+                    codec.check(header["encoding"],header.get("level"))
+                except ValueError as e:
+                    return {"err":True,"errMsg":str(e),"data":[]}
+            values = dev.read_block(hardware.FETCH_ADDR[header["fetchType"]],header["numFetch"])
+            if "encoding" in header:
+                return encode_block(values,header)
+        elif header["mode"] == "fetch decoded":
+            return fetch_decoded(dev,header)
+        else:
+            return {"err":True,"errMsg":"Unknown mode {}".format(header["mode"]),"data":[]}
+    except (OSError,ValueError,IndexError):
+        response = {"err":True,"errMsg":"Bus error","data":[]}
+    else:
+        response = {"err":False,"errMsg":"","data":values}
+
+    return response
@@ -3,33 +3,85 @@ import socket
 import selectors
 import traceback
 import subprocess
+import logging
+import argparse
 
 import libserver
+import appcontroller
+import hardware
+import metrics
 
 sel = selectors.DefaultSelector()
 
 def acceptWrapper(sock):
     conn, addr = sock.accept()
-    print("Client (%s, %s) connected" % addr)
+    log.info("Client (%s, %s) connected",*addr)
     conn.setblocking(False)
     message = libserver.Message(sel,conn,addr)
     sel.register(conn,selectors.EVENT_READ,data=message)
 
+parser = argparse.ArgumentParser(description="Socket server for the Red Pitaya feedback design")
+parser.add_argument("--mem",default="/dev/mem",help="file to memory-map in place of /dev/mem")
+parser.add_argument("--simulate",action="store_true",help="use a simulated device instead of the FPGA (needs NumPy)")
+parser.add_argument("--host",default=None,help="address to listen on, found using get_ip.sh by default")
+parser.add_argument("--port",type=int,default=6666,help="port to listen on")
+parser.add_argument("--history-shots",type=int,default=0,help="number of shots to keep in memory for the 'history' mode")
+parser.add_argument("--history-bytes",type=int,default=64*2**20,help="maximum size of the shot history in bytes")
+parser.add_argument("--history-raw",action="store_true",help="keep the raw data in the shot history")
+parser.add_argument("--archive",default=None,help="directory to append every shot to, see shotarchive.py")
+parser.add_argument("--archive-segment-mb",type=int,default=256,help="size of each archive segment file in MB")
+parser.add_argument("--archive-raw",action="store_true",help="also archive the raw data")
+parser.add_argument("--feedback-stats",action="store_true",help="keep statistics of the feedback from every shot for the 'feedback stats' mode")
+parser.add_argument("--profiles",default=None,help="JSON file to keep the register profiles in")
+parser.add_argument("--log-level",default="warning",choices=["debug","info","warning","error"],help="level of the messages printed; 'debug' prints every request and reply")
+parser.add_argument("--metrics-port",type=int,default=None,help="serve Prometheus metrics over HTTP on this port")
+parser.add_argument("--no-metrics",action="store_true",help="do not time or count requests for the 'stats' mode")
+args = parser.parse_args()
+logging.basicConfig(level=getattr(logging,args.log_level.upper()),format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+log = logging.getLogger("appserver")
+
+#Map the FPGA registers once so that requests do not need to spawn 'monitor'
+if args.simulate:
+    import simulator
+    hardware.set_device(simulator.SimulatedDevice())
+elif args.mem == "/dev/mem":
+    appcontroller.open_device()
+else:
+    appcontroller.open_device(args.mem,0)
+
+if args.history_shots > 0:
+    appcontroller.enable_history(args.history_shots,args.history_bytes,args.history_raw)
+if args.archive is not None:
+    appcontroller.enable_archive(args.archive,args.archive_segment_mb*2**20,args.archive_raw)
+if args.feedback_stats:
+    appcontroller.enable_feedback_stats()
+appcontroller.enable_profiles(args.profiles)
+if args.no_metrics:
+    metrics.get_metrics().enabled = False
+
 # host = "127.0.0.1"
-r = subprocess.run(['./get_ip.sh'],stdout=subprocess.PIPE)
-host = r.stdout.decode('ascii').rstrip()
-port = 6666
+if args.host is None:
+    r = subprocess.run(['./get_ip.sh'],stdout=subprocess.PIPE)
+    host = r.stdout.decode('ascii').rstrip()
+else:
+    host = args.host
+port = args.port
 lsock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
 lsock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR, 1)
 lsock.bind((host,port))
 lsock.listen()
 print("Listening on", (host,port))
+if args.metrics_port is not None:
+    metrics.serve_http(host,args.metrics_port)
 lsock.setblocking(False)
 sel.register(lsock,selectors.EVENT_READ,data=None)
 
+#Watches the counter registers for completed shots while clients are subscribed or the history is enabled
+watcher = appcontroller.get_watcher()
+
 try:
     while True:
-        events = sel.select(timeout=None)
+        events = sel.select(timeout=watcher.timeout() if watcher.active() else None)
         for key,mask in events:
             if key.data is None:
                 acceptWrapper(key.fileobj)
@@ -43,10 +95,17 @@ try:
                     # print("Exception caught")
                     # print(message.addr)
                     # print(traceback.format_exc())
-                    print("main: error: exception for {}:\n{}".format(message.addr,traceback.format_exc()))
+                    log.error("main: error: exception for %s:\n%s",message.addr,traceback.format_exc())
                     message.close()
+        if watcher.active():
+            try:
+                watcher.poll()
+            except Exception:
+                log.error("main: error: exception while checking for shots:\n%s",traceback.format_exc())
 
 except KeyboardInterrupt:
     print("Caught keyboard interrupt, exiting")
 finally:
     sel.close()
+    appcontroller.disable_archive()
+    hardware.close_device()
@@ -0,0 +1,319 @@
+import sys
+import time
+import json
+import struct
+import array
+import asyncio
+import traceback
+import subprocess
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import libserver
+import appcontroller
+import binheader
+import hardware
+import metrics
+import sequencer
+
+#
+# Hardware access runs on worker threads so that the event loop is never blocked. Register
+# traffic and bulk transfers have separate workers, so a large fetch cannot hold up register
+# reads and writes from other clients. Each worker handles one request at a time
+#
+BULK_MODES = ("fetch data","fetch decoded","history","find transition")
+register_worker = ThreadPoolExecutor(max_workers=1)
+bulk_worker = ThreadPoolExecutor(max_workers=1)
+
+shots_wanted = None     #Set while at least one client is subscribed or running a sequence
+
+
+class Subscriber:
+    #Sends shots to a client that has subscribed. push() is called from the register worker
+    #when the watcher finds a new shot, and hands the shot over to the event loop
+    def __init__(self,loop,writer,raw):
+        self.loop = loop
+        self.writer = writer
+        self.raw = raw
+
+    def push(self,shot):
+        self.loop.call_soon_threadsafe(self._send,shot)
+
+    def _send(self,shot):
+        if self.writer.transport.is_closing():
+            return
+        if self.writer.transport.get_write_buffer_size() > libserver.MAX_PENDING_PUSH:
+            log.warning("Dropping shot %d for %s: client is not keeping up",shot.index,self.writer.get_extra_info("peername"))
+            metrics.get_metrics().dropped()
+            return
+        for b in libserver.frame_shot(shot,self.raw):
+            self.writer.write(b)
+            metrics.get_metrics().sent(len(b))
+
+
+#
+# The watcher polls on the register worker, so listeners, waiters and sequences are added to and
+# removed from it on that worker as well, and never while it goes through them
+#
+async def subscribe(loop,subscriber):
+    if subscriber is not None:
+        await loop.run_in_executor(register_worker,appcontroller.get_watcher().add_listener,subscriber.push,subscriber.raw)
+        shots_wanted.set()
+
+async def unsubscribe(loop,subscriber):
+    if subscriber is not None:
+        await loop.run_in_executor(register_worker,appcontroller.get_watcher().remove_listener,subscriber.push,subscriber.raw)
+
+
+def timed_write(data,header,binary=None):
+    #Runs a request on a worker and returns the reply with the time the worker started and
+    #the time spent handling it. binary is (opcode, fetchType, numFetch) for a binary header
+    t = time.perf_counter()
+    if binary is not None:
+        response = appcontroller.write_binary(data,*binary)
+    else:
+        response = appcontroller.write(data,header)
+    return response,t,time.perf_counter() - t
+
+
+async def wait_for_shot(loop,header):
+    #Waits for the next shot without blocking the event loop. The waiter is registered on the
+    #register worker, which also polls the watcher, and the shot is handed back to the loop
+    future = loop.create_future()
+    def done(shot):
+        loop.call_soon_threadsafe(lambda: future.done() or future.set_result(shot))
+    response = await loop.run_in_executor(register_worker,appcontroller.wait_for_shot,header,done)
+    if response is not None:
+        return response
+    shots_wanted.set()
+    try:
+        shot = await future
+    finally:
+        if not future.done():
+            await loop.run_in_executor(register_worker,appcontroller.get_watcher().remove_waiter,done)
+    return appcontroller.shot_counts(shot)
+
+
+def send_sequence(writer,response,close):
+    #Sends results from a sequence, called on the event loop
+    if writer.transport.is_closing():
+        return
+    for b in libserver.frame_response(response):
+        writer.write(b)
+        metrics.get_metrics().sent(len(b))
+    if response["done"] and close:
+        writer.close()
+
+
+async def handle_client(reader,writer):
+    #Reads requests using the same framing as libserver.Message: a 2 byte proto-header giving
+    #the length of the JSON header, the header, and 4*header["length"] bytes of data. With
+    #binheader.MAGIC in the proto-header a binary header follows instead
+    addr = writer.get_extra_info("peername")
+    loop = asyncio.get_running_loop()
+    subscriber = None
+    sequence = None
+    partial = False         #Set while a request has only been partly read
+    next_request = None     #Read of the next proto-header started while waiting for a shot
+    m = metrics.get_metrics()
+    m.opened()
+    log.info("Client %s connected",addr)
+    try:
+        while True:
+            header_len = struct.unpack("<H",await (next_request or reader.readexactly(2)))[0]
+            next_request = None
+            partial = True
+            binary = None
+            if header_len == binheader.MAGIC:
+                header_len = binheader.REQUEST.size
+                buf = await reader.readexactly(header_len)
+                t = time.perf_counter()
+                opcode,flags,fetch_type,length,num_fetch,request_id = binheader.REQUEST.unpack(buf)
+                binary = (opcode,fetch_type,num_fetch)
+                header = {"mode":binheader.MODES.get(opcode,"unknown"),"keepAlive":bool(flags & binheader.FLAG_KEEP_ALIVE)}
+            else:
+                buf = await reader.readexactly(header_len)
+                t = time.perf_counter()
+                header = json.loads(buf.decode('ascii'))
+                length = header["length"]
+            t_parse = time.perf_counter() - t
+            buf = await reader.readexactly(4*length)
+            partial = False
+            t = time.perf_counter()
+            data = array.array("I")
+            data.frombytes(buf)
+            if sys.byteorder != "little":
+                data.byteswap()
+            m.received(2 + header_len + len(buf))
+            mode = header["mode"]
+            t_hw = time.perf_counter()
+            t_worker = None
+            m.observe("parse",mode,t_parse + t_hw - t)
+
+            if binary is not None:
+                worker = bulk_worker if header["mode"] in BULK_MODES else register_worker
+                response,t_start,t_worker = await loop.run_in_executor(worker,timed_write,data,header,binary)
+                m.observe("queue",mode,t_start - t_hw)
+            elif header["mode"] == "subscribe":
+                await unsubscribe(loop,subscriber)
+                subscriber = Subscriber(loop,writer,bool(header.get("raw",False)))
+                await subscribe(loop,subscriber)
+                response = {"err":False,"errMsg":"","data":[]}
+            elif header["mode"] == "unsubscribe":
+                await unsubscribe(loop,subscriber)
+                subscriber = None
+                response = {"err":False,"errMsg":"","data":[]}
+            elif header["mode"] == "sequence":
+                if sequence is not None and not sequence.done:
+                    response = {"err":True,"errMsg":"A sequence is already running on this connection","data":[]}
+                else:
+                    close = not header.get("keepAlive",False) and subscriber is None
+                    send = lambda r,close=close: loop.call_soon_threadsafe(send_sequence,writer,r,close)
+                    try:
+                        ready = lambda: writer.transport.get_write_buffer_size() <= libserver.MAX_PENDING_PUSH
+                        sequence = sequencer.Sequence(header.get("steps"),header.get("iterations"),send,bool(header.get("stream",True)),ready)
+                    except (ValueError,TypeError) as e:
+                        sequence = None
+                        response = {"err":True,"errMsg":str(e),"data":[]}
+                    else:
+                        response = {"err":False,"errMsg":"","iterations":sequence.iterations,"data":[]}
+            elif header["mode"] == "wait for shot":
+                #Reading the next request at the same time notices a disconnect straight away
+                #instead of after the timeout. A request that arrives is handled after the reply
+                next_request = asyncio.ensure_future(reader.readexactly(2))
+                waiting = asyncio.ensure_future(wait_for_shot(loop,header))
+                await asyncio.wait([waiting,next_request],return_when=asyncio.FIRST_COMPLETED)
+                if next_request.done() and next_request.exception() is not None:
+                    waiting.cancel()
+                    raise next_request.exception()
+                response = await waiting
+            else:
+                worker = bulk_worker if header["mode"] in BULK_MODES else register_worker
+                response,t_start,t_worker = await loop.run_in_executor(worker,timed_write,data,header)
+                m.observe("queue",mode,t_start - t_hw)
+            if t_worker is None:
+                t_worker = time.perf_counter() - t_hw
+            m.observe("hardware",mode,t_worker)
+            m.request(mode,response["err"])
+
+            t = time.perf_counter()
+            if binary is not None:
+                buffers = libserver.frame_binary_response(response,opcode,request_id)
+            else:
+                buffers = libserver.frame_response(response)
+            for b in buffers:
+                writer.write(b)
+                m.sent(len(b))
+            t_sent = time.perf_counter()
+            m.observe("build",mode,t_sent - t)
+            if header["mode"] == "sequence" and not response["err"]:
+                #Started after the reply is written so that results cannot be sent ahead of it
+                await loop.run_in_executor(register_worker,sequence.start,appcontroller.get_watcher())
+                shots_wanted.set()
+            await writer.drain()
+            m.observe("send",mode,time.perf_counter() - t_sent)
+            if not header.get("keepAlive",False) and subscriber is None and (sequence is None or sequence.done):
+                break
+    except asyncio.IncompleteReadError as e:
+        #Closing the connection between requests is how clients end kept-alive connections
+        if partial or e.partial:
+            log.warning("Client %s closed the connection in the middle of a request",addr)
+    except (BrokenPipeError,ConnectionResetError):
+        #Clients that close with messages still unread reset the connection
+        log.debug("Client %s reset the connection",addr)
+    except Exception:
+        log.error("main: error: exception for %s:\n%s",addr,traceback.format_exc())
+    finally:
+        if next_request is not None:
+            next_request.cancel()
+        await unsubscribe(loop,subscriber)
+        if sequence is not None:
+            await loop.run_in_executor(register_worker,sequence.cancel)
+        log.info("Closing connection %s",addr)
+        m.closed()
+        writer.close()
+
+
+async def watch_shots():
+    #Polls for completed shots on the register worker while anyone is subscribed or the history is enabled
+    loop = asyncio.get_running_loop()
+    watcher = appcontroller.get_watcher()
+    while True:
+        if not watcher.active():
+            shots_wanted.clear()
+            await shots_wanted.wait()
+        try:
+            await loop.run_in_executor(register_worker,watcher.poll)
+        except Exception:
+            log.error("main: error: exception while checking for shots:\n%s",traceback.format_exc())
+        await asyncio.sleep(watcher.timeout())
+
+
+parser = argparse.ArgumentParser(description="asyncio socket server for the Red Pitaya feedback design")
+parser.add_argument("--mem",default="/dev/mem",help="file to memory-map in place of /dev/mem")
+parser.add_argument("--simulate",action="store_true",help="use a simulated device instead of the FPGA (needs NumPy)")
+parser.add_argument("--host",default=None,help="address to listen on, found using get_ip.sh by default")
+parser.add_argument("--port",type=int,default=6666,help="port to listen on")
+parser.add_argument("--history-shots",type=int,default=0,help="number of shots to keep in memory for the 'history' mode")
+parser.add_argument("--history-bytes",type=int,default=64*2**20,help="maximum size of the shot history in bytes")
+parser.add_argument("--history-raw",action="store_true",help="keep the raw data in the shot history")
+parser.add_argument("--archive",default=None,help="directory to append every shot to, see shotarchive.py")
+parser.add_argument("--archive-segment-mb",type=int,default=256,help="size of each archive segment file in MB")
+parser.add_argument("--archive-raw",action="store_true",help="also archive the raw data")
+parser.add_argument("--feedback-stats",action="store_true",help="keep statistics of the feedback from every shot for the 'feedback stats' mode")
+parser.add_argument("--profiles",default=None,help="JSON file to keep the register profiles in")
+parser.add_argument("--log-level",default="warning",choices=["debug","info","warning","error"],help="level of the messages printed; 'debug' prints every request and reply")
+parser.add_argument("--metrics-port",type=int,default=None,help="serve Prometheus metrics over HTTP on this port")
+parser.add_argument("--no-metrics",action="store_true",help="do not time or count requests for the 'stats' mode")
+args = parser.parse_args()
+logging.basicConfig(level=getattr(logging,args.log_level.upper()),format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+log = logging.getLogger("appserver")
+
+if args.simulate:
+    import simulator
+    hardware.set_device(simulator.SimulatedDevice())
+elif args.mem == "/dev/mem":
+    appcontroller.open_device()
+else:
+    appcontroller.open_device(args.mem,0)
+
+if args.history_shots > 0:
+    appcontroller.enable_history(args.history_shots,args.history_bytes,args.history_raw)
+if args.archive is not None:
+    appcontroller.enable_archive(args.archive,args.archive_segment_mb*2**20,args.archive_raw)
+if args.feedback_stats:
+    appcontroller.enable_feedback_stats()
+appcontroller.enable_profiles(args.profiles)
+if args.no_metrics:
+    metrics.get_metrics().enabled = False
+
+if args.host is None:
+    r = subprocess.run(['./get_ip.sh'],stdout=subprocess.PIPE)
+    host = r.stdout.decode('ascii').rstrip()
+else:
+    host = args.host
+port = args.port
+
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+shots_wanted = asyncio.Event()
+server = loop.run_until_complete(asyncio.start_server(handle_client,host,port))
+print("Listening on", (host,port))
+if args.metrics_port is not None:
+    metrics.serve_http(host,args.metrics_port)
+watch_task = loop.create_task(watch_shots())
+
+try:
+    loop.run_forever()
+except KeyboardInterrupt:
+    print("Caught keyboard interrupt, exiting")
+finally:
+    watch_task.cancel()
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
+    register_worker.shutdown()
+    bulk_worker.shutdown()
+    appcontroller.disable_archive()
+    hardware.close_device()
@@ -0,0 +1,222 @@
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import argparse
+import platform
+import threading
+import subprocess
+
+import binheader
+
+#
+# End-to-end benchmark of the socket server. By default a server with a simulated device is
+# started on localhost, but any running server can be used with --host and --port. Each run
+# is appended as one line of JSON to the results file so that changes can be followed over time
+#
+REGISTER_ADDR = 0x24        #Parameter register used for reads and writes (integrateRegs(0))
+
+
+def request(header,data=(),binary=False):
+    #With binary set the request is sent with a binary header, see binheader.py
+    if binary:
+        flags = binheader.FLAG_KEEP_ALIVE if header.get("keepAlive") else 0
+        msg = binheader.pack_request(binheader.OPCODES[header["mode"]],len(data),flags,header.get("fetchType",0),header.get("numFetch",0))
+        return msg + struct.pack("<%dI" % len(data),*data)
+    header = dict(header,length=len(data))
+    tmp = json.dumps(header).encode('ascii')
+    return struct.pack("<H",len(tmp)) + tmp + struct.pack("<%dI" % len(data),*data)
+
+def recv_exact(sock,n,buf=None):
+    buf = bytearray(n) if buf is None else buf
+    view = memoryview(buf)
+    pos = 0
+    while pos < n:
+        k = sock.recv_into(view[pos:n])
+        if k == 0:
+            raise ConnectionError("Server closed the connection")
+        pos += k
+    return buf
+
+def response(sock):
+    n = struct.unpack("<H",recv_exact(sock,2))[0]
+    if n == binheader.MAGIC:
+        opcode,flags,length,request_id = binheader.REPLY.unpack(recv_exact(sock,binheader.REPLY.size))
+        data = recv_exact(sock,length)
+        if flags & binheader.FLAG_ERROR:
+            raise RuntimeError(bytes(data).decode('ascii'))
+        return {"length":length},data
+    header = json.loads(bytes(recv_exact(sock,n)).decode('ascii'))
+    data = recv_exact(sock,header["length"])
+    if header["err"]:
+        raise RuntimeError(header["errMsg"])
+    return header,data
+
+def percentile(values,p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1,int(round(p/100*(len(values) - 1))))]
+
+
+def run_clients(target,clients,duration):
+    #Runs target(stop_time,results) in each client thread and returns the list of results
+    results = [[] for n in range(clients)]
+    stop = time.time() + duration
+    threads = [threading.Thread(target=target,args=(stop,results[n])) for n in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def bench_registers(addr,clients,duration,binary=False):
+    #Alternating reads and writes of one register on persistent connections
+    def client(stop,latencies):
+        with socket.create_connection(addr) as sock:
+            n = 0
+            while time.time() < stop:
+                if n % 2:
+                    msg = request({"mode":"write","keepAlive":True},[REGISTER_ADDR,n],binary)
+                else:
+                    msg = request({"mode":"read","keepAlive":True},[REGISTER_ADDR],binary)
+                t = time.perf_counter()
+                sock.sendall(msg)
+                response(sock)
+                latencies.append(time.perf_counter() - t)
+                n += 1
+    results = run_clients(client,clients,duration)
+    latencies = [x for r in results for x in r]
+    return {"ops":len(latencies),"opsPerSecond":len(latencies)/duration,
+            "p50":percentile(latencies,50),"p90":percentile(latencies,90),
+            "p99":percentile(latencies,99),"max":max(latencies) if latencies else None}
+
+def bench_fetch(addr,clients,duration,num_fetch,fetch_type,binary=False):
+    #Repeated block RAM fetches on persistent connections
+    def client(stop,sizes):
+        with socket.create_connection(addr) as sock:
+            msg = request({"mode":"fetch data","numFetch":num_fetch,"fetchType":fetch_type,"keepAlive":True},(),binary)
+            while time.time() < stop:
+                sock.sendall(msg)
+                header,data = response(sock)
+                sizes.append(len(data))
+    t = time.perf_counter()
+    results = run_clients(client,clients,duration)
+    elapsed = time.perf_counter() - t
+    nbytes = sum(x for r in results for x in r)
+    return {"fetches":sum(len(r) for r in results),"bytes":nbytes,"MBPerSecond":nbytes/elapsed/2**20}
+
+def bench_connections(addr,clients,duration):
+    #One read per connection, with the connection closed by the server after the reply
+    def client(stop,times):
+        msg = request({"mode":"read"},[REGISTER_ADDR])
+        while time.time() < stop:
+            t = time.perf_counter()
+            with socket.create_connection(addr) as sock:
+                sock.sendall(msg)
+                response(sock)
+            times.append(time.perf_counter() - t)
+    results = run_clients(client,clients,duration)
+    times = [x for r in results for x in r]
+    return {"connections":len(times),"connectionsPerSecond":len(times)/duration,
+            "p50":percentile(times,50),"p99":percentile(times,99)}
+
+
+def start_server(script,port):
+    #Starts a server with a simulated device and waits until it accepts connections
+    proc = subprocess.Popen([sys.executable,script,"--simulate","--host","127.0.0.1","--port",format(port)],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+    for n in range(100):
+        try:
+            socket.create_connection(("127.0.0.1",port)).close()
+            return proc
+        except OSError:
+            if proc.poll() is not None:
+                raise RuntimeError("Server exited with code {}".format(proc.returncode))
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("Server did not start")
+
+def git_commit():
+    try:
+        r = subprocess.run(["git","rev-parse","--short","HEAD"],stdout=subprocess.PIPE,stderr=subprocess.DEVNULL,
+                           cwd=os.path.dirname(os.path.abspath(__file__)))
+        return r.stdout.decode('ascii').strip() or None
+    except OSError:
+        return None
+
+def previous_run(filename,config):
+    #Returns the last recorded run with the same configuration
+    last = None
+    if os.path.exists(filename):
+        with open(filename) as f:
+            for line in f:
+                try:
+                    run = json.loads(line)
+                except ValueError:
+                    continue
+                if run.get("config") == config:
+                    last = run
+    return last
+
+def compare(name,value,old,higher_is_better):
+    if old is None or value is None or old == 0:
+        return ""
+    change = 100*(value - old)/old
+    worse = change < 0 if higher_is_better else change > 0
+    return " ({:+.1f}% vs last run{})".format(change," - worse" if worse and abs(change) > 10 else "")
+
+
+parser = argparse.ArgumentParser(description="Benchmark the socket server with many concurrent clients")
+parser.add_argument("--host",default=None,help="address of a running server; by default a simulated server is started")
+parser.add_argument("--port",type=int,default=6667,help="port of the server")
+parser.add_argument("--server",default="appserver.py",help="server script to start when --host is not given")
+parser.add_argument("--clients",type=int,default=8,help="number of concurrent clients")
+parser.add_argument("--duration",type=float,default=5,help="duration of each test in seconds")
+parser.add_argument("--num-fetch",type=int,default=16384,help="number of words in each fetch")
+parser.add_argument("--fetch-type",type=int,default=1,help="memory to fetch from")
+parser.add_argument("--binary",action="store_true",help="send register and fetch requests with the binary header")
+parser.add_argument("--record",default="benchmark-results.jsonl",help="file that results are appended to")
+args = parser.parse_args()
+
+proc = None
+if args.host is None:
+    proc = start_server(args.server,args.port)
+    host = "127.0.0.1"
+else:
+    host = args.host
+addr = (host,args.port)
+
+config = {"server":args.server if proc is not None else "{}:{}".format(host,args.port),
+          "simulated":proc is not None,"clients":args.clients,"duration":args.duration,
+          "numFetch":args.num_fetch,"fetchType":args.fetch_type}
+if args.binary:
+    config["binary"] = True
+try:
+    results = {}
+    results["registers"] = bench_registers(addr,args.clients,args.duration,args.binary)
+    results["fetch"] = bench_fetch(addr,args.clients,args.duration,args.num_fetch,args.fetch_type,args.binary)
+    results["connections"] = bench_connections(addr,args.clients,args.duration)
+finally:
+    if proc is not None:
+        proc.terminate()
+        proc.wait()
+
+last = previous_run(args.record,config)
+old = last["results"] if last is not None else {"registers":{},"fetch":{},"connections":{}}
+r = results["registers"]
+print("Register ops:  {:.0f} ops/s{}".format(r["opsPerSecond"],compare("ops",r["opsPerSecond"],old["registers"].get("opsPerSecond"),True)))
+for p in ("p50","p90","p99","max"):
+    print("  {:>4}: {:.3f} ms{}".format(p,1e3*r[p],compare(p,r[p],old["registers"].get(p),False)))
+r = results["fetch"]
+print("Fetch:         {:.1f} MB/s{}".format(r["MBPerSecond"],compare("fetch",r["MBPerSecond"],old["fetch"].get("MBPerSecond"),True)))
+r = results["connections"]
+print("Connections:   {:.0f} per second{}".format(r["connectionsPerSecond"],compare("conn",r["connectionsPerSecond"],old["connections"].get("connectionsPerSecond"),True)))
+
+run = {"time":time.strftime("%Y-%m-%dT%H:%M:%S"),"commit":git_commit(),"python":platform.python_version(),
+       "machine":platform.machine(),"config":config,"results":results}
+with open(args.record,"a") as f:
+    f.write(json.dumps(run) + "\n")
+print("Results appended to {}".format(args.record))
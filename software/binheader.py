@@ -0,0 +1,41 @@
+import struct
+
+#
+# Fixed-layout binary header for the simple register and memory requests, used in place of the
+# JSON header when the 2 byte proto-header holds MAGIC. JSON headers are never MAGIC bytes long
+# (json_frame() refuses them), so both kinds of request can be sent on the same connection.
+#   request: opcode, flags, fetchType, pad, length (32-bit words of data), numFetch, id
+#   reply:   opcode, flags, pad, length (bytes of data), id
+# The reply echoes the opcode and request id. When FLAG_ERROR is set the data is the error message
+#
+MAGIC = 0xFFFF
+REQUEST = struct.Struct("<BBBxIII")
+REPLY = struct.Struct("<BBxxII")
+PROTO = struct.Struct("<H")
+
+FLAG_KEEP_ALIVE = 1
+FLAG_PRINT = 2
+FLAG_ERROR = 1
+
+#Opcode -> mode of the JSON request that does the same
+MODES = {
+    1: "read",
+    2: "write",
+    3: "read batch",
+    4: "write batch",
+    5: "fetch data",
+}
+OPCODES = dict((mode,op) for op,mode in MODES.items())
+
+
+def json_frame(tmp):
+    #Returns the proto-header followed by the encoded JSON header tmp
+    if len(tmp) >= MAGIC:
+        raise ValueError("JSON header must be shorter than {:d} bytes".format(MAGIC))
+    return PROTO.pack(len(tmp)) + tmp
+
+def pack_request(opcode,nwords,flags=0,fetch_type=0,num_fetch=0,request_id=0):
+    return PROTO.pack(MAGIC) + REQUEST.pack(opcode,flags,fetch_type,nwords,num_fetch,request_id)
+
+def pack_reply(opcode,nbytes,flags=0,request_id=0):
+    return PROTO.pack(MAGIC) + REPLY.pack(opcode,flags,nbytes,request_id)
@@ -0,0 +1,125 @@
+import sys
+import bz2
+import lzma
+import zlib
+import array
+try:
+    import numpy as np
+except ImportError:
+    #The filters fall back to plain Python loops
+    np = None
+
+#
+# Encodings for bulk data, given as a codec optionally followed by filters that are applied
+# before compressing, e.g. "zlib", "zlib+shuffle" or "zlib+delta+shuffle":
+#   delta:   each element is replaced by its difference from the element 'stride' before it
+#   shuffle: the bytes of the elements are regrouped so that all first bytes come first, then
+#            all second bytes and so on
+# The element size and stride depend on the memory layout, see layout()
+#
+CODECS = {
+    "zlib": (lambda data,level: zlib.compress(data,1 if level is None else level),zlib.decompress),
+    "bz2":  (lambda data,level: bz2.compress(data,9 if level is None else level),bz2.decompress),
+    "lzma": (lambda data,level: lzma.compress(data,preset=level),lzma.decompress),
+}
+FILTERS = ("delta","shuffle")
+LEVELS = {"zlib":range(0,10),"bz2":range(1,10),"lzma":range(0,10)}
+
+
+def parse_encoding(encoding):
+    #Splits an encoding into the codec and the list of filters
+    parts = encoding.split("+") if isinstance(encoding,str) else []
+    if not parts or parts[0] not in CODECS or any(f not in FILTERS for f in parts[1:]) or len(set(parts[1:])) < len(parts) - 1:
+        raise ValueError("Unknown encoding {}, use one of {} optionally followed by {}".format(encoding,", ".join(CODECS),", ".join("+" + f for f in FILTERS)))
+    return parts[0],[f for f in FILTERS if f in parts[1:]]
+
+def check(encoding,level=None):
+    #Raises a ValueError if the encoding or compression level is not supported
+    codec,filters = parse_encoding(encoding)
+    if level is not None and level not in LEVELS[codec]:
+        raise ValueError("Compression level for {} must be between {} and {}".format(codec,LEVELS[codec][0],LEVELS[codec][-1]))
+
+def layout(fetch_type):
+    #Element size in bytes and stride used by the filters for each memory. Raw data holds
+    #interleaved 16-bit I and Q values, integrated data interleaved 32-bit values of the two
+    #channels, and the ratio one 16-bit value in each word
+    if fetch_type in (0,2):
+        return 2,2
+    elif fetch_type in (1,3):
+        return 4,2
+    return 4,1
+
+def _typecode(size):
+    return "h" if size == 2 else "i"
+
+def _wrap(x,size):
+    bits = 8*size
+    return ((x + (1 << (bits - 1))) & ((1 << bits) - 1)) - (1 << (bits - 1))
+
+def delta(data,size,stride):
+    n = len(data) // size
+    if np is not None:
+        a = np.frombuffer(data,dtype="<i{}".format(size),count=n)
+        d = a.copy()
+        d[stride:] -= a[:-stride]
+        return d.tobytes() + bytes(data[n*size:])
+    a = array.array(_typecode(size))
+    a.frombytes(bytes(data[:n*size]))
+    if sys.byteorder != "little":
+        a.byteswap()
+    d = array.array(_typecode(size),a)
+    for k in range(stride,n):
+        d[k] = _wrap(a[k] - a[k - stride],size)
+    if sys.byteorder != "little":
+        d.byteswap()
+    return d.tobytes() + bytes(data[n*size:])
+
+def undelta(data,size,stride):
+    n = len(data) // size
+    if np is not None:
+        d = np.frombuffer(data,dtype="<i{}".format(size),count=n)
+        a = np.empty_like(d)
+        for j in range(stride):
+            #Sums of fixed-width integers wrap around in the same way as the differences did
+            a[j::stride] = np.cumsum(d[j::stride],dtype=d.dtype)
+        return a.tobytes() + bytes(data[n*size:])
+    a = array.array(_typecode(size))
+    a.frombytes(bytes(data[:n*size]))
+    if sys.byteorder != "little":
+        a.byteswap()
+    for k in range(stride,n):
+        a[k] = _wrap(a[k] + a[k - stride],size)
+    if sys.byteorder != "little":
+        a.byteswap()
+    return a.tobytes() + bytes(data[n*size:])
+
+def shuffle(data,size):
+    data = bytes(data)
+    m = len(data) - len(data) % size
+    return b"".join(data[k:m:size] for k in range(size)) + data[m:]
+
+def unshuffle(data,size):
+    n = len(data) // size
+    out = bytearray(data)
+    for k in range(size):
+        out[k:n*size:size] = data[k*n:(k + 1)*n]
+    return bytes(out)
+
+def encode(data,encoding,size=4,stride=1,level=None):
+    #Encodes little-endian bytes and returns the encoded bytes
+    check(encoding,level)
+    codec,filters = parse_encoding(encoding)
+    if "delta" in filters:
+        data = delta(data,size,stride)
+    if "shuffle" in filters:
+        data = shuffle(data,size)
+    return CODECS[codec][0](bytes(data),level)
+
+def decode(data,encoding,size=4,stride=1):
+    codec,filters = parse_encoding(encoding)
+    data = CODECS[codec][1](bytes(data))
+    if "shuffle" in filters:
+        data = unshuffle(data,size)
+    if "delta" in filters:
+        data = undelta(data,size,stride)
+    return data
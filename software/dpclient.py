@@ -0,0 +1,524 @@
+import json
+import queue
+import socket
+import struct
+import asyncio
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import codec
+import dpdata
+import binheader
+import registermap
+
+DEFAULT_PORT = 6666
+PIPELINE_DEPTH = 64             #Maximum number of requests sent ahead of their replies
+PIPELINE_BYTES = 32768          #Maximum number of request bytes sent ahead of their replies
+BINARY_FIELDS = frozenset(("mode","fetchType","numFetch","keepAlive","print"))
+TRIGGER_ADDR = registermap.ADDR[registermap.index("pulseTrig")]
+
+
+def encode_request(header,data=()):
+    #Frames a request in the same way as libserver.Message expects: a 2 byte proto-header,
+    #the JSON header and the data as little-endian 32-bit words
+    data = np.asarray(data,dtype="<u4").ravel()
+    header = dict(header,length=len(data))
+    tmp = json.dumps(header).encode('ascii')
+    return binheader.json_frame(tmp) + data.tobytes()
+
+def encode_binary_request(header,data=(),request_id=0):
+    #Frames a request with a binary header (see binheader.py), or returns None if the request
+    #has fields that only a JSON header can carry
+    opcode = binheader.OPCODES.get(header["mode"])
+    if opcode is None or not BINARY_FIELDS.issuperset(header):
+        return None
+    data = np.asarray(data,dtype="<u4").ravel()
+    flags = (binheader.FLAG_KEEP_ALIVE if header.get("keepAlive") else 0) | (binheader.FLAG_PRINT if header.get("print") else 0)
+    return binheader.pack_request(opcode,len(data),flags,header.get("fetchType",0),header.get("numFetch",0),request_id) + data.tobytes()
+
+def binary_reply_header(buf):
+    #Returns a binary reply header as a dict with the fields of a JSON reply header. The error
+    #message of a failed request is the data, which is added by finish_binary_reply()
+    opcode,flags,length,request_id = binheader.REPLY.unpack(buf)
+    return {"err":bool(flags & binheader.FLAG_ERROR),"errMsg":"","length":length,"opcode":opcode,"id":request_id}
+
+def finish_binary_reply(header,data):
+    if header["err"]:
+        header["errMsg"] = bytes(data).decode('ascii')
+    return header
+
+def check_response(header):
+    if header.get("err",False):
+        raise ValueError(header.get("errMsg","Server returned an error"))
+    return header
+
+def words(data):
+    #Returns a reply body as 32-bit words without copying
+    return np.frombuffer(data,dtype="<u4")
+
+
+class Connection:
+    #Persistent connection to one server. Requests can be pipelined: send() returns straight
+    #away, and the replies are read with receive() in the order the requests were sent. With
+    #binary set, requests that fit the binary header are sent with it
+    def __init__(self,host,port=DEFAULT_PORT,timeout=10,binary=False):
+        self.host = host
+        self.port = port
+        self.binary = binary
+        self.sock = socket.create_connection((host,port),timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        self.pending = 0
+        self._request_id = 0
+
+    def encode(self,header,data=()):
+        header = dict(header,keepAlive=True)
+        if self.binary:
+            self._request_id = (self._request_id + 1) & 0xFFFFFFFF
+            msg = encode_binary_request(header,data,self._request_id)
+            if msg is not None:
+                return msg
+        return encode_request(header,data)
+
+    def send(self,header,data=()):
+        self.sock.sendall(self.encode(header,data))
+        self.pending += 1
+
+    def _recv_exact(self,n):
+        buf = bytearray(n)
+        view = memoryview(buf)
+        pos = 0
+        while pos < n:
+            k = self.sock.recv_into(view[pos:])
+            if k == 0:
+                raise ConnectionError("Server closed the connection")
+            pos += k
+        return buf
+
+    def receive_message(self):
+        #Reads the next message, which can also be a shot or sequence result pushed by the server
+        n = struct.unpack("<H",self._recv_exact(2))[0]
+        if n == binheader.MAGIC:
+            header = binary_reply_header(self._recv_exact(binheader.REPLY.size))
+            data = self._recv_exact(header["length"])
+            return finish_binary_reply(header,data),data
+        header = json.loads(self._recv_exact(n).decode('ascii'))
+        data = self._recv_exact(header["length"])
+        return header,data
+
+    def receive(self):
+        header,data = self.receive_message()
+        self.pending -= 1
+        return check_response(header),data
+
+    def request(self,header,data=()):
+        self.send(header,data)
+        return self.receive()
+
+    def pipeline(self,requests):
+        #Sends a list of (header, data) requests and returns the list of replies. Only a limited
+        #number of requests is sent ahead of the replies so that neither side blocks on a full
+        #socket buffer
+        replies = []
+        sent = []
+        for header,data in requests:
+            msg = self.encode(header,data)
+            while sent and (len(sent) >= PIPELINE_DEPTH or sum(sent) + len(msg) > PIPELINE_BYTES):
+                replies.append(self.receive())
+                sent.pop(0)
+            self.sock.sendall(msg)
+            self.pending += 1
+            sent.append(len(msg))
+        while sent:
+            replies.append(self.receive())
+            sent.pop(0)
+        return replies
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class Client:
+    #Thread-safe client for one device with a pool of persistent connections. Register values are
+    #returned as integers and buffers as NumPy arrays that share memory with the received data.
+    #submit() runs any method on a worker thread and returns a concurrent.futures.Future. With
+    #binary set, register reads and writes and uncompressed fetches use the binary header,
+    #which costs the server less to decode than JSON
+    def __init__(self,host,port=DEFAULT_PORT,pool_size=4,timeout=10,binary=False):
+        self.host = host
+        self.port = port
+        self.binary = binary
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+        #Borrows a connection from the pool. Connections that fail are closed and not reused.
+        #Error replies leave the connection in a clean state, so it goes back to the pool as long
+        #as no reply is outstanding
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = Connection(self.host,self.port,self.timeout,self.binary)
+        try:
+            yield conn
+        except (OSError,ConnectionError):
+            conn.close()
+            raise
+        finally:
+            if conn.sock is not None:
+                if conn.pending == 0 and self._pool.qsize() < self.pool_size:
+                    self._pool.put(conn)
+                else:
+                    conn.close()
+
+    def request(self,header,data=()):
+        with self.connection() as conn:
+            return conn.request(header,data)
+
+    def pipeline(self,requests):
+        with self.connection() as conn:
+            return conn.pipeline(requests)
+
+    def submit(self,fn,*args,**kwargs):
+        #Runs e.g. client.submit(client.fetch,1,1000) in the background
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.pool_size)
+        return self._executor.submit(fn,*args,**kwargs)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    ## Registers
+    def read(self,addr):
+        return int(words(self.request({"mode":"read"},[addr])[1])[0])
+
+    def write(self,addr,value):
+        self.request({"mode":"write"},[addr,value])
+
+    def read_batch(self,addrs):
+        return words(self.request({"mode":"read batch"},addrs)[1])
+
+    def write_batch(self,addrs,values):
+        data = np.empty(2*len(addrs),dtype="<u4")
+        data[0::2] = addrs
+        data[1::2] = values
+        self.request({"mode":"write batch"},data)
+
+    ## Data
+    def fetch(self,fetch_type,num_fetch,encoding=None,level=None):
+        #Returns the first num_fetch words of a block RAM as a uint32 array. With an encoding
+        #(see codec.py) the data is compressed by the server, which helps on slow links
+        header = {"mode":"fetch data","fetchType":fetch_type,"numFetch":num_fetch}
+        if encoding is None:
+            return words(self.request(header)[1])
+        header["encoding"] = encoding
+        if level is not None:
+            header["level"] = level
+        return words(decode_reply(*self.request(header)))
+
+    def fetch_raw(self,channel,samples_per_pulse,num_fetch,encoding=None):
+        #Returns I and Q as arrays of size (samples_per_pulse, pulses) for the signal (channel 1)
+        #or auxiliary (channel 2) acquisition, like DPFeedback.getRaw
+        return dpdata.decode_raw(self.fetch(2*(channel - 1),num_fetch,encoding),samples_per_pulse)
+
+    def fetch_integrated(self,channel,pulses,encoding=None):
+        #Returns the integrated data of size (pulses, 2), like DPFeedback.getProcessed without
+        #the division by the summation width
+        return dpdata.decode_integrated(self.fetch(2*channel - 1,2*pulses,encoding))
+
+    def fetch_ratio(self,pulses,encoding=None):
+        return dpdata.decode_ratio(self.fetch(4,pulses,encoding))
+
+    def fetch_decoded(self,quantity,method="float"):
+        #Asks the server to decode the data (see dpdata.QUANTITIES). Returns the array and the
+        #time between samples or pulses
+        header,data = self.request({"mode":"fetch decoded","quantity":quantity,"method":method})
+        return np.frombuffer(data,dtype="<f4").reshape(header["shape"]),header["dt"]
+
+    def wait_for_shot(self,timeout=10,start=False,after=None):
+        #Blocks until the server finds the next completed shot and returns the reply header, with
+        #the shot number in 'shot' and the final counters in 'counts' (register values) and
+        #'values' (parameters). With start set the same request triggers the acquisition, and
+        #with 'after' a shot newer than that number is returned even if it has already ended.
+        #Raises a ValueError if no shot completes within timeout seconds
+        header = {"mode":"wait for shot","timeout":timeout,"start":start}
+        if after is not None:
+            header["after"] = after
+        with self.connection() as conn:
+            conn.sock.settimeout(None if self.timeout is None else timeout + self.timeout)
+            try:
+                return conn.request(header)[0]
+            finally:
+                if conn.sock is not None:
+                    conn.sock.settimeout(self.timeout)
+
+    def find_transition(self,method="midpoint",start=0,step=1,**fields):
+        #Asks the server for the frequency of the transition in a ramp scan (see transition.py),
+        #with pulse k at start + k*step. Returns (frequency, uncertainty) for the shot in memory,
+        #or lists of shot numbers, frequencies and uncertainties if history fields such as
+        #'first' or 'maxShots' are given. Other fields are 'edge', 'quantity' and 'channel'
+        header = self.request(dict(fields,mode="find transition",method=method,start=start,step=step))[0]
+        if "shots" in header:
+            return header["shots"],header["frequency"],header["uncertainty"]
+        return header["frequency"],header["uncertainty"]
+
+    def feedback_stats(self,reset=False):
+        #Returns the statistics of the feedback kept by the server (see feedbackstats.py), which
+        #must be started with --feedback-stats. With reset set they start again afterwards
+        return self.request({"mode":"feedback stats","reset":reset})[0]["stats"]
+
+    def save_profile(self,name,values=None,registers=None,base=None):
+        #Stores the current parameters on the server as profile 'name', with the parameters in
+        #values and the raw words in registers (a dict of address -> value) changed. With base
+        #the profile starts from that stored profile instead of the device
+        header = {"mode":"save profile","name":name}
+        if values is not None:
+            header["values"] = values
+        if registers is not None:
+            header["registers"] = [[a,v] for a,v in registers.items()]
+        if base is not None:
+            header["base"] = base
+        self.request(header)
+
+    def activate_profile(self,name):
+        #Loads a stored profile into the device. Only the registers that differ are written, and
+        #their addresses are returned
+        return self.request({"mode":"activate profile","name":name})[0]["changed"]
+
+    def profiles(self,values=True):
+        #Returns a dict of profile name -> parameter values, or a list of names if values is false
+        return self.request({"mode":"list profiles","values":values})[0]["profiles"]
+
+    def delete_profile(self,name):
+        self.request({"mode":"delete profile","name":name})
+
+    def history(self,**fields):
+        #Returns stored shots as a list of (header, {fetchType: array}) from the server's history.
+        #fields are the request fields 'first', 'last', 'since', 'until', 'maxShots' and 'raw'
+        header,data = self.request(dict(fields,mode="history"))
+        return [(shot,split_shot(shot,data[pos:pos + sum(shot["lengths"])])) for shot,pos in shot_offsets(header["shots"])]
+
+    def shots(self,raw=False):
+        #Subscribes on a dedicated connection and returns a generator that yields each completed
+        #shot as (header, {fetchType: array}). The subscription starts before this returns, so
+        #no shot triggered afterwards is missed. Closing the generator closes the connection
+        conn = Connection(self.host,self.port,None)
+        try:
+            conn.request({"mode":"subscribe","raw":raw})
+        except Exception:
+            conn.close()
+            raise
+        return self._shots(conn)
+
+    def _shots(self,conn):
+        try:
+            while True:
+                header,data = conn.receive_message()
+                if header.get("mode") == "shot":
+                    yield header,split_shot(header,data)
+        finally:
+            conn.close()
+
+    def sequence(self,steps,iterations=None):
+        #Runs a sequence on the server (see sequencer.Sequence) and yields the header and data
+        #words of the result of each iteration
+        conn = Connection(self.host,self.port,None)
+        try:
+            header = {"mode":"sequence","steps":steps}
+            if iterations is not None:
+                header["iterations"] = iterations
+            conn.request(header)
+            while True:
+                header,data = conn.receive_message()
+                check_response(header)
+                yield header,words(data)
+                if header.get("done"):
+                    break
+        finally:
+            conn.close()
+
+
+def decode_reply(header,data):
+    #Decodes the data of a reply with an 'encoding' field
+    if "encoding" not in header:
+        return data
+    data = codec.decode(data,header["encoding"],header["elementSize"],header["stride"])
+    if len(data) != header["rawLength"]:
+        raise ValueError("Decoded {} bytes but expected {}".format(len(data),header["rawLength"]))
+    return data
+
+def shot_offsets(shots):
+    pos = 0
+    for shot in shots:
+        yield shot,pos
+        pos += sum(shot["lengths"])
+
+def split_shot(header,data):
+    #Splits the body of a shot message into one array per fetchType
+    buffers = {}
+    pos = 0
+    for k,n in zip(header["fetchTypes"],header["lengths"]):
+        buffers[k] = words(data[pos:pos + n])
+        pos += n
+    return buffers
+
+
+class AsyncClient:
+    #asyncio client using one pipelined connection. Requests can be awaited concurrently, and
+    #replies are matched to requests in order by a single reader task. binary is the same as
+    #for Client
+    def __init__(self,host,port=DEFAULT_PORT,binary=False):
+        self.host = host
+        self.port = port
+        self.binary = binary
+        self._request_id = 0
+        self._reader = None
+        self._writer = None
+        self._waiting = None
+        self._task = None
+        self._connected = None
+
+    async def connect(self):
+        self._reader,self._writer = await asyncio.open_connection(self.host,self.port)
+        self._waiting = asyncio.Queue()
+        self._task = asyncio.ensure_future(self._read_replies())
+        return self
+
+    async def _read_replies(self):
+        #Whatever ends the reader, requests still waiting for a reply fail instead of waiting forever
+        try:
+            while True:
+                n = struct.unpack("<H",await self._reader.readexactly(2))[0]
+                if n == binheader.MAGIC:
+                    header = binary_reply_header(await self._reader.readexactly(binheader.REPLY.size))
+                    data = await self._reader.readexactly(header["length"])
+                    finish_binary_reply(header,data)
+                else:
+                    header = json.loads((await self._reader.readexactly(n)).decode('ascii'))
+                    data = await self._reader.readexactly(header["length"])
+                future = await self._waiting.get()
+                if not future.cancelled():
+                    future.set_result((header,data))
+        except (asyncio.IncompleteReadError,ConnectionError):
+            pass
+        finally:
+            while not self._waiting.empty():
+                future = self._waiting.get_nowait()
+                if not future.done():
+                    future.set_exception(ConnectionError("Server closed the connection"))
+
+    async def request(self,header,data=()):
+        if self._connected is None:
+            #Concurrent first requests share the same connection attempt
+            self._connected = asyncio.ensure_future(self.connect())
+        await self._connected
+        if self._task.done():
+            raise ConnectionError("Server closed the connection")
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.put_nowait(future)
+        msg = None
+        if self.binary:
+            self._request_id = (self._request_id + 1) & 0xFFFFFFFF
+            msg = encode_binary_request(dict(header,keepAlive=True),data,self._request_id)
+        self._writer.write(msg if msg is not None else encode_request(dict(header,keepAlive=True),data))
+        await self._writer.drain()
+        header,data = await future
+        return check_response(header),data
+
+    async def read(self,addr):
+        return int(words((await self.request({"mode":"read"},[addr]))[1])[0])
+
+    async def write(self,addr,value):
+        await self.request({"mode":"write"},[addr,value])
+
+    async def read_batch(self,addrs):
+        return words((await self.request({"mode":"read batch"},addrs))[1])
+
+    async def write_batch(self,addrs,values):
+        data = np.empty(2*len(addrs),dtype="<u4")
+        data[0::2] = addrs
+        data[1::2] = values
+        await self.request({"mode":"write batch"},data)
+
+    async def fetch(self,fetch_type,num_fetch,encoding=None,level=None):
+        header = {"mode":"fetch data","fetchType":fetch_type,"numFetch":num_fetch}
+        if encoding is not None:
+            header["encoding"] = encoding
+        if level is not None:
+            header["level"] = level
+        return words(decode_reply(*(await self.request(header))))
+
+    async def wait_for_shot(self,timeout=10,start=False,after=None):
+        #Replies are in order, so other requests on this client wait behind this one
+        header = {"mode":"wait for shot","timeout":timeout,"start":start}
+        if after is not None:
+            header["after"] = after
+        return (await self.request(header))[0]
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._task.cancel()
+            self._writer = None
+            self._connected = None
+
+
+#######################################################################################################
+#####################################  Parameters  ####################################################
+#######################################################################################################
+
+class Device:
+    #Typed access to the parameters of one device, e.g. dev.period = 5e-6 or dev.get(["sumStart","sumWidth"]).
+    #Parameters are those in registermap.py, and reading or writing any number of them takes a
+    #single request to the server
+    def __init__(self,client):
+        self.client = client
+
+    def get(self,names):
+        #Returns the value of one parameter, or a dict of values for a list of names
+        single = isinstance(names,str)
+        names = [names] if single else list(names)
+        values = self.client.request({"mode":"read parameters","names":names})[0]["values"]
+        return values[names[0]] if single else values
+
+    def set(self,values):
+        #Writes a dict of parameter values. The server reads and writes each register involved once
+        self.client.request({"mode":"write parameters","values":values})
+
+    def snapshot(self):
+        #Returns the values of all parameters that can be written
+        names = [n for k,n in enumerate(registermap.NAMES) if registermap.ADDR[k] in registermap.PARAMETER_REGISTERS]
+        return self.get(names)
+
+    def start(self):
+        #Software start trigger, like DPFeedback.start
+        self.client.write(TRIGGER_ADDR,1)
+
+    def reset(self):
+        self.client.write(TRIGGER_ADDR,0)
+
+def _make_property(name):
+    return property(lambda self: self.get(name),lambda self,v: self.set({name:v}))
+
+for _name in registermap.NAMES:
+    if _name != "pulseTrig":
+        setattr(Device,_name,_make_property(_name))
@@ -0,0 +1,133 @@
+import numpy as np
+
+import hardware
+import acquisition
+import registermap
+
+CLK = registermap.CLK
+
+#
+# Quantities that can be requested with the 'fetch decoded' mode
+#
+QUANTITIES = ("raw signal","raw aux","signal","aux","ratio","sum diff")
+
+
+def get_bits(value,bits):
+    return (value >> bits[0]) & ((1 << (bits[1] - bits[0] + 1)) - 1)
+
+def read_parameters(dev,names):
+    #Reads the registers holding the parameters once each and returns their values
+    return registermap.unpack(names,dict((a,dev.read(a)) for a in registermap.registers_for(names)))
+
+def view_block(dev,fetch_type,num):
+    #Returns the first num words of a block RAM. If the device supports it the result is a
+    #view of the memory map and nothing is copied
+    if hasattr(dev,"view_block"):
+        return dev.view_block(hardware.FETCH_ADDR[fetch_type],num)
+    return dev.read_block(hardware.FETCH_ADDR[fetch_type],num)
+
+
+#######################################################################################################
+#####################################  Decoding  ######################################################
+#######################################################################################################
+
+def split_raw(buf,samples_per_pulse,pulses=None):
+    #Views raw data as an int16 array of size (pulses, samples_per_pulse, 2), where channel 0 is
+    #the low half of each word. Incomplete pulses at the end of the buffer are dropped
+    words = np.frombuffer(buf,dtype="<i2").reshape(-1,2)
+    if samples_per_pulse < 1:
+        return np.zeros((0,0,2),dtype="<i2")
+    max_pulses = words.shape[0] // samples_per_pulse
+    if pulses is None or pulses > max_pulses:
+        pulses = max_pulses
+    return words[:pulses*samples_per_pulse].reshape(pulses,samples_per_pulse,2)
+
+def decode_raw(buf,samples_per_pulse,pulses=None):
+    #Splits raw data into I (low 16 bits) and Q (high 16 bits) and reshapes each into an array
+    #of size (samples_per_pulse, pulses) like DPFeedback.getRaw. Incomplete pulses are dropped.
+    #The results are views of buf
+    words = split_raw(buf,samples_per_pulse,pulses)
+    return words[:,:,0].T,words[:,:,1].T
+
+def decode_integrated(buf,pulses=None):
+    #Returns integrated data as an array of size (pulses, 2) with one column for each
+    #of the two interleaved channels. The result is a view of buf
+    data = np.frombuffer(buf,dtype="<i4")
+    data = data[:2*(len(data) // 2)].reshape(-1,2)
+    if pulses is not None:
+        data = data[:pulses]
+    return data
+
+def decode_ratio(buf,pulses=None):
+    #Returns the ratio computed by the FPGA. Each word holds a signed 16-bit value in its
+    #lower half which is scaled by 2^15
+    data = np.frombuffer(buf,dtype="<i2")[::2]
+    if pulses is not None:
+        data = data[:pulses]
+    return data/2**15
+
+def sum_diff(signal,aux,sum_width=1,method="float"):
+    #Calculates the sum and difference values in the same way as DPFeedback.calcSumDiff.
+    #signal and aux are (pulses, 2) arrays of integrated data divided by sum_width, and aux can
+    #also be a two element sequence when fixed auxiliary values are used. With method 'int'
+    #the data is first converted back to integers as it is on the FPGA
+    if method not in ("int","float"):
+        raise ValueError("Method can only be 'int' or 'float'")
+    signal = np.asarray(signal,dtype=float)
+    aux = np.asarray(aux,dtype=float)
+    if method == "int":
+        signal = np.fix(signal*sum_width)
+        aux = np.fix(aux*sum_width)
+    p0 = signal[...,0]*aux[...,1]
+    p1 = signal[...,1]*aux[...,0]
+    return p0 + p1,p0 - p1
+
+def ratio(signal,aux,sum_width=1,method="float"):
+    #Calculates the ratio from processed data like DPFeedback.calcRatio
+    s,d = sum_diff(signal,aux,sum_width,method)
+    with np.errstate(divide="ignore",invalid="ignore"):
+        return d/s
+
+
+#######################################################################################################
+#####################################  Reading from the device  #######################################
+#######################################################################################################
+
+def read_quantity(dev,quantity,method="float"):
+    #Reads and decodes one of QUANTITIES from the device. Returns the data as a float array and
+    #the time step between consecutive samples (raw data) or pulses (everything else)
+    if quantity not in QUANTITIES:
+        raise ValueError("Unknown quantity {}".format(quantity))
+    counts = acquisition.read_counts(dev)
+    params = read_parameters(dev,["samplesPerPulse","log2Avgs","period","sumWidth","useFixedAux"])
+    period = params["period"]
+
+    if quantity in ("raw signal","raw aux"):
+        fetch_type = 0 if quantity == "raw signal" else 2
+        samples_per_pulse = params["samplesPerPulse"]
+        buf = view_block(dev,fetch_type,min(counts[fetch_type],hardware.MAX_FETCH))
+        data_i,data_q = decode_raw(buf,samples_per_pulse)
+        return np.stack((data_i,data_q)).astype(float),2**params["log2Avgs"]/CLK
+
+    if quantity == "ratio":
+        buf = view_block(dev,4,min(counts[4],hardware.MAX_FETCH))
+        return decode_ratio(buf),period
+
+    sum_width = params["sumWidth"]
+    scale = 1/sum_width if sum_width > 0 else 1
+    if quantity in ("signal","aux"):
+        fetch_type = 1 if quantity == "signal" else 3
+        buf = view_block(dev,fetch_type,min(counts[fetch_type],hardware.MAX_FETCH))
+        return decode_integrated(buf)*scale,period
+
+    signal = decode_integrated(view_block(dev,1,min(counts[1],hardware.MAX_FETCH)))*scale
+    if params["useFixedAux"]:
+        aux = np.array(list(read_parameters(dev,["fixedAux0","fixedAux1"]).values()),dtype=float)
+    else:
+        aux = decode_integrated(view_block(dev,3,min(counts[3],hardware.MAX_FETCH)))*scale
+        n = min(len(signal),len(aux))
+        signal = signal[:n]
+        aux = aux[:n]
+    s,d = sum_diff(signal,aux,sum_width,method)
+    with np.errstate(divide="ignore",invalid="ignore"):
+        return np.stack((s,d,d/s)),period
@@ -0,0 +1,188 @@
+import math
+import threading
+
+import hardware
+import registermap
+
+#
+# Statistics of the number stabilisation (NumberStabilisation.vhd), updated from every shot in
+# constant time and memory so that the feedback can be followed over long runs without fetching
+# the ratio data. Each ratio trace is followed in the same way as on the FPGA: feedback goes on
+# while |ratio| is above both the target and the tolerance, and each step applies
+# maxMWPulses*(|ratio| - target)/|ratio| microwave pulses. For every shot this gives
+#   error:     |ratio| at which the feedback stopped minus the target, which is the quantity
+#              the FPGA compares, so it is at most zero when the target was reached
+#   mwPulses:  the number of microwave pulses applied
+#   pulses:    the number of dispersive pulses until the feedback stopped
+# The mean, standard deviation and extremes of each are kept with Welford's method, along with
+# a histogram, and the overlapping Allan deviation of the final ratio from shot to shot is kept
+# for averaging times of 1, 2, 4, ... shots
+#
+FEEDBACK_NAMES = ["enableFB","maxMWPulses","target","tol"]
+FEEDBACK_REGISTERS = registermap.registers_for(FEEDBACK_NAMES)
+RATIO_TYPE = 4              #fetchType of the ratio memory
+HISTOGRAMS = {              #Quantity -> (low edge, high edge, number of bins)
+    "error":    (-1.0,1.0,200),
+    "mwPulses": (0,1024,64),
+    "pulses":   (0,256,64),
+}
+MAX_TAU = 1024              #Longest averaging time for the Allan deviation, in shots
+
+
+class RunningStats:
+    #Mean and variance by Welford's method
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self,x):
+        self.count += 1
+        d = x - self.mean
+        self.mean += d/self.count
+        self.m2 += d*(x - self.mean)
+        self.min = x if self.min is None else min(self.min,x)
+        self.max = x if self.max is None else max(self.max,x)
+
+    def std(self):
+        return math.sqrt(self.m2/(self.count - 1)) if self.count > 1 else None
+
+    def summary(self):
+        return {"count":self.count,"mean":self.mean if self.count > 0 else None,"std":self.std(),"min":self.min,"max":self.max}
+
+
+class Histogram:
+    #Equal bins between low and high, with values outside counted separately
+    def __init__(self,low,high,bins):
+        if not high > low or bins < 1:
+            raise ValueError("A histogram needs high > low and at least one bin")
+        self.low = low
+        self.high = high
+        self.counts = [0]*bins
+        self.underflow = 0
+        self.overflow = 0
+
+    def add(self,x):
+        if x < self.low:
+            self.underflow += 1
+        elif x >= self.high:
+            self.overflow += 1
+        else:
+            self.counts[int((x - self.low)/(self.high - self.low)*len(self.counts))] += 1
+
+    def summary(self):
+        return {"low":self.low,"high":self.high,"counts":list(self.counts),"underflow":self.underflow,"overflow":self.overflow}
+
+
+class AllanDeviation:
+    #Overlapping Allan deviation at averaging times of m = 1, 2, 4, ... up to max_tau samples.
+    #The phase (the running sum of the samples) is kept in a ring buffer of the last 2*max_tau + 1
+    #values, and each new value adds one second difference to the sum for every m. The first
+    #sample is subtracted from all of them, which leaves the deviation unchanged but keeps the
+    #phase small
+    def __init__(self,max_tau=MAX_TAU):
+        self.taus = [2**k for k in range(int(math.log2(max_tau)) + 1)]
+        self._size = 2*self.taus[-1] + 1
+        self._phase = [0.0]*self._size
+        self._sums = [0.0]*len(self.taus)
+        self._terms = [0]*len(self.taus)
+        self._n = 1                 #Number of phase values, starting from x0 = 0
+        self._offset = None
+
+    def add(self,y):
+        if self._offset is None:
+            self._offset = y
+        x = self._phase[(self._n - 1) % self._size] + y - self._offset
+        self._phase[self._n % self._size] = x
+        self._n += 1
+        for k,m in enumerate(self.taus):
+            if self._n < 2*m + 1:
+                break
+            d = x - 2*self._phase[(self._n - 1 - m) % self._size] + self._phase[(self._n - 1 - 2*m) % self._size]
+            self._sums[k] += d*d
+            self._terms[k] += 1
+
+    def deviation(self):
+        #Returns the averaging times that have at least one term and their deviations
+        taus = [m for k,m in enumerate(self.taus) if self._terms[k] > 0]
+        return taus,[math.sqrt(self._sums[k]/(2*m*m*self._terms[k])) for k,m in enumerate(taus)]
+
+    def summary(self):
+        taus,adev = self.deviation()
+        return {"tau":taus,"adev":adev,"terms":self._terms[:len(taus)]}
+
+
+def ratio_abs(word):
+    #|2*ratio| as the 16-bit unsigned value the FPGA compares with the target and tolerance
+    r = (word << 1) & 0xFFFF
+    return abs(r - 0x10000 if r & 0x8000 else r) & 0xFFFF
+
+def follow(words,target,tol,max_pulses):
+    #Follows the feedback through a ratio trace given as memory words and register values.
+    #Returns the index of the pulse at which it stopped, or None if it never did, and the number
+    #of microwave pulses applied before that
+    mw = 0
+    for k,w in enumerate(words):
+        a = ratio_abs(w)
+        if a <= tol or a <= target:
+            return k,mw
+        mw += min((((a - target) << 16)//a*max_pulses) >> 16,0xFFFF)
+    return None,mw
+
+
+class FeedbackStats:
+    #Collects the statistics from every shot passed to add(), which is used as a ShotWatcher
+    #listener. Shots taken with the feedback off or without ratio data are only counted.
+    #The feedback settings are read when the shot is found, so they should not be changed
+    #while a shot is running. Updates and snapshots are made under a lock
+    def __init__(self,device=None,max_tau=MAX_TAU,histograms=None):
+        self.device = device
+        self.max_tau = max_tau
+        self.ranges = dict(HISTOGRAMS)
+        self.ranges.update(histograms or {})
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.shots = 0
+            self.skipped = 0        #Shots with the feedback off or no ratio data
+            self.converged = 0      #Shots in which the ratio reached the target or tolerance
+            self.last = None
+            self.stats = dict((q,RunningStats()) for q in HISTOGRAMS)
+            self.histograms = dict((q,Histogram(*self.ranges[q])) for q in HISTOGRAMS)
+            self.allan = AllanDeviation(self.max_tau)
+
+    def add(self,shot):
+        dev = self.device if self.device is not None else hardware.get_device()
+        regs = dict((a,dev.read(a)) for a in FEEDBACK_REGISTERS)
+        settings = dict((n,registermap.get_field(n,regs[registermap.ADDR[registermap.index(n)]])) for n in FEEDBACK_NAMES)
+        target = registermap.unpack(["target"],regs)["target"]
+        words = shot.buffers[RATIO_TYPE]
+        with self._lock:
+            self.shots += 1
+            if not settings["enableFB"] or not words:
+                self.skipped += 1
+                return
+            stop,mw = follow(words,settings["target"],settings["tol"],settings["maxMWPulses"])
+            if stop is not None:
+                self.converged += 1
+            last = words[stop if stop is not None else len(words) - 1] & 0xFFFF
+            ratio = (last - 0x10000 if last & 0x8000 else last)/2**15
+            values = {"error":ratio_abs(last)/2**16 - target,"mwPulses":mw,
+                      "pulses":stop + 1 if stop is not None else len(words)}
+            for q,x in values.items():
+                self.stats[q].add(x)
+                self.histograms[q].add(x)
+            self.allan.add(ratio)
+            self.last = dict(values,shot=shot.index,ratio=ratio,converged=stop is not None)
+
+    def snapshot(self):
+        #Returns all values as a dict that can be sent as JSON
+        with self._lock:
+            out = {"shots":self.shots,"skipped":self.skipped,"converged":self.converged,"last":self.last,"allan":self.allan.summary()}
+            for q in HISTOGRAMS:
+                out[q] = dict(self.stats[q].summary(),histogram=self.histograms[q].summary())
+            return out
@@ -0,0 +1,199 @@
+import time
+import queue
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import dpclient
+
+
+def parse_address(address,port=dpclient.DEFAULT_PORT):
+    #Splits 'host' or 'host:port' into (host, port)
+    if isinstance(address,tuple):
+        return address
+    host,sep,p = address.rpartition(":")
+    if not sep:
+        return address,port
+    return host,int(p)
+
+
+class Result(dict):
+    #Result of a call on every device: maps each device name to the value returned, with the
+    #time taken by each device in 'latency' and the exceptions raised in 'errors'
+    def __init__(self):
+        dict.__init__(self)
+        self.latency = {}
+        self.errors = {}
+
+    def check(self):
+        #Raises a ValueError naming the devices that failed
+        if self.errors:
+            raise ValueError("; ".join("{}: {}".format(name,e) for name,e in self.errors.items()))
+        return self
+
+    def stack(self,names=None):
+        #Stacks array results into one array with the devices along the first axis
+        names = list(self) if names is None else names
+        return np.stack([self[n] for n in names])
+
+
+class Fleet:
+    #Controls several devices at once. Each device has its own pooled dpclient.Client, and calls
+    #are made on all devices concurrently so that the time taken is that of the slowest device
+    #rather than the sum over devices. Devices are given as a list of 'host' or 'host:port'
+    #strings, which are also used as their names, or as a dict of name -> address
+    def __init__(self,devices,port=dpclient.DEFAULT_PORT,pool_size=2,timeout=10):
+        if not isinstance(devices,dict):
+            devices = dict((d if isinstance(d,str) else "{}:{}".format(*d),d) for d in devices)
+        if len(devices) == 0:
+            raise ValueError("A fleet needs at least one device")
+        self.clients = {}
+        self.devices = {}
+        for name,address in devices.items():
+            host,p = parse_address(address,port)
+            self.clients[name] = dpclient.Client(host,p,pool_size,timeout)
+            self.devices[name] = dpclient.Device(self.clients[name])
+        self.names = list(devices)
+        self._executor = ThreadPoolExecutor(max_workers=len(self.names)*pool_size)
+
+    def call(self,fn,names=None,check=True):
+        #Runs fn(name) for each device in parallel and returns a Result
+        names = self.names if names is None else names
+        def timed(name):
+            t = time.perf_counter()
+            try:
+                return fn(name),None,time.perf_counter() - t
+            except (OSError,ValueError) as e:
+                return None,e,time.perf_counter() - t
+        result = Result()
+        for name,(value,err,latency) in zip(names,self._executor.map(timed,names)):
+            result.latency[name] = latency
+            if err is None:
+                result[name] = value
+            else:
+                result.errors[name] = err
+        return result.check() if check else result
+
+    def broadcast(self,method,*args,**kwargs):
+        #Calls the same dpclient.Client method with the same arguments on every device
+        return self.call(lambda name: getattr(self.clients[name],method)(*args,**kwargs))
+
+    ## Parameters
+    def get(self,names):
+        return self.call(lambda name: self.devices[name].get(names))
+
+    def set(self,values):
+        #Uploads parameters to every device. values is either a dict of parameter values used
+        #for all devices, or a dict of device name -> dict of parameter values
+        if all(n in self.devices for n in values):
+            return self.call(lambda name: self.devices[name].set(values[name]),list(values))
+        return self.call(lambda name: self.devices[name].set(values))
+
+    def start(self):
+        #Sends the start trigger to all devices at the same time
+        return self.call(lambda name: self.devices[name].start())
+
+    def reset(self):
+        return self.call(lambda name: self.devices[name].reset())
+
+    def wait_for_shot(self,timeout=10,start=False):
+        #Waits for the next shot on every device, see dpclient.Client.wait_for_shot. With start
+        #set each device is triggered by its own request, so the boards start within the spread
+        #of the request latencies
+        return self.broadcast("wait_for_shot",timeout,start)
+
+    def feedback_stats(self,reset=False):
+        return self.broadcast("feedback_stats",reset)
+
+    def activate_profile(self,name):
+        #Loads the profile with this name on every device, see dpclient.Client.activate_profile
+        return self.broadcast("activate_profile",name)
+
+    ## Data
+    def fetch(self,fetch_type,num_fetch):
+        return self.broadcast("fetch",fetch_type,num_fetch)
+
+    def fetch_integrated(self,channel,pulses):
+        return self.broadcast("fetch_integrated",channel,pulses)
+
+    def fetch_ratio(self,pulses):
+        return self.broadcast("fetch_ratio",pulses)
+
+    def fetch_decoded(self,quantity,method="float"):
+        #Returns a Result of (array, dt) for each device
+        return self.broadcast("fetch_decoded",quantity,method)
+
+    def shots(self,raw=False,timeout=None):
+        #Subscribes to all devices and returns a generator of aligned shots: the n-th shot of
+        #every device after subscribing is yielded together as a Result of device name ->
+        #(header, {fetchType: array}). 'latency' holds the time between the first device's shot
+        #arriving and each device's shot arriving. If timeout is given, a ValueError is raised
+        #when a device does not deliver its shot within timeout seconds of the first one
+        conns = {}
+        try:
+            for name in self.names:
+                client = self.clients[name]
+                conns[name] = dpclient.Connection(client.host,client.port,None)
+                conns[name].request({"mode":"subscribe","raw":raw})
+        except Exception:
+            for conn in conns.values():
+                conn.close()
+            raise
+        return self._shots(conns,timeout)
+
+    def _shots(self,conns,timeout):
+        arrived = queue.Queue()
+        def reader(name,conn):
+            try:
+                while True:
+                    header,data = conn.receive_message()
+                    if header.get("mode") == "shot":
+                        arrived.put((name,(header,dpclient.split_shot(header,data)),time.perf_counter(),None))
+            except (OSError,ValueError) as e:
+                arrived.put((name,None,time.perf_counter(),e))
+        for item in conns.items():
+            threading.Thread(target=reader,args=item,daemon=True).start()
+        pending = dict((name,[]) for name in self.names)
+        try:
+            while True:
+                first = None
+                while any(len(p) == 0 for p in pending.values()):
+                    wait = None
+                    if timeout is not None and first is not None:
+                        wait = max(0,first + timeout - time.perf_counter())
+                    try:
+                        name,shot,t,err = arrived.get(timeout=wait)
+                    except queue.Empty:
+                        missing = [n for n,p in pending.items() if len(p) == 0]
+                        raise ValueError("No shot from {} within {} s".format(", ".join(missing),timeout))
+                    if err is not None:
+                        raise ValueError("{}: {}".format(name,err))
+                    pending[name].append((shot,t))
+                    first = min(p[0][1] for p in pending.values() if p)
+                result = Result()
+                for name in self.names:
+                    shot,t = pending[name].pop(0)
+                    result[name] = shot
+                    result.latency[name] = t - first
+                yield result
+        finally:
+            for conn in conns.values():
+                #Shutting down the sockets stops the readers
+                try:
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                conn.close()
+
+    def close(self):
+        self._executor.shutdown()
+        for client in self.clients.values():
+            client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
@@ -0,0 +1,189 @@
+import numpy as np
+
+import dpdata
+
+#
+# Bit-exact model of the signal chain in the FPGA: QuickAvg -> IntegrateADCData -> ComputeSignal
+# (fpga/vhdl-common and fpga/rp-feedback-sources/vhdl). Data for many pulses and shots is
+# processed at once. The layouts follow the block RAMs so that fetched buffers can be used
+# without copying:
+#   raw data:        int16 array (..., pulses, samples, 2), channel 0 is the low half of each word
+#   integrated data: int32 array (..., pulses, 2)
+#   ratio:           int16 array (..., pulses), the fraction scaled by 2^15
+#
+ADC_WIDTH = 16              #Width of the samples from QuickAvg
+INTEG_ADC_WIDTH = 14        #IntegrateADCData only uses bits 13 downto 0 of each sample
+INTEG_WIDTH = 24            #Width of the integrated values
+WINDOW_WIDTH = 11           #Width of the sample counter and window limits in IntegrateADCData
+AVG_COUNT_WIDTH = 8         #Width of the averaging counter in QuickAvg
+SIGNAL_FRAC_WIDTH = 16      #Width of the ratio output by ComputeSignal
+PROD_WIDTH = 2*INTEG_WIDTH  #Width of the products, sum and difference in ComputeSignal
+
+
+class ChainParameters:
+    #Parameters of the signal chain, named in the same way as the fields of
+    #RedPitaya.Configuration and DPFeedback.m and given as integer register values
+    def __init__(self,log2Avgs=0,samplesPerPulse=0,sumStart=0,subStart=0,width=0,offsets=(0,0),
+                 usePresetOffsets=False,useFixedAux=False,fixedAux=(1,1)):
+        self.log2Avgs = log2Avgs
+        self.samplesPerPulse = samplesPerPulse
+        self.sumStart = sumStart
+        self.subStart = subStart
+        self.width = width
+        self.offsets = offsets
+        self.usePresetOffsets = usePresetOffsets
+        self.useFixedAux = useFixedAux
+        self.fixedAux = fixedAux
+
+    @classmethod
+    def from_configuration(cls,cfg):
+        #Copies the parameters from a RedPitaya.Configuration. Fields that the configuration
+        #does not have keep their default values
+        params = cls()
+        for name in vars(params):
+            if hasattr(type(cfg),name) or hasattr(cfg,name):
+                setattr(params,name,getattr(cfg,name))
+        return params
+
+
+def wrap_signed(x,bits):
+    #Keeps the lowest 'bits' bits of x as a two's complement number, like resize() on an
+    #unsigned vector or an overflowing adder
+    x = np.asarray(x,dtype=np.int64)
+    return ((x + (1 << (bits - 1))) & ((1 << bits) - 1)) - (1 << (bits - 1))
+
+def resize_signed(x,bits):
+    #numeric_std resize() of a signed value to fewer bits: the sign bit is kept and the
+    #upper bits are dropped
+    x = np.asarray(x,dtype=np.int64)
+    low = x & ((1 << (bits - 1)) - 1)
+    return np.where(x < 0,low - (1 << (bits - 1)),low)
+
+#The block RAM layouts are decoded by dpdata, so the model and the decoding of fetched data
+#cannot disagree
+split_raw = dpdata.split_raw
+split_integrated = dpdata.decode_integrated
+
+
+#######################################################################################################
+#####################################  QuickAvg  ######################################################
+#######################################################################################################
+
+def num_avgs(log2_avgs):
+    #Number of samples averaged for each output sample. The 8 bit counter in QuickAvg wraps
+    #for log2Avgs >= 8, and 256 samples are then summed before shifting by log2Avgs
+    n = (1 << log2_avgs) & ((1 << AVG_COUNT_WIDTH) - 1)
+    return n if n > 0 else (1 << AVG_COUNT_WIDTH)
+
+def quick_avg(adc,log2_avgs,samples_per_pulse):
+    #Averages ADC data following a (delayed) trigger. adc is an array of size
+    #(..., n, 2) of int16 samples starting at the first sample after the trigger, and the
+    #result is an int16 array of size (..., samples_per_pulse, 2)
+    adc = np.asarray(adc)
+    if log2_avgs == 0:
+        return adc[...,:samples_per_pulse,:].astype(np.int16)
+    n = num_avgs(log2_avgs)
+    if adc.shape[-2] < n*samples_per_pulse:
+        raise ValueError("{} ADC samples are needed for each pulse, but only {} were given".format(n*samples_per_pulse,adc.shape[-2]))
+    x = adc[...,:n*samples_per_pulse,:].astype(np.int64)
+    x = x.reshape(x.shape[:-2] + (samples_per_pulse,n,2)).sum(axis=-2)
+    x = wrap_signed(x,ADC_WIDTH + 8) >> log2_avgs
+    return resize_signed(x,ADC_WIDTH).astype(np.int16)
+
+
+#######################################################################################################
+#####################################  IntegrateADCData  ##############################################
+#######################################################################################################
+
+def integration_weights(samples_per_pulse,sum_start,sub_start,width,use_preset_offsets=False):
+    #Returns the weight (+1, -1 or 0) of each sample in a pulse. Both windows include their
+    #end point, the summation window takes priority where they overlap, and no samples are
+    #used after the end of the last window
+    mask = (1 << WINDOW_WIDTH) - 1
+    sum_end = (sum_start + width) & mask
+    sub_end = (sub_start + width) & mask
+    last = sum_end if use_preset_offsets else sub_end
+    if last >= samples_per_pulse:
+        raise ValueError("Integration windows end after sample {:d}, but there are only {:d} samples per pulse".format(last,samples_per_pulse))
+    count = np.arange(last + 1)
+    in_sum = (count >= sum_start) & (count <= sum_end)
+    in_sub = (count >= sub_start) & (count <= sub_end) & ~in_sum
+    weights = np.zeros(samples_per_pulse,dtype=np.int64)
+    weights[:last + 1] = in_sum.astype(np.int64)
+    if not use_preset_offsets:
+        weights[:last + 1] -= in_sub.astype(np.int64)
+    return weights
+
+def integrate(raw,sum_start,sub_start,width,offsets=(0,0),use_preset_offsets=False):
+    #Integrates raw data of size (..., pulses, samples, 2) and returns int32 values of size
+    #(..., pulses, 2) equal to those stored in the integrated data memory
+    raw = np.asarray(raw)
+    weights = integration_weights(raw.shape[-2],sum_start,sub_start,width,use_preset_offsets)
+    x = wrap_signed(raw,INTEG_ADC_WIDTH)
+    result = np.einsum("...sc,s->...c",x,weights)
+    if use_preset_offsets:
+        result -= np.count_nonzero(weights)*wrap_signed(np.asarray(offsets),INTEG_ADC_WIDTH)
+    return wrap_signed(result,INTEG_WIDTH).astype(np.int32)
+
+
+#######################################################################################################
+#####################################  ComputeSignal  #################################################
+#######################################################################################################
+
+def compute_sum_diff(signal,aux=None,fixed_aux=None):
+    #Returns the 48 bit sum and difference S0*A1 + S1*A0 and S0*A1 - S1*A0. aux is integrated
+    #data of the same size as signal; if fixed_aux is given, the lowest 24 bits of each of the
+    #two fixed values are used instead
+    signal = np.asarray(signal,dtype=np.int64)
+    if fixed_aux is not None:
+        aux = wrap_signed(np.asarray(fixed_aux),INTEG_WIDTH)
+    else:
+        aux = np.asarray(aux,dtype=np.int64)
+    p0 = signal[...,0]*aux[...,1]
+    p1 = signal[...,1]*aux[...,0]
+    return wrap_signed(p0 + p1,PROD_WIDTH),wrap_signed(p0 - p1,PROD_WIDTH)
+
+def compute_ratio(signal,aux=None,fixed_aux=None):
+    #Returns the fractional part of diff/sum as computed by the divider, as int16 values scaled
+    #by 2^15. The divider truncates towards zero and gives a fraction with the sign of the
+    #quotient. The output of the divider is undefined when the sum is zero, and 0 is returned
+    s,d = compute_sum_diff(signal,aux,fixed_aux)
+    safe = np.where(s == 0,1,s)
+    q = np.abs(d) // np.abs(safe)
+    r = np.abs(d) - q*np.abs(safe)
+    frac = (r << (SIGNAL_FRAC_WIDTH - 1)) // np.abs(safe)
+    frac = np.where((d < 0) != (safe < 0),-frac,frac)
+    return np.where(s == 0,0,wrap_signed(frac,SIGNAL_FRAC_WIDTH)).astype(np.int16)
+
+
+#######################################################################################################
+#####################################  Full chain  ####################################################
+#######################################################################################################
+
+def process_raw(raw_signal,params,raw_aux=None):
+    #Runs the integration and ratio stages on averaged raw data, as fetched with fetchType 0
+    #and 2. Returns the integrated signal, integrated auxiliary (None with fixed auxiliary
+    #values) and the ratio
+    signal = integrate(raw_signal,params.sumStart,params.subStart,params.width,params.offsets,params.usePresetOffsets)
+    if params.useFixedAux:
+        return signal,None,compute_ratio(signal,fixed_aux=params.fixedAux)
+    if raw_aux is None:
+        raise ValueError("Auxiliary data is needed unless fixed auxiliary values are used")
+    aux = integrate(raw_aux,params.sumStart,params.subStart,params.width,params.offsets,params.usePresetOffsets)
+    return signal,aux,compute_ratio(signal,aux)
+
+def process_adc(adc_signal,params,adc_aux=None):
+    #Runs the whole chain on ADC data following each delayed trigger, of size (..., pulses, n, 2).
+    #Returns the raw data that would be stored along with the outputs of process_raw
+    raw_signal = quick_avg(adc_signal,params.log2Avgs,params.samplesPerPulse)
+    raw_aux = None if adc_aux is None else quick_avg(adc_aux,params.log2Avgs,params.samplesPerPulse)
+    return (raw_signal,raw_aux) + process_raw(raw_signal,params,raw_aux)
+
+def to_words(data):
+    #Packs raw or integrated data into the 32 bit words stored in the block RAMs
+    data = np.ascontiguousarray(data)
+    return data.astype(data.dtype.newbyteorder("<")).view("<u4").ravel()
+
+def ratio_to_words(ratio):
+    #Packs ratio values into 32 bit words, zero-padded as in SaveADCData
+    return np.asarray(ratio,dtype=np.int16).astype("<u2").astype("<u4").ravel()
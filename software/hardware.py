@@ -0,0 +1,161 @@
+import os
+import mmap
+import array
+import subprocess
+
+MEM_ADDR = 0x40000000       #Start of the AXI window used by the FPGA
+REGION_SIZE = 0x01000000    #Address space decoded by each value of addr(31 downto 24) in topmod.vhd
+MAP_SIZE = 262144           #Size of the window mapped for each region, same as the C programs
+
+#
+# Memory locations of the block RAMs indexed by fetchType
+# 0: raw signal, 1: integrated signal, 2: raw auxiliary, 3: integrated auxiliary, 4: ratio
+#
+FETCH_ADDR = [0x02000000,0x03000000,0x04000000,0x05000000,0x06000000]
+MAX_FETCH = 16384           #Maximum number of words that can be fetched from a block RAM
+REGIONS = len(FETCH_ADDR) + 2   #Parameters, read-only registers and the block RAMs
+
+
+class MemoryDevice:
+    #Register access through a memory-mapped file. With the default arguments this maps
+    #/dev/mem at 0x40000000, but any regular file that is large enough can stand in for
+    #the hardware (see create_image). Addresses are relative to MEM_ADDR, like the
+    #addresses sent by clients. The window at the start of each 16 MB region is mapped when
+    #the device is opened, so that a file that cannot be mapped raises an OSError straight away
+    def __init__(self,filename="/dev/mem",base=MEM_ADDR,size=MAP_SIZE,regions=REGIONS):
+        self.filename = filename
+        self.base = base
+        self.size = size
+        self._maps = {}
+        self._words = {}
+        flags = os.O_RDWR
+        if hasattr(os,"O_SYNC"):
+            flags |= os.O_SYNC
+        self._fd = os.open(filename,flags)
+        try:
+            for region in range(regions):
+                m = mmap.mmap(self._fd,size,mmap.MAP_SHARED,mmap.PROT_READ | mmap.PROT_WRITE,offset=base + region*REGION_SIZE)
+                self._maps[region] = m
+                self._words[region] = memoryview(m).cast("I")
+        except (OSError,ValueError) as e:
+            self.close()
+            if isinstance(e,ValueError):
+                #mmap raises a ValueError for a file that is too short
+                raise OSError("Cannot map {}: {}".format(filename,e))
+            raise
+
+    def _region(self,addr):
+        #Returns the 32-bit word view of the region containing addr and the word index within it
+        if addr < 0 or addr % 4 != 0:
+            raise ValueError("Address {:#010x} is not a valid 4-byte aligned address".format(addr))
+        region = addr // REGION_SIZE
+        offset = addr % REGION_SIZE
+        if offset >= self.size:
+            raise ValueError("Address {:#010x} is outside of the mapped window".format(addr))
+        words = self._words.get(region)
+        if words is None:
+            raise ValueError("Address {:#010x} is outside of the mapped regions".format(addr))
+        return words,offset >> 2
+
+    def read(self,addr):
+        words,idx = self._region(addr)
+        return words[idx]
+
+    def write(self,addr,value):
+        words,idx = self._region(addr)
+        words[idx] = value & 0xFFFFFFFF
+
+    def read_block(self,addr,num):
+        #Reads num consecutive 32-bit words starting at addr into an array('I')
+        words,idx = self._region(addr)
+        if num < 0 or idx + num > len(words):
+            raise ValueError("Cannot read {} words from address {:#010x}".format(num,addr))
+        data = array.array("I")
+        data.frombytes(words[idx:idx + num].cast("B"))
+        return data
+
+    def view_block(self,addr,num):
+        #Returns num consecutive 32-bit words starting at addr as a byte memoryview of the
+        #memory map, without copying. The view is only valid until the device is closed
+        words,idx = self._region(addr)
+        if num < 0 or idx + num > len(words):
+            raise ValueError("Cannot read {} words from address {:#010x}".format(num,addr))
+        return words[idx:idx + num].cast("B")
+
+    def close(self):
+        for words in self._words.values():
+            words.release()
+        for m in self._maps.values():
+            m.close()
+        self._words = {}
+        self._maps = {}
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class MonitorDevice:
+    #Register access using the 'monitor' and 'fetchData' programs. This is how the
+    #server used to talk to the FPGA, and is kept as a fallback for when /dev/mem cannot be mapped
+    def read(self,addr):
+        result = subprocess.run(['monitor','0x' + '{:0>8x}'.format(MEM_ADDR + addr)],stdout=subprocess.PIPE)
+        if result.returncode != 0:
+            raise ValueError("Monitor code returned error!")
+        return int(result.stdout.decode('ascii').rstrip(),16)
+
+    def write(self,addr,value):
+        result = subprocess.run(['monitor','0x' + '{:0>8x}'.format(MEM_ADDR + addr),'0x' + '{:0>8x}'.format(value)],stdout=subprocess.PIPE)
+        if result.returncode != 0:
+            raise ValueError("Monitor code returned error!")
+
+    def read_block(self,addr,num):
+        if addr in FETCH_ADDR:
+            result = subprocess.run(['./fetchData',format(num),format(FETCH_ADDR.index(addr))],stdout=subprocess.PIPE)
+            if result.returncode != 0:
+                raise ValueError("fetchData returned error!")
+            return array.array("I",[int(d,16) for d in result.stdout.decode('ascii').split()])
+        else:
+            return array.array("I",[self.read(addr + 4*n) for n in range(num)])
+
+    def close(self):
+        pass
+
+
+def create_image(filename,regions=REGIONS,size=MAP_SIZE):
+    #Creates a zero-filled file that a MemoryDevice with base=0 can use in place of /dev/mem
+    with open(filename,"wb") as f:
+        f.truncate((regions - 1)*REGION_SIZE + size)
+
+
+_device = None
+
+def open_device(filename="/dev/mem",base=MEM_ADDR):
+    #Opens the device used by the server and RedPitaya.py. Falls back to the monitor
+    #program if /dev/mem cannot be mapped
+    global _device
+    close_device()
+    try:
+        _device = MemoryDevice(filename,base)
+    except OSError as e:
+        if filename != "/dev/mem":
+            raise
+        print("Unable to map {} ({}), using monitor instead".format(filename,e))
+        _device = MonitorDevice()
+    return _device
+
+def set_device(device):
+    #Replaces the current device, e.g. with a file-backed MemoryDevice
+    global _device
+    _device = device
+
+def get_device():
+    #Returns the current device, opening /dev/mem if no device has been opened yet
+    if _device is None:
+        open_device()
+    return _device
+
+def close_device():
+    global _device
+    if _device is not None:
+        _device.close()
+        _device = None
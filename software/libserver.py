@@ -1,10 +1,75 @@
 import sys
+import time
+import logging
 import selectors
 import json
 import io
 import struct
+import array
+import itertools
+from collections import deque
 
 import appcontroller
+import binheader
+import acquisition
+import sequencer
+import metrics
+
+RECV_CHUNK = 4096           #Minimum free space in the receive buffer before each recv
+RECV_BUFFER_SIZE = 65536    #Initial size of the receive buffer
+MAX_PENDING_PUSH = 8*2**20  #Shots are dropped for subscribers with more than this many bytes waiting to be sent
+MAX_PENDING_MESSAGES = 64   #...or with more than this many messages waiting
+IOV_MAX = 1024              #Most buffers that can be passed to one sendmsg() call on Linux
+
+log = logging.getLogger(__name__)
+
+
+def frame_response(response):
+    #Converts a response from appcontroller into a list of buffers to send: the proto-header
+    #and JSON header, followed by the data. The 'data' entry is replaced by the field 'length'.
+    #Data given as bytes, such as encoded data, is sent as it is
+    data = response.pop("data")
+    if isinstance(data,bytes):
+        response["length"] = len(data)
+        tmp = json.dumps(response).encode('ascii')
+        return [memoryview(binheader.json_frame(tmp)),memoryview(data)]
+    if not isinstance(data,array.array):
+        data = array.array("I",data)
+    if sys.byteorder != "little":
+        data.byteswap()
+    response["length"] = 4*len(data)
+    tmp = json.dumps(response).encode('ascii')
+    return [memoryview(binheader.json_frame(tmp)),memoryview(data).cast("B")]
+
+def frame_binary_response(response,opcode,request_id):
+    #Same as frame_response() for a request with a binary header. The reply has a binary header
+    #too, and the data of an error reply is its message
+    if response["err"]:
+        data = response["errMsg"].encode('ascii')
+        return [memoryview(binheader.pack_reply(opcode,len(data),binheader.FLAG_ERROR,request_id) + data)]
+    data = response["data"]
+    if not isinstance(data,array.array):
+        data = array.array("I",data)
+    if sys.byteorder != "little":
+        data.byteswap()
+    return [memoryview(binheader.pack_reply(opcode,4*len(data),0,request_id)),memoryview(data).cast("B")]
+
+def frame_shot(shot,raw=False):
+    #Converts a shot into a list of buffers to send as one message with mode 'shot'. The body
+    #is the concatenation of the buffers listed in the header field 'fetchTypes'
+    types = [k for k in shot.fetch_types() if raw or k not in acquisition.RAW_TYPES]
+    header = {"err":False,"errMsg":"","mode":"shot"}
+    header.update(shot.header(types))
+    header["length"] = sum(header["lengths"])
+    tmp = json.dumps(header).encode('ascii')
+    buffers = [memoryview(binheader.json_frame(tmp))]
+    for k in types:
+        data = shot.buffers[k]
+        if sys.byteorder != "little":
+            data = array.array("I",data)
+            data.byteswap()
+        buffers.append(memoryview(data).cast("B"))
+    return buffers
 
 
 class Message:
@@ -12,16 +77,33 @@ class Message:
         self.selector = selector
         self.sock = sock
         self.addr = addr
-        self._recv_buffer = b""
-        self._send_buffer = b""
+        self._recv_buffer = bytearray(RECV_BUFFER_SIZE)
+        self._recv_start = 0        #Index of the first unprocessed byte in the receive buffer
+        self._recv_end = 0          #Index one past the last received byte
+        self._send_buffer = deque() #Memoryviews still to be sent
+        self._message_buffers = deque() #Number of buffers left in the send buffer for each queued message
+        self._pending_bytes = 0
         self.read_serial = None
         self.header_len = None
         self.header = None
+        self.binary = None          #(opcode, fetchType, numFetch, request id) of a request with a binary header
         self.msg_len = None
         self.msg = None
         self.fpga_response = None
         self.response = None
         self.response_created = False
+        self.keep_alive = False
+        self.subscribed = False
+        self.subscribe_raw = False
+        self.sequence = None
+        self.sequence_keep_alive = False
+        self.sequence_pending = False
+        self.waiting = False        #Set while the reply waits for a shot
+        self.close_when_sent = False
+        self.metrics = metrics.get_metrics()
+        self.metrics.opened()
+        self._parse_time = 0        #Time spent decoding the current request
+        self._queued_time = None    #When the reply to the current request was queued
 
     def _set_selector_events_mask(self,mode):
         #Sets the selector's event mask to r, w, or rw/wr
@@ -37,20 +119,52 @@ class Message:
         self.selector.modify(self.sock,events,data=self)
 
     def _read(self):
-        #Internal read function, reads up to 4096 bytes from socket
+        #Internal read function, receives directly into the free space at the end of the recv buffer
+        self._reserve(RECV_CHUNK)
         try:
             #Socket should be ready to read
-            data = self.sock.recv(4096)
+            with memoryview(self._recv_buffer) as view:
+                nbytes = self.sock.recv_into(view[self._recv_end:])
         except BlockingIOError:
             #Resource temporarily unavailable
-            pass
+            return
+        except ConnectionResetError:
+            #A client that closes with messages still unread resets the connection instead
+            nbytes = 0
+        if nbytes:
+            self._recv_end += nbytes
+            self.metrics.received(nbytes)
+        elif self._recv_available() > 0 or (self.header_len is not None and self.msg is None):
+            raise RuntimeError("Peer closed in the middle of a request.")
         else:
-            if data:
-                #If valid data is received, add it to recv buffer
-                self._recv_buffer += data
-            else:
-                #If false, then the client has disconnected
-                raise RuntimeError("Peer closed.")
+            #The client has disconnected between requests, which is how kept-alive connections end
+            log.debug("Connection (%s, %s) closed by the client",*self.addr)
+            self.close()
+
+    def _reserve(self,nbytes):
+        #Makes sure that there are at least nbytes free at the end of the recv buffer. Unprocessed
+        #data is only moved when the end of the buffer is reached, and the buffer only grows
+        #when a single message does not fit
+        if len(self._recv_buffer) - self._recv_end >= nbytes:
+            return
+        pending = self._recv_end - self._recv_start
+        if self._recv_start > 0:
+            self._recv_buffer[:pending] = self._recv_buffer[self._recv_start:self._recv_end]
+            self._recv_start = 0
+            self._recv_end = pending
+        if len(self._recv_buffer) - pending < nbytes:
+            self._recv_buffer.extend(bytes(max(len(self._recv_buffer),nbytes)))
+
+    def _recv_available(self):
+        #Number of received bytes that have not been processed yet
+        return self._recv_end - self._recv_start
+
+    def _consume_recv_buffer(self,nbytes):
+        #Marks nbytes at the start of the recv buffer as processed
+        self._recv_start += nbytes
+        if self._recv_start == self._recv_end:
+            self._recv_start = 0
+            self._recv_end = 0
 
     def _write(self):
         #Internal write function
@@ -58,50 +172,114 @@ class Message:
             #If there is valid data in the send buffer
             try:
                 #Should be ready to write
-                sent = self.sock.send(self._send_buffer)    #sent is the number of bytes sent
+                sent = self.sock.sendmsg(itertools.islice(self._send_buffer,IOV_MAX))    #sent is the number of bytes sent
             except BlockingIOError:
                 #Resource temporarily unavailable
                 pass
+            except (BrokenPipeError,ConnectionResetError):
+                #The client has gone, e.g. a subscriber that closed without reading
+                log.debug("Connection (%s, %s) closed by the client while sending",*self.addr)
+                self.close()
             else:
-                self._send_buffer = self._send_buffer[sent:]    #Retains only data from index sent to end of array of bytes
-                print("Bytes sent: %d, Bytes Remaining: %d" % (sent, len(self._send_buffer)))
-                #Close when the buffer is empty - binary data is true if not empty
+                self._consume_send_buffer(sent)
+                self.metrics.sent(sent)
+                #When the buffer is empty either close the connection or, if the client
+                #asked for it, wait for the next request on the same connection
                 if sent and not self._send_buffer:
-                    self.close()
+                    if self._queued_time is not None:
+                        self.metrics.observe("send",self.header["mode"],time.perf_counter() - self._queued_time)
+                        self._queued_time = None
+                    if not self.response_created:
+                        #Only pushed messages were sent, so carry on reading the current request
+                        if self.close_when_sent:
+                            self.close()
+                        else:
+                            self._set_selector_events_mask("r")
+                    elif self.keep_alive or self.subscribed or self.sequence is not None:
+                        self.reset()
+                    else:
+                        self.close()
+
+    def _consume_send_buffer(self,sent):
+        #Drops sent bytes from the front of the send buffer without copying the remaining data
+        self._pending_bytes -= sent
+        while self._send_buffer and sent >= len(self._send_buffer[0]):
+            sent -= len(self._send_buffer.popleft())
+            self._message_buffers[0] -= 1
+            if self._message_buffers[0] == 0:
+                self._message_buffers.popleft()
+        if sent:
+            self._send_buffer[0] = self._send_buffer[0][sent:]
 
     def read(self):
         #This function is called repeatedly by socket event loop. Processes header and message data
         self._read()
+        if self.sock is not None:
+            self._process_recv_buffer()
 
+    def _process_recv_buffer(self):
         #First step is to process header length
         if self.header_len is None:
             self.process_proto_header()
 
         #Second step is to process the header
-        if self.msg_len is None:
+        if self.header_len is not None and self.msg_len is None:
             self.process_header()
 
         #Last step is to process the message
-        if self.msg is None:
+        if self.msg_len is not None and self.msg is None:
             self.process_request()
 
     def write(self):
         #This function is called repeatedly until a response is ready to be sent
-        #If message has been received
-        if self.msg:
+        #If message has been received and handled
+        if self.msg is not None and self.fpga_response is not None:
             #If the response hasn't been created (None is converted into boolean False)
             if not self.response_created:
                 self.create_response()
         self._write()
 
+    def reset(self):
+        #Resets the state machine so that another request can be read on the same connection
+        self.header_len = None
+        self.header = None
+        self.binary = None
+        self.msg_len = None
+        self.msg = None
+        self.fpga_response = None
+        self.response = None
+        self.response_created = False
+        self.keep_alive = False
+        self._parse_time = 0
+        self._queued_time = None
+        self._set_selector_events_mask("r")
+        #Pipelined requests may already be waiting in the receive buffer
+        if self._recv_available():
+            self._process_recv_buffer()
+
     def close(self):
         #Closes the socket connection
-        print("Closing connection (%s, %s)" % self.addr)
+        if self.sock is None:
+            return
+        log.info("Closing connection (%s, %s)",*self.addr)
+        self.metrics.closed()
+        if self.subscribed:
+            self.unsubscribe()
+        if self.sequence is not None:
+            self.sequence.cancel()
+            self.sequence = None
+        if self.waiting:
+            appcontroller.get_watcher().remove_waiter(self.finish_wait)
+            self.waiting = False
         try:
             self.selector.unregister(self.sock)
         except Exception as e:
             # print(f"Error: selector.unregister() exception for",f"{self.addr}: {repr(e)}")
-            print("Errpr: selector.unregister() exception for {}: {}".format(self.addr,repr(e)))
+            log.error("selector.unregister() exception for %s: %r",self.addr,e)
+        try:
+            self.sock.close()
+        except OSError as e:
+            log.error("socket.close() exception for %s: %r",self.addr,e)
         finally:
             #Delete reference to socket object for garbage collection
             self.sock = None
@@ -109,59 +287,180 @@ class Message:
     def process_proto_header(self):
         #This function retrieves the header from the message
         proto_len = 2
-        if len(self._recv_buffer) >= proto_len:
-            self.header_len = struct.unpack("<H",self._recv_buffer[:proto_len])[0]
-            self._recv_buffer = self._recv_buffer[proto_len:]
+        if self._recv_available() >= proto_len:
+            self.header_len = struct.unpack_from("<H",self._recv_buffer,self._recv_start)[0]
+            self._consume_recv_buffer(proto_len)
+            if self.header_len == binheader.MAGIC:
+                self.binary = True
+                self.header_len = binheader.REQUEST.size
 
 
     def process_header(self):
         #This function processes the header
-        if len(self._recv_buffer) >= self.header_len:
+        if self._recv_available() >= self.header_len:
             # print("Header is",self._recv_buffer[:hdr_len])
             # hdr = int.from_bytes(struct.unpack("<c",self._recv_buffer[:1])[0],'little')
-            self.header = json.loads(self._recv_buffer[:self.header_len].decode('ascii'))
-            self.msg_len = 4*self.header["length"]
+            t = time.perf_counter()
+            start = self._recv_start
+            if self.binary:
+                self.process_binary_header()
+            else:
+                self.header = json.loads(self._recv_buffer[start:start + self.header_len].decode('ascii'))
+                self.msg_len = 4*self.header["length"]
+                self.keep_alive = bool(self.header.get("keepAlive",False))
+            self._parse_time = time.perf_counter() - t
 
-            print("Header:")
-            print(self.header)
-            self._recv_buffer = self._recv_buffer[self.header_len:]
+            log.debug("Header: %s",self.header)
+            self._consume_recv_buffer(self.header_len)
+
+    def process_binary_header(self):
+        #Unpacks a binary header. The mode is only kept for logging and the metrics
+        opcode,flags,fetch_type,length,num_fetch,request_id = binheader.REQUEST.unpack_from(self._recv_buffer,self._recv_start)
+        self.binary = (opcode,fetch_type,num_fetch,request_id)
+        self.header = {"mode":binheader.MODES.get(opcode,"unknown"),"print":bool(flags & binheader.FLAG_PRINT)}
+        self.msg_len = 4*length
+        self.keep_alive = bool(flags & binheader.FLAG_KEEP_ALIVE)
 
     def process_request(self):
         #Processes the message
-        if len(self._recv_buffer) >= self.msg_len:
-            self.msg = self._recv_buffer[:self.msg_len]
-            pmsg = []
-            for d in struct.iter_unpack("<I",self._recv_buffer[:self.msg_len]):
-                pmsg.append(d[0])
-            if ("print" in self.header) and (self.header["print"]):
-                print("Message:",self.msg)
-                print("\n".join("%08x"%item for item in pmsg))
+        if self._recv_available() >= self.msg_len:
+            #Decode the whole body into 32-bit words with a single copy
+            t = time.perf_counter()
+            self.msg = array.array("I")
+            with memoryview(self._recv_buffer) as view:
+                self.msg.frombytes(view[self._recv_start:self._recv_start + self.msg_len])
+            if sys.byteorder != "little":
+                self.msg.byteswap()
+            mode = self.header["mode"]
+            t_hw = time.perf_counter()
+            self.metrics.observe("parse",mode,self._parse_time + t_hw - t)
+            if ("print" in self.header) and (self.header["print"]) and log.isEnabledFor(logging.INFO):
+                log.info("Message: %s\n%s",self.msg,"\n".join("%08x"%item for item in self.msg))
             
-            self._recv_buffer = self._recv_buffer[self.msg_len:]
+            self._consume_recv_buffer(self.msg_len)
             
-            #Write data using io-controller
-            self.fpga_response = appcontroller.write(pmsg,self.header)
-            print("Message written to server")
-            #At end of reading of data, set class to write mode
-            self._set_selector_events_mask("w")
+            #Write data using io-controller. Subscriptions belong to the connection and are handled here
+            if self.binary is not None:
+                response = appcontroller.write_binary(self.msg,*self.binary[:3])
+            elif self.header["mode"] == "subscribe":
+                response = self.subscribe(bool(self.header.get("raw",False)))
+            elif self.header["mode"] == "unsubscribe":
+                response = self.unsubscribe()
+            elif self.header["mode"] == "sequence":
+                response = self.start_sequence()
+            elif self.header["mode"] == "wait for shot":
+                response = self.wait_for_shot()
+            else:
+                response = appcontroller.write(self.msg,self.header)
+            self.metrics.observe("hardware",mode,time.perf_counter() - t_hw)
+            if response is not None:
+                self.set_response(response)
+
+    def set_response(self,response):
+        self.fpga_response = response
+        self.metrics.request(self.header["mode"],response["err"])
+        #At end of reading of data, set class to write mode
+        self._set_selector_events_mask("w")
 
     
     def create_response(self):
-        self.fpga_response["length"] = 4*len(self.fpga_response["data"])
-        data = self.fpga_response.pop("data")
-        json_str = json.dumps(self.fpga_response)
-        print(json_str)
-        tmp = json_str.encode('ascii')
-        self._send_buffer = struct.pack("<H",len(tmp)) + tmp
-        for d in data:
-            # print(format(int(d,16)))
-            self._send_buffer += struct.pack("<I",int(d,16))
+        #The data is sent straight from the array that it was read into. Shots pushed to
+        #subscribers may already be waiting in the send buffer
+        t = time.perf_counter()
+        log.debug("Reply: %s",self.fpga_response)
+        if self.binary is not None:
+            self._queue(frame_binary_response(self.fpga_response,self.binary[0],self.binary[3]))
+        else:
+            self._queue(frame_response(self.fpga_response))
+        self._queued_time = time.perf_counter()
+        self.metrics.observe("build",self.header["mode"],self._queued_time - t)
         self.response_created = True
+        if self.sequence_pending:
+            self.sequence_pending = False
+            self.sequence.start(appcontroller.get_watcher())
+
+    def subscribe(self,raw=False):
+        #Registers this connection to receive every completed shot. The raw buffers are only
+        #read from the FPGA when at least one subscriber asks for them
+        if self.subscribed:
+            self.unsubscribe()
+        self.subscribed = True
+        self.subscribe_raw = raw
+        appcontroller.get_watcher().add_listener(self.push_shot,raw)
+        return {"err":False,"errMsg":"","data":[]}
+
+    def unsubscribe(self):
+        if self.subscribed:
+            appcontroller.get_watcher().remove_listener(self.push_shot,self.subscribe_raw)
+        self.subscribed = False
+        self.subscribe_raw = False
+        return {"err":False,"errMsg":"","data":[]}
+
+    def start_sequence(self):
+        #Runs a sequence uploaded by the client. The results are pushed to this connection
+        #as the sequence runs, and the connection is kept open until it has finished
+        if self.sequence is not None:
+            return {"err":True,"errMsg":"A sequence is already running on this connection","data":[]}
+        try:
+            seq = sequencer.Sequence(self.header.get("steps"),self.header.get("iterations"),self.push_sequence,bool(self.header.get("stream",True)),self.can_push)
+        except (ValueError,TypeError) as e:
+            return {"err":True,"errMsg":str(e),"data":[]}
+        self.sequence = seq
+        self.sequence_keep_alive = self.keep_alive
+        #Started once this reply is queued, so that results cannot be sent ahead of it
+        self.sequence_pending = True
+        return {"err":False,"errMsg":"","iterations":seq.iterations,"data":[]}
+
+    def wait_for_shot(self):
+        #The reply is sent when the watcher calls finish_wait() with the next shot, or with None
+        #on timeout. Until then the connection only reads, so that a disconnect is noticed
+        response = appcontroller.wait_for_shot(self.header,self.finish_wait)
+        if response is None and self.fpga_response is None:
+            self.waiting = True
+        return response
+
+    def finish_wait(self,shot):
+        self.waiting = False
+        if self.sock is None:
+            return
+        self.set_response(appcontroller.shot_counts(shot))
+
+    def push_sequence(self,response):
+        #Queues results from the running sequence for sending
+        if self.sock is None:
+            return
+        if response["done"]:
+            self.sequence = None
+            self.close_when_sent = not (self.sequence_keep_alive or self.subscribed)
+        self._queue(frame_response(response))
+        self._set_selector_events_mask("rw")
+
+    def push_shot(self,shot):
+        #Queues a shot for sending to this subscriber
+        if self.sock is None:
+            return
+        if not self.can_push():
+            log.warning("Dropping shot %d for (%s, %s): client is not keeping up",shot.index,*self.addr)
+            self.metrics.dropped()
+            return
+        self._queue(frame_shot(shot,self.subscribe_raw))
+        self._set_selector_events_mask("rw")
+
+    def _queue(self,buffers):
+        #Adds the buffers of one message to the send buffer
+        self._send_buffer.extend(buffers)
+        self._message_buffers.append(len(buffers))
+        self._pending_bytes += sum(len(b) for b in buffers)
+
+    def can_push(self):
+        #False while the client is falling behind, in which case shots are dropped and sequences
+        #wait before their next iteration
+        return self._pending_bytes <= MAX_PENDING_PUSH and len(self._message_buffers) < MAX_PENDING_MESSAGES
         
 
             
     def process_events(self,mask):
         if mask & selectors.EVENT_READ:
             self.read()
-        if mask & selectors.EVENT_WRITE:
+        if mask & selectors.EVENT_WRITE and self.sock is not None:
             self.write()
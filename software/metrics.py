@@ -0,0 +1,197 @@
+import time
+import bisect
+import threading
+
+#
+# Counters and latency histograms for the socket servers. Each request is timed in four stages:
+#   parse:    decoding the JSON header and the message body
+#   hardware: handling the request in appcontroller, including access to the FPGA
+#   build:    framing the reply
+#   send:     from the reply being queued until its last byte was handed to the socket
+# appserver_async.py also records 'queue', the time spent waiting for a free worker. Histograms have fixed buckets so that recording a value is a bisect and an increment
+#
+BUCKETS = [10e-6,25e-6,50e-6,100e-6,250e-6,500e-6,1e-3,2.5e-3,5e-3,10e-3,25e-3,50e-3,0.1,0.25,0.5,1,2.5,5,10]
+STAGES = ("parse","queue","hardware","build","send")
+PREFIX = "dpfeedback"
+#Modes the servers handle. Any other mode sent by a client is counted as "unknown", so that
+#clients cannot add labels without limit
+MODES = ("read","write","read batch","write batch","fetch data","fetch decoded","read parameters",
+         "write parameters","history","find transition","stats","feedback stats","list profiles",
+         "delete profile","save profile","activate profile","subscribe","unsubscribe","sequence","wait for shot")
+
+
+def label(mode):
+    return mode if isinstance(mode,str) and mode in MODES else "unknown"
+
+def escape(value):
+    #Escapes a label value for the Prometheus text format
+    return str(value).replace("\\","\\\\").replace('"','\\"').replace("\n","\\n")
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0]*(len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self,value):
+        self.counts[bisect.bisect_left(BUCKETS,value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self,q):
+        #Upper edge of the bucket holding the q-th quantile, or None if nothing was recorded
+        if self.count == 0:
+            return None
+        target = q*self.count
+        total = 0
+        for k,n in enumerate(self.counts):
+            total += n
+            if total >= target and n > 0:
+                return BUCKETS[k] if k < len(BUCKETS) else float("inf")
+        return float("inf")
+
+    def summary(self):
+        return {"count":self.count,"sum":self.sum,"p50":self.quantile(0.5),"p90":self.quantile(0.9),
+                "p99":self.quantile(0.99),"buckets":BUCKETS,"counts":list(self.counts)}
+
+
+class Metrics:
+    #Collects the numbers for the 'stats' mode. Updates can come from worker threads, so they
+    #are made under a lock. With enabled set to False (the servers' --no-metrics) requests are
+    #not timed or counted, and only the connections are
+    def __init__(self):
+        self.enabled = True
+        self.started = time.time()
+        self.requests = {}          #Mode -> number of requests
+        self.errors = {}            #Mode -> number of replies with err set
+        self.histograms = {}        #(stage, mode) -> Histogram
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connections = 0        #Connections accepted since the start
+        self.active = 0             #Connections currently open
+        self.dropped_shots = 0
+        self._lock = threading.Lock()
+
+    def observe(self,stage,mode,seconds):
+        if not self.enabled:
+            return
+        mode = label(mode)
+        with self._lock:
+            h = self.histograms.get((stage,mode))
+            if h is None:
+                h = self.histograms[(stage,mode)] = Histogram()
+            h.observe(seconds)
+
+    def request(self,mode,err=False):
+        if not self.enabled:
+            return
+        mode = label(mode)
+        with self._lock:
+            self.requests[mode] = self.requests.get(mode,0) + 1
+            if err:
+                self.errors[mode] = self.errors.get(mode,0) + 1
+
+    def received(self,nbytes):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.bytes_in += nbytes
+
+    def sent(self,nbytes):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.bytes_out += nbytes
+
+    def opened(self):
+        with self._lock:
+            self.connections += 1
+            self.active += 1
+
+    def closed(self):
+        with self._lock:
+            self.active -= 1
+
+    def dropped(self):
+        with self._lock:
+            self.dropped_shots += 1
+
+    def reset(self):
+        with self._lock:
+            self.requests = {}
+            self.errors = {}
+            self.histograms = {}
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.dropped_shots = 0
+            self.started = time.time()
+
+    def snapshot(self):
+        #Returns all values as a dict that can be sent as JSON
+        with self._lock:
+            latency = {}
+            for (stage,mode),h in self.histograms.items():
+                latency.setdefault(mode,{})[stage] = h.summary()
+            return {"uptime":time.time() - self.started,"requests":dict(self.requests),"errors":dict(self.errors),
+                    "latency":latency,"bytesIn":self.bytes_in,"bytesOut":self.bytes_out,
+                    "connections":self.connections,"activeConnections":self.active,"droppedShots":self.dropped_shots}
+
+    def prometheus(self):
+        #Returns all values in the Prometheus text exposition format
+        with self._lock:
+            lines = []
+            def metric(name,kind,doc,samples):
+                lines.append("# HELP {}_{} {}".format(PREFIX,name,doc))
+                lines.append("# TYPE {}_{} {}".format(PREFIX,name,kind))
+                for labels,value in samples:
+                    lines.append("{}_{}{} {}".format(PREFIX,name,labels,value))
+            metric("requests_total","counter","Requests handled, by mode",
+                   [('{{mode="{}"}}'.format(escape(m)),n) for m,n in sorted(self.requests.items())])
+            metric("errors_total","counter","Replies with an error, by mode",
+                   [('{{mode="{}"}}'.format(escape(m)),n) for m,n in sorted(self.errors.items())])
+            metric("received_bytes_total","counter","Bytes received from clients",[("",self.bytes_in)])
+            metric("sent_bytes_total","counter","Bytes sent to clients",[("",self.bytes_out)])
+            metric("connections_total","counter","Connections accepted",[("",self.connections)])
+            metric("active_connections","gauge","Connections currently open",[("",self.active)])
+            metric("dropped_shots_total","counter","Shots not sent to subscribers that were falling behind",[("",self.dropped_shots)])
+            samples = []
+            for (stage,mode),h in sorted(self.histograms.items()):
+                labels = 'stage="{}",mode="{}"'.format(escape(stage),escape(mode))
+                total = 0
+                for le,n in zip(BUCKETS + ["+Inf"],h.counts):
+                    total += n
+                    samples.append(("_bucket{{{},le=\"{}\"}}".format(labels,le),total))
+                samples.append(("_sum{{{}}}".format(labels),h.sum))
+                samples.append(("_count{{{}}}".format(labels),h.count))
+            metric("request_seconds","histogram","Time spent in each stage of a request",samples)
+            return "\n".join(lines) + "\n"
+
+
+_metrics = Metrics()
+
+def get_metrics():
+    return _metrics
+
+def serve_http(host,port):
+    #Serves the Prometheus text on http://host:port/metrics from a background thread
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/","/metrics"):
+                self.send_error(404)
+                return
+            body = _metrics.prometheus().encode('ascii')
+            self.send_response(200)
+            self.send_header("Content-Type","text/plain; version=0.0.4")
+            self.send_header("Content-Length",str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self,*args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host,port),Handler)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return server
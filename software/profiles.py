@@ -0,0 +1,92 @@
+import os
+import json
+
+import registermap
+
+#
+# Named register images of the parameter registers (registermap.PARAMETER_REGISTERS, i.e. all
+# of 0x04 to 0x40). Profiles are validated and completed when they are saved, so activating one
+# only has to compare it with the device and write the words that differ. With a filename the
+# profiles are kept in a JSON file and survive restarts of the server
+#
+MAX_PROFILES = 256
+
+
+class ProfileStore:
+    def __init__(self,filename=None):
+        self.filename = filename
+        self._profiles = {}         #Name -> dict of address -> register value
+        if filename is not None and os.path.exists(filename):
+            with open(filename) as f:
+                for name,regs in json.load(f).items():
+                    self._profiles[name] = check_registers(dict((int(a),v) for a,v in regs.items()))
+
+    def __contains__(self,name):
+        return name in self._profiles
+
+    def names(self):
+        return sorted(self._profiles)
+
+    def get(self,name):
+        try:
+            return self._profiles[name]
+        except KeyError:
+            raise ValueError("Unknown profile {}".format(name))
+
+    def save(self,name,regs):
+        #Stores a complete image, replacing any profile with the same name
+        if not isinstance(name,str) or not name:
+            raise ValueError("A profile needs a name")
+        if name not in self._profiles and len(self._profiles) >= MAX_PROFILES:
+            raise ValueError("No more than {:d} profiles can be stored".format(MAX_PROFILES))
+        regs = check_registers(regs)
+        if set(regs) != set(registermap.PARAMETER_REGISTERS):
+            raise ValueError("A profile must hold every parameter register")
+        self._profiles[name] = regs
+        self._write()
+
+    def delete(self,name):
+        self.get(name)
+        del self._profiles[name]
+        self._write()
+
+    def _write(self):
+        #Replaces the file in one step so that a crash cannot leave it half written
+        if self.filename is None:
+            return
+        tmp = self.filename + ".tmp"
+        with open(tmp,"w") as f:
+            json.dump(dict((name,dict((str(a),v) for a,v in regs.items())) for name,regs in self._profiles.items()),f,indent=1)
+        os.replace(tmp,self.filename)
+
+
+def check_registers(regs):
+    #Returns regs as a dict of int address -> int value, or raises a ValueError if any address is
+    #not a parameter register or any value is not a 32-bit word
+    out = {}
+    for a,v in regs.items():
+        if a not in registermap.PARAMETER_REGISTERS:
+            raise ValueError("Address 0x{:x} is not a parameter register".format(a) if isinstance(a,int) else "Invalid address {}".format(a))
+        if not isinstance(v,int) or isinstance(v,bool) or v < 0 or v > 0xFFFFFFFF:
+            raise ValueError("Value {} for address 0x{:x} is not a 32-bit word".format(v,a))
+        out[a] = v
+    return out
+
+def build(base,registers=None,values=None):
+    #Returns a complete image: base (address -> value) with the raw words in 'registers' and
+    #then the parameters in 'values', given in physical units, applied to it
+    regs = dict(base)
+    if values is not None and not isinstance(values,dict):
+        raise ValueError("Values must be a dict of parameter name and value")
+    for name in values or ():
+        if registermap.ADDR[registermap.index(name)] not in registermap.PARAMETER_REGISTERS:
+            raise ValueError("Parameter {} cannot be stored in a profile".format(name))
+    if registers is not None:
+        regs.update(check_registers(registers))
+    if values is not None:
+        registermap.pack(values,regs)
+    return check_registers(regs)
+
+def diff(profile,current):
+    #Addresses whose words differ between a profile and the current register values
+    return [a for a in sorted(profile) if current.get(a) != profile[a]]
@@ -0,0 +1,147 @@
+import math
+
+#
+# Register map of the feedback design (topmod.vhd), with the same parameter names, bit ranges and
+# scaling as DPFeedback.m. This is the one place where the layout is written down: RedPitaya.py,
+# the 'read parameters' and 'write parameters' server modes, dpclient.py and the simulator all use
+# the tables compiled from it below, so encoding a field is a lookup of a precomputed shift and mask
+#
+CLK = 125000000
+
+
+def matlab_round(x):
+    #Rounds half away from zero like MATLAB's round(). Python's round() goes to the even
+    #neighbour, which gave different words from DPFeedback.m for values such as 62.5
+    return int(math.floor(abs(x) + 0.5))*(-1 if x < 0 else 1)
+
+#
+# Scaling between physical values and register values: name -> (to register, from register)
+#
+SCALES = {
+    None:       (matlab_round,lambda x: x),
+    "time":     (lambda x: matlab_round(x*CLK),lambda x: x/CLK),
+    "fraction": (lambda x: matlab_round(x*(2**16 - 1)),lambda x: x/(2**16 - 1)),
+    "signed14": (lambda x: matlab_round(x) & 0x3FFF,lambda x: x - (1 << 14) if x & (1 << 13) else x),
+    "half":     (matlab_round,lambda x: (x + 1)//2),
+}
+
+#
+# name, address, [low bit, high bit], scale, flags
+# Volatile registers have side effects or change on their own and are never cached. Read-only
+# registers are also volatile
+#
+REGISTER_MAP = [
+    #Triggers
+    ("pulseTrig",           0x00,[0,0],None,"volatile"),
+    #Shared register
+    ("enableDP",            0x04,[0,0],None,""),
+    ("enableFB",            0x04,[1,1],None,""),
+    ("useFixedAux",         0x04,[2,2],None,""),
+    ("enableManualMW",      0x04,[3,3],None,""),
+    ("dpOnShutterOff",      0x04,[4,4],None,""),
+    ("auxOnShutterOff",     0x04,[5,5],None,""),
+    ("auxMan",              0x04,[27,27],None,""),
+    ("pulseMWMan",          0x04,[28,28],None,""),
+    ("shutterDPMan",        0x04,[29,29],None,""),
+    ("pulseDPMan",          0x04,[30,30],None,""),
+    ("manualFlag",          0x04,[31,31],None,""),
+    #Pulse generation
+    ("width",               0x08,[0,15],"time",""),
+    ("numpulses",           0x08,[16,31],None,""),
+    ("period",              0x0C,[0,31],"time",""),
+    ("shutterDelay",        0x10,[0,31],"time",""),
+    ("auxDelay",            0x14,[0,31],"time",""),
+    ("additionalPulses",    0x18,[0,7],None,""),
+    ("useAdditionalPulses", 0x18,[8,8],None,""),
+    #Initial processing
+    ("delaySignal",         0x1C,[0,13],"time",""),
+    ("samplesPerPulse",     0x1C,[14,27],None,""),
+    ("log2Avgs",            0x1C,[28,31],None,""),
+    ("delayAux",            0x20,[0,13],"time",""),
+    #Secondary processing
+    ("sumStart",            0x24,[0,10],None,""),
+    ("subStart",            0x24,[11,21],None,""),
+    ("sumWidth",            0x24,[22,31],None,""),
+    ("offsets0",            0x28,[0,13],"signed14",""),
+    ("offsets1",            0x28,[14,27],"signed14",""),
+    ("usePresetOffsets",    0x28,[28,28],None,""),
+    #Signal computation
+    ("fixedAux0",           0x2C,[0,31],None,""),
+    ("fixedAux1",           0x30,[0,31],None,""),
+    #Feedback
+    ("maxMWPulses",         0x34,[0,15],None,""),
+    ("target",              0x34,[16,31],"fraction",""),
+    ("tol",                 0x38,[0,15],None,""),       #Register value, DPFeedback.m scales it with the target
+    ("mwPulseWidth",        0x3C,[0,15],"time",""),
+    ("mwNumPulses",         0x3C,[16,31],None,""),
+    ("mwPulsePeriod",       0x40,[0,31],"time",""),
+    #Read-only counters
+    ("samplesCollected0",   0x01000000,[0,14],None,"readonly"),
+    ("pulsesCollected0",    0x01000004,[0,14],"half","readonly"),
+    ("samplesCollected1",   0x01000008,[0,14],None,"readonly"),
+    ("pulsesCollected1",    0x0100000C,[0,14],"half","readonly"),
+    ("pulsesCollected2",    0x01000010,[0,14],None,"readonly"),
+]
+
+
+#
+# Tables compiled from the map, indexed by the position of each parameter in NAMES
+#
+NAMES = tuple(p[0] for p in REGISTER_MAP)
+INDEX = dict((name,k) for k,name in enumerate(NAMES))
+ADDR = tuple(p[1] for p in REGISTER_MAP)
+BITS = tuple(tuple(p[2]) for p in REGISTER_MAP)
+SHIFT = tuple(p[2][0] for p in REGISTER_MAP)
+MASK = tuple((1 << (p[2][1] - p[2][0] + 1)) - 1 for p in REGISTER_MAP)
+TO_REGISTER = tuple(SCALES[p[3]][0] for p in REGISTER_MAP)
+FROM_REGISTER = tuple(SCALES[p[3]][1] for p in REGISTER_MAP)
+READONLY = frozenset(p[1] for p in REGISTER_MAP if p[4] == "readonly")
+VOLATILE = frozenset(p[1] for p in REGISTER_MAP if p[4] in ("volatile","readonly"))
+REGISTERS = tuple(sorted(set(ADDR)))
+PARAMETER_REGISTERS = tuple(a for a in REGISTERS if a not in VOLATILE)
+
+
+def index(name):
+    try:
+        return INDEX[name]
+    except KeyError:
+        raise ValueError("Unknown parameter {}".format(name))
+
+def get_field(name,reg):
+    #Returns the register value of a parameter from the whole register
+    k = index(name)
+    return (reg >> SHIFT[k]) & MASK[k]
+
+def set_field(name,raw,reg=0):
+    #Returns reg with the bits of the parameter replaced by raw. Raises a ValueError if raw does not fit
+    k = index(name)
+    if raw < 0 or raw > MASK[k]:
+        raise ValueError("Value {} for {} does not fit in bits {}-{}".format(raw,name,*BITS[k]))
+    return (reg & ~(MASK[k] << SHIFT[k])) | (raw << SHIFT[k])
+
+def decode(name,reg):
+    #Returns the physical value of a parameter from the whole register
+    k = index(name)
+    return FROM_REGISTER[k]((reg >> SHIFT[k]) & MASK[k])
+
+def encode(name,value,reg=0):
+    #Returns reg with the parameter set to a physical value
+    return set_field(name,TO_REGISTER[index(name)](value),reg)
+
+def registers_for(names):
+    #Sorted list of the registers holding the given parameters
+    return sorted(set(ADDR[index(n)] for n in names))
+
+def unpack(names,regs):
+    #Returns a dict of physical values from a dict of address -> register value
+    return dict((n,decode(n,regs[ADDR[index(n)]])) for n in names)
+
+def pack(values,regs):
+    #Sets the parameters in a dict of address -> register value, which must already hold the
+    #current values of the registers involved. Returns regs
+    for n,v in values.items():
+        k = index(n)
+        if ADDR[k] in READONLY:
+            raise ValueError("Parameter {} is read-only".format(n))
+        regs[ADDR[k]] = encode(n,v,regs[ADDR[k]])
+    return regs
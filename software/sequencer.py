@@ -0,0 +1,189 @@
+import time
+import array
+
+import hardware
+import acquisition
+import appcontroller
+
+OPS = ("write","read","wait","fetch")
+DEFAULT_WAIT_TIMEOUT = 10       #Seconds to wait for a shot before a sequence is aborted
+
+
+def is_word(x):
+    return isinstance(x,int) and not isinstance(x,bool) and 0 <= x <= 0xFFFFFFFF
+
+
+class Sequence:
+    #Runs a list of steps on the device for a number of iterations without any round trips to
+    #the client. Each step is a dict with the field 'op':
+    #   write: writes 'value', or 'values'[iteration], to 'addr'. With 'mask' only those bits are changed
+    #   read:  reads 'addr', which can be a single address or a list of addresses
+    #   wait:  waits until the next shot is complete, for at most 'timeout' seconds
+    #   fetch: reads 'numFetch' words of block RAM 'fetchType'. Without 'numFetch' the whole
+    #          of the last shot is returned
+    #The sequence is driven by the shot watcher: it starts on the next poll, and steps after a
+    #'wait' run when the watcher finds the next shot. Results are passed to send() as a
+    #response dict for each iteration, or once at the end if stream is False. If ready() returns
+    #False the next iteration is held back until it returns True, so that a client that is slow to
+    #receive the results cannot make them pile up on the server
+    def __init__(self,steps,iterations=None,send=None,stream=True,ready=None):
+        if not isinstance(steps,list) or len(steps) == 0:
+            raise ValueError("A sequence needs a list of steps")
+        lengths = []
+        for n,step in enumerate(steps):
+            if not isinstance(step,dict) or step.get("op") not in OPS:
+                raise ValueError("Step {:d} must have 'op' set to one of {}".format(n,", ".join(OPS)))
+            if step["op"] == "write":
+                if "addr" not in step or ("value" in step) == ("values" in step):
+                    raise ValueError("Write in step {:d} needs 'addr' and either 'value' or 'values'".format(n))
+                values = step["values"] if "values" in step else [step["value"]]
+                if not isinstance(values,list) or not all(is_word(v) for v in values + [step["addr"],step.get("mask",0)]):
+                    raise ValueError("Address, mask and values in step {:d} must be 32-bit words".format(n))
+                if "values" in step:
+                    lengths.append(len(step["values"]))
+            elif step["op"] == "read":
+                addrs = step.get("addr")
+                if not (is_word(addrs) or (isinstance(addrs,list) and len(addrs) > 0 and all(is_word(a) for a in addrs))):
+                    raise ValueError("Read in step {:d} needs 'addr' as an address or a list of addresses".format(n))
+            elif step["op"] == "wait":
+                timeout = step.get("timeout",DEFAULT_WAIT_TIMEOUT)
+                if not isinstance(timeout,(int,float)) or timeout <= 0:
+                    raise ValueError("Timeout in step {:d} must be a positive number of seconds".format(n))
+            elif step["op"] == "fetch":
+                if step.get("fetchType") not in range(len(hardware.FETCH_ADDR)):
+                    raise ValueError("Invalid fetch type in step {:d}".format(n))
+                num = step.get("numFetch",0)
+                if not isinstance(num,int) or num < 0 or num > hardware.MAX_FETCH:
+                    raise ValueError("Number of samples to fetch in step {:d} must be between 0 and {:d}".format(n,hardware.MAX_FETCH))
+        if iterations is None:
+            iterations = max(lengths) if lengths else 1
+        if not isinstance(iterations,int) or iterations < 1 or any(k < iterations for k in lengths):
+            raise ValueError("Every list of values must have an entry for each of the {} iterations".format(iterations))
+
+        self.steps = steps
+        self.iterations = iterations
+        self.send = send
+        self.stream = stream
+        self.ready = ready
+        self.iteration = 0
+        self.step = 0
+        self.started = False
+        self.waiting = False
+        self.paused = False
+        self.done = False
+        self.raw = any(s["op"] == "fetch" and s["fetchType"] in acquisition.RAW_TYPES for s in steps)
+        self._watcher = None
+        self._deadline = 0
+        self._shot = None
+        self._results = []
+        self._data = array.array("I")
+        self._buffered = []
+
+    def start(self,watcher):
+        self._watcher = watcher
+        watcher.add_listener(self.on_shot,self.raw)
+        watcher.add_poller(self.on_poll)
+
+    def cancel(self):
+        #Stops the sequence without sending anything else
+        if self._watcher is not None:
+            self._watcher.remove_listener(self.on_shot,self.raw)
+            self._watcher.remove_poller(self.on_poll)
+            self._watcher = None
+        self.done = True
+
+    def on_poll(self,now):
+        if self.done:
+            return
+        if not self.started:
+            self.started = True
+            self._advance()
+        elif self.waiting and now > self._deadline:
+            self._finish("Timed out waiting for a shot at step {:d} of iteration {:d}".format(self.step,self.iteration))
+        elif self.paused:
+            self._advance()
+
+    def on_shot(self,shot):
+        if not self.waiting or self.done:
+            return
+        self.waiting = False
+        self._shot = shot
+        self._results.append({"step":self.step,"op":"wait","shot":shot.index,"time":shot.time})
+        self.step += 1
+        self._advance()
+
+    def _advance(self):
+        #Runs steps until the sequence has to wait for a shot or is finished
+        try:
+            while not self.waiting and not self.done:
+                self.paused = self.step == 0 and self.ready is not None and not self.ready()
+                if self.paused:
+                    return
+                if self.step == len(self.steps):
+                    self._end_iteration()
+                else:
+                    self._run_step(self.steps[self.step])
+        except (OSError,ValueError,IndexError):
+            self._finish("Bus error at step {:d} of iteration {:d}".format(self.step,self.iteration))
+
+    def _run_step(self,step):
+        dev = hardware.get_device()
+        if step["op"] == "write":
+            value = step["values"][self.iteration] if "values" in step else step["value"]
+            if "mask" in step:
+                value = (dev.read(step["addr"]) & ~step["mask"]) | (value & step["mask"])
+            #Through appcontroller so that writing the trigger wakes the shot watcher
+            appcontroller.write_register(dev,step["addr"],value)
+        elif step["op"] == "read":
+            addrs = step["addr"] if isinstance(step["addr"],list) else [step["addr"]]
+            self._add_result(step,array.array("I",[dev.read(a) for a in addrs]))
+        elif step["op"] == "fetch":
+            ft = step["fetchType"]
+            if "numFetch" not in step and self._shot is not None and self._shot.buffers[ft] is not None:
+                #The watcher has already read the buffer
+                data = self._shot.buffers[ft]
+            else:
+                num = step.get("numFetch",min(acquisition.read_counts(dev)[ft],hardware.MAX_FETCH))
+                data = dev.read_block(hardware.FETCH_ADDR[ft],num)
+            self._add_result(step,data,fetchType=ft)
+        elif step["op"] == "wait":
+            self.waiting = True
+            self._deadline = time.time() + step.get("timeout",DEFAULT_WAIT_TIMEOUT)
+            return
+        self.step += 1
+
+    def _add_result(self,step,data,**fields):
+        result = {"step":self.step,"op":step["op"],"length":4*len(data)}
+        result.update(fields)
+        self._results.append(result)
+        self._data.extend(data)
+
+    def _end_iteration(self):
+        record = {"iteration":self.iteration,"results":self._results}
+        self.iteration += 1
+        self.step = 0
+        self._shot = None
+        done = self.iteration == self.iterations
+        if self.stream:
+            self._send(dict(record,done=done),self._data)
+        else:
+            self._buffered.append(record)
+        self._results = []
+        self._data = array.array("I") if self.stream else self._data
+        if done:
+            self._finish()
+
+    def _finish(self,errMsg=""):
+        self.cancel()
+        response = {"iteration":self.iteration,"done":True}
+        if not self.stream:
+            response["iterations"] = self._buffered
+        if errMsg or not self.stream:
+            self._send(response,self._data if not self.stream else array.array("I"),errMsg)
+
+    def _send(self,fields,data,errMsg=""):
+        response = {"err":bool(errMsg),"errMsg":errMsg,"mode":"sequence"}
+        response.update(fields)
+        response["data"] = data
+        if self.send is not None:
+            self.send(response)
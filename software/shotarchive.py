@@ -0,0 +1,207 @@
+import os
+import json
+import bisect
+import mmap
+import struct
+import hashlib
+
+import hardware
+import acquisition
+import registermap
+
+#
+# Append-only archive of shots on disk. The buffers of each shot are appended to a segment file
+# that is preallocated and memory-mapped, and a fixed-size record describing the shot is
+# appended to an index file next to it:
+#   shot-NNNNNN.dat  buffers of each shot, one after another
+#   shot-NNNNNN.idx  one INDEX_RECORD per shot
+#   registers.jsonl  parameter registers, one line for each new register hash
+# A record is only written once the buffers are in the segment, so readers never see a
+# partially written shot. A new segment is started when the current one is full
+#
+INDEX_RECORD = struct.Struct("<Qd8s5Q5I")   #Shot index, time, register hash, offset and length in bytes for each fetchType
+REGISTER_ADDR = list(registermap.PARAMETER_REGISTERS)    #Parameter registers stored with each shot
+SEGMENT_BYTES = 256*2**20
+
+
+def segment_name(directory,number,ext):
+    return os.path.join(directory,"shot-{:06d}.{}".format(number,ext))
+
+def segment_numbers(directory):
+    numbers = []
+    for name in os.listdir(directory):
+        if name.startswith("shot-") and name.endswith(".idx"):
+            try:
+                numbers.append(int(name[5:-4]))
+            except ValueError:
+                pass
+    return sorted(numbers)
+
+def register_hash(values):
+    return hashlib.blake2b(struct.pack("<%dI" % len(values),*values),digest_size=8).digest()
+
+
+class ArchiveWriter:
+    #Writes shots to the archive in 'directory'. It is used as a shot watcher listener. Raw
+    #buffers are only stored with raw=True. Each time the writer is opened it starts a new segment
+    def __init__(self,directory,segment_bytes=SEGMENT_BYTES,raw=False,device=None):
+        if segment_bytes < 4096:
+            raise ValueError("Segments must be at least 4096 bytes")
+        os.makedirs(directory,exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.raw = raw
+        self.device = device
+        numbers = segment_numbers(directory)
+        self.segment = numbers[-1] if numbers else 0
+        self._data = None
+        self._map = None
+        self._index = None
+        self._pos = 0
+        self._size = 0
+        self._hashes = set(r[0] for r in read_registers(directory))
+        self._registers = open(os.path.join(directory,"registers.jsonl"),"a")
+
+    def _open_segment(self,nbytes):
+        self._close_segment()
+        self.segment += 1
+        self._size = max(self.segment_bytes,nbytes)
+        self._data = open(segment_name(self.directory,self.segment,"dat"),"w+b")
+        self._data.truncate(self._size)
+        self._map = mmap.mmap(self._data.fileno(),self._size)
+        self._index = open(segment_name(self.directory,self.segment,"idx"),"ab")
+        self._pos = 0
+
+    def _close_segment(self):
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            #Give back the preallocated space that was not used
+            self._data.truncate(self._pos)
+            self._data.close()
+            self._index.close()
+            self._map = None
+
+    def snapshot(self):
+        #Stores the current parameter registers if they have not been seen before and returns their hash
+        dev = self.device if self.device is not None else hardware.get_device()
+        values = [dev.read(a) for a in REGISTER_ADDR]
+        h = register_hash(values)
+        if h not in self._hashes:
+            self._registers.write(json.dumps({"hash":h.hex(),"addr":REGISTER_ADDR,"values":values}) + "\n")
+            self._registers.flush()
+            self._hashes.add(h)
+        return h
+
+    def add(self,shot):
+        types = [k for k in shot.fetch_types() if self.raw or k not in acquisition.RAW_TYPES]
+        nbytes = sum(4*len(shot.buffers[k]) for k in types)
+        if self._map is None or self._pos + nbytes > self._size:
+            self._open_segment(nbytes)
+        offsets = [0]*len(acquisition.COUNT_ADDR)
+        lengths = [0]*len(acquisition.COUNT_ADDR)
+        for k in types:
+            n = 4*len(shot.buffers[k])
+            self._map[self._pos:self._pos + n] = memoryview(shot.buffers[k]).cast("B")
+            offsets[k] = self._pos
+            lengths[k] = n
+            self._pos += n
+        self._index.write(INDEX_RECORD.pack(shot.index,shot.time,self.snapshot(),*(offsets + lengths)))
+        self._index.flush()
+
+    def close(self):
+        self._close_segment()
+        self._registers.close()
+
+
+class ArchiveEntry:
+    #One shot in the archive
+    def __init__(self,segment,record):
+        self.segment = segment
+        self.index = record[0]
+        self.time = record[1]
+        self.registers = record[2]
+        n = len(acquisition.COUNT_ADDR)
+        self.offsets = record[3:3 + n]
+        self.lengths = record[3 + n:3 + 2*n]
+
+
+class ArchiveReader:
+    #Reads an archive written by ArchiveWriter, also while it is being written. The segments are
+    #memory-mapped, and buffers are returned as memoryviews of the segment without copying, so
+    #they can be used with e.g. numpy.frombuffer. Call refresh() to see shots added since opening
+    def __init__(self,directory):
+        self.directory = directory
+        self.entries = []
+        self._maps = {}
+        self._index_pos = {}
+        self._times = []
+        self.refresh()
+
+    def refresh(self):
+        for number in segment_numbers(self.directory):
+            with open(segment_name(self.directory,number,"idx"),"rb") as f:
+                f.seek(self._index_pos.get(number,0))
+                data = f.read()
+            n = len(data) // INDEX_RECORD.size
+            self._index_pos[number] = self._index_pos.get(number,0) + n*INDEX_RECORD.size
+            self.entries.extend(ArchiveEntry(number,r) for r in INDEX_RECORD.iter_unpack(data[:n*INDEX_RECORD.size]))
+            if n > 0 and number in self._maps and len(self._maps[number]) < self._end(self.entries[-1]):
+                #The segment was mapped before these shots were written. The old map is left
+                #to be freed once no views of it remain
+                del self._maps[number]
+        self.entries.sort(key=lambda e: e.time)
+        self._times = [e.time for e in self.entries]
+        return len(self.entries)
+
+    def _end(self,entry):
+        return max(o + n for o,n in zip(entry.offsets,entry.lengths))
+
+    def _segment(self,number):
+        if number not in self._maps:
+            with open(segment_name(self.directory,number,"dat"),"rb") as f:
+                self._maps[number] = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        return self._maps[number]
+
+    def select(self,first=None,last=None,since=None,until=None):
+        #Returns the entries with first <= shot index <= last and since <= time <= until. Shot
+        #indices start again from 1 when the server restarts, so times are usually more useful
+        lo = 0 if since is None else bisect.bisect_left(self._times,since)
+        hi = len(self.entries) if until is None else bisect.bisect_right(self._times,until)
+        return [e for e in self.entries[lo:hi] if (first is None or e.index >= first) and (last is None or e.index <= last)]
+
+    def view(self,entry,fetch_type):
+        #Returns the buffer of one shot as a memoryview of 32-bit words, or None if it was not stored
+        n = entry.lengths[fetch_type]
+        if n == 0:
+            return None
+        o = entry.offsets[fetch_type]
+        return memoryview(self._segment(entry.segment))[o:o + n].cast("I")
+
+    def registers(self):
+        #Returns a dict of register hash -> {address: value}
+        return dict((h,dict(zip(addr,values))) for h,addr,values in read_registers(self.directory))
+
+    def close(self):
+        for m in self._maps.values():
+            try:
+                m.close()
+            except BufferError:
+                #Views of the segment are still in use
+                pass
+        self._maps = {}
+
+
+def read_registers(directory):
+    #Returns the list of (hash, addresses, values) stored in registers.jsonl
+    filename = os.path.join(directory,"registers.jsonl")
+    result = []
+    if os.path.exists(filename):
+        with open(filename) as f:
+            for line in f:
+                try:
+                    r = json.loads(line)
+                except ValueError:
+                    continue
+                result.append((bytes.fromhex(r["hash"]),r["addr"],r["values"]))
+    return result
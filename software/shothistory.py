@@ -0,0 +1,84 @@
+import bisect
+import threading
+
+import acquisition
+
+
+class ShotHistory:
+    #Keeps the most recent shots in memory so that clients can retrieve shots that they missed.
+    #The oldest shots are evicted when either max_shots or max_bytes is exceeded. Shots are
+    #stored in a list with a moving start index so that they can be found with bisect. Shots
+    #are added by the thread that polls the watcher while other threads may be reading, so the
+    #lists are only changed or read under a lock, and select() returns a copy
+    def __init__(self,max_shots=1000,max_bytes=64*2**20,raw=False):
+        if max_shots < 1 or max_bytes < 1:
+            raise ValueError("History must be able to hold at least one shot")
+        self.max_shots = max_shots
+        self.max_bytes = max_bytes
+        self.raw = raw
+        self.nbytes = 0
+        self._shots = []
+        self._times = []
+        self._indices = []
+        self._start = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._shots) - self._start
+
+    def add(self,shot):
+        #Stores a shot. Raw buffers are dropped unless the history was created with raw=True
+        if not self.raw and any(shot.buffers[k] is not None for k in acquisition.RAW_TYPES):
+            buffers = list(shot.buffers)
+            for k in acquisition.RAW_TYPES:
+                buffers[k] = None
+            shot = acquisition.Shot(shot.index,shot.time,shot.counts,buffers)
+        with self._lock:
+            self._shots.append(shot)
+            self._times.append(shot.time)
+            self._indices.append(shot.index)
+            self.nbytes += shot_bytes(shot)
+            while len(self) > self.max_shots or (self.nbytes > self.max_bytes and len(self) > 1):
+                self._evict()
+
+    def _evict(self):
+        self.nbytes -= shot_bytes(self._shots[self._start])
+        self._shots[self._start] = None
+        self._start += 1
+        if self._start > len(self._shots)//2:
+            #Compact the lists once half of them is evicted shots
+            del self._shots[:self._start]
+            del self._times[:self._start]
+            del self._indices[:self._start]
+            self._start = 0
+
+    def first(self):
+        with self._lock:
+            return self._indices[self._start] if len(self) > 0 else None
+
+    def last(self):
+        with self._lock:
+            return self._indices[-1] if len(self) > 0 else None
+
+    def select(self,first=None,last=None,since=None,until=None,max_shots=None):
+        #Returns the stored shots with first <= index <= last and since <= time <= until.
+        #Limits that are None are not applied. At most max_shots shots are returned, counting
+        #from the oldest matching shot
+        with self._lock:
+            lo = self._start
+            hi = len(self._shots)
+            if first is not None:
+                lo = max(lo,bisect.bisect_left(self._indices,first,self._start))
+            if last is not None:
+                hi = min(hi,bisect.bisect_right(self._indices,last,self._start))
+            if since is not None:
+                lo = max(lo,bisect.bisect_left(self._times,since,self._start))
+            if until is not None:
+                hi = min(hi,bisect.bisect_right(self._times,until,self._start))
+            if max_shots is not None:
+                hi = min(hi,lo + max_shots)
+            return self._shots[lo:hi] if hi > lo else []
+
+
+def shot_bytes(shot):
+    return sum(4*len(b) for b in shot.buffers if b is not None)
@@ -0,0 +1,167 @@
+import time
+import array
+import threading
+
+import numpy as np
+
+import hardware
+import fpgamodel
+import registermap
+
+CLK = 125000000
+SHUTTER_HOLDOFF = 625000    #Clock cycles between the last pulse and the end of a shot, as in DualChannelAcquisition
+
+#
+# Parameter registers decoded by topmod.vhd, and the size in words of each block RAM indexed by fetchType
+#
+PARAM_ADDR = [a for a in registermap.REGISTERS if a not in registermap.READONLY]
+MEM_WORDS = [4096,16384,4096,16384,8192]
+
+
+class SimulatedDevice:
+    #In-process stand-in for the FPGA with the same address map as topmod.vhd. Writing a 1 to
+    #bit 0 of the trigger register starts a shot whose data is generated with fpgamodel from
+    #synthetic ADC traces. The data appears in the block RAMs, and the counters are updated,
+    #once the pulses and the shutter hold-off would have finished on the real device. The
+    #asyncio server uses it from two worker threads, so each access is made under a lock
+    def __init__(self,amplitude=3000,noise=20,decay=200,seed=None):
+        self.amplitude = amplitude
+        self.noise = noise
+        self.decay = decay          #Number of pulses over which the signal decays
+        self.rng = np.random.default_rng(seed)
+        self.shots = 0
+        self._params = dict((a,0) for a in PARAM_ADDR)
+        self._mem = [array.array("I",[0])*n for n in MEM_WORDS]
+        self._counts = [0]*len(MEM_WORDS)
+        self._pending = None
+        self._pending_time = 0
+        self._lock = threading.Lock()
+
+    def _check_addr(self,addr):
+        if addr < 0 or addr % 4 != 0:
+            raise ValueError("Address {:#010x} is not a valid 4-byte aligned address".format(addr))
+        region = addr // hardware.REGION_SIZE
+        offset = addr % hardware.REGION_SIZE
+        if region == 0 and addr not in self._params:
+            raise ValueError("No parameter at address {:#010x}".format(addr))
+        elif region == 1 and offset // 4 >= len(self._counts):
+            raise ValueError("No read-only register at address {:#010x}".format(addr))
+        elif region >= 2 and (region - 2 >= len(MEM_WORDS) or offset // 4 >= MEM_WORDS[region - 2]):
+            raise ValueError("Address {:#010x} is outside of the block RAMs".format(addr))
+        return region,offset // 4
+
+    def _update(self):
+        #Makes a finished shot visible
+        if self._pending is not None and time.time() >= self._pending_time:
+            for k,data in enumerate(self._pending):
+                n = min(len(data),MEM_WORDS[k])
+                self._mem[k][:n] = data[:n]
+                self._counts[k] = n
+            self._pending = None
+            self.shots += 1
+
+    def read(self,addr):
+        region,idx = self._check_addr(addr)
+        with self._lock:
+            self._update()
+            if region == 0:
+                #The trigger register is cleared by the bus after each write
+                return 0 if addr == 0 else self._params[addr]
+            elif region == 1:
+                return self._counts[idx]
+            return self._mem[region - 2][idx]
+
+    def write(self,addr,value):
+        region,idx = self._check_addr(addr)
+        if region != 0:
+            raise ValueError("Address {:#010x} is read-only".format(addr))
+        value &= 0xFFFFFFFF
+        with self._lock:
+            self._update()
+            if addr == 0:
+                #Writing the trigger register resets the memories, and bit 0 starts a shot
+                self._counts = [0]*len(MEM_WORDS)
+                self._pending = None
+                if value & 1:
+                    self.start()
+            else:
+                self._params[addr] = value
+
+    def view_block(self,addr,num):
+        #Like the memory map, the view shows the block RAM as it is changed by later shots
+        region,idx = self._check_addr(addr)
+        if region < 2 or num < 0 or idx + num > MEM_WORDS[region - 2]:
+            raise ValueError("Cannot read {} words from address {:#010x}".format(num,addr))
+        with self._lock:
+            self._update()
+        return memoryview(self._mem[region - 2])[idx:idx + num].cast("B")
+
+    def read_block(self,addr,num):
+        data = array.array("I")
+        data.frombytes(self.view_block(addr,num))
+        return data
+
+    def close(self):
+        pass
+
+    def field(self,name):
+        return registermap.get_field(name,self._params[registermap.ADDR[registermap.INDEX[name]]])
+
+    def chain_parameters(self):
+        #Signal chain parameters from the registers
+        return fpgamodel.ChainParameters(
+            log2Avgs=self.field("log2Avgs"),
+            samplesPerPulse=self.field("samplesPerPulse"),
+            sumStart=self.field("sumStart"),
+            subStart=self.field("subStart"),
+            width=self.field("sumWidth"),
+            offsets=(self.field("offsets0"),self.field("offsets1")),
+            usePresetOffsets=bool(self.field("usePresetOffsets")),
+            useFixedAux=bool(self.field("useFixedAux")),
+            fixedAux=(self.field("fixedAux0"),self.field("fixedAux1")))
+
+    def start(self):
+        #Generates the data for a shot using the current parameters. Called with the lock held
+        if not self.field("enableDP"):
+            return
+        pulses = self.field("numpulses")
+        period = self.field("period")
+        params = self.chain_parameters()
+        if pulses == 0 or params.samplesPerPulse == 0:
+            return
+        adc_signal = self.adc_data(pulses,params,self.field("delaySignal"),1)
+        adc_aux = None if params.useFixedAux else self.adc_data(pulses,params,self.field("delayAux"),0.5)
+        raw_signal,raw_aux = fpgamodel.quick_avg(adc_signal,params.log2Avgs,params.samplesPerPulse),None
+        if adc_aux is not None:
+            raw_aux = fpgamodel.quick_avg(adc_aux,params.log2Avgs,params.samplesPerPulse)
+        data = [fpgamodel.to_words(raw_signal),np.zeros(0,dtype="<u4"),
+                np.zeros(0,dtype="<u4") if raw_aux is None else fpgamodel.to_words(raw_aux),
+                np.zeros(0,dtype="<u4"),np.zeros(0,dtype="<u4")]
+        try:
+            signal,aux,ratio = fpgamodel.process_raw(raw_signal,params,raw_aux)
+        except ValueError:
+            #The integration windows do not fit in a pulse, so the FPGA produces no processed data
+            pass
+        else:
+            data[1] = fpgamodel.to_words(signal)
+            if aux is not None:
+                data[3] = fpgamodel.to_words(aux)
+            data[4] = fpgamodel.ratio_to_words(ratio)
+        self._pending = []
+        for d in data:
+            words = array.array("I")
+            words.frombytes(d.tobytes())
+            self._pending.append(words)
+        self._pending_time = time.time() + (pulses*period + SHUTTER_HOLDOFF)/CLK
+
+    def adc_data(self,pulses,params,delay,scale):
+        #Synthetic ADC traces of size (pulses, samples, 2) starting 'delay' cycles after each
+        #pulse starts. The light is on for the pulse width, and the signal on the first channel
+        #decays from pulse to pulse
+        n = fpgamodel.num_avgs(params.log2Avgs)*params.samplesPerPulse if params.log2Avgs > 0 else params.samplesPerPulse
+        t = delay + np.arange(n)
+        on = (t < self.field("width")).astype(float)
+        decay = 0.5 + 0.5*np.exp(-np.arange(pulses)/self.decay)
+        amp = scale*self.amplitude*np.stack((np.outer(decay,on),np.outer(np.full(pulses,0.7),on)),axis=-1)
+        adc = np.rint(amp + self.rng.normal(0,self.noise,amp.shape))
+        return np.clip(adc,-2**13,2**13 - 1).astype(np.int16)
@@ -0,0 +1,37 @@
+import os
+import sys
+import time
+import socket
+import subprocess
+
+#
+# Servers with a simulated device for the round-trip tests
+#
+SOFTWARE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_server(script,options,log):
+    #Starts a server with a simulated device on a free port and waits until it accepts connections
+    port = free_port()
+    proc = subprocess.Popen([sys.executable,script,"--simulate","--host","127.0.0.1","--port",format(port)] + options,
+                            cwd=SOFTWARE,stdout=log,stderr=log)
+    for n in range(100):
+        try:
+            socket.create_connection(("127.0.0.1",port)).close()
+            return proc,port
+        except OSError:
+            if proc.poll() is not None:
+                raise RuntimeError("Server exited with code {}".format(proc.returncode))
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("Server did not start")
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1",0))
+        return s.getsockname()[1]
+
+def server_errors(log):
+    #Lines of a server log that report an error
+    with open(log) as f:
+        return [line for line in f if " ERROR " in line or "Traceback" in line]
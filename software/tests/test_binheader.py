@@ -0,0 +1,40 @@
+import json
+
+import pytest
+
+import binheader
+
+
+def test_request():
+    msg = binheader.pack_request(binheader.OPCODES["fetch data"],3,binheader.FLAG_KEEP_ALIVE,4,100,7)
+    assert binheader.PROTO.unpack(msg[:2]) == (binheader.MAGIC,)
+    assert len(msg) == 2 + binheader.REQUEST.size == 18
+    assert binheader.REQUEST.unpack(msg[2:]) == (5,binheader.FLAG_KEEP_ALIVE,4,3,100,7)
+
+def test_reply():
+    msg = binheader.pack_reply(1,4,binheader.FLAG_ERROR,0xFFFFFFFF)
+    assert len(msg) == 2 + binheader.REPLY.size == 14
+    assert binheader.REPLY.unpack(msg[2:]) == (1,binheader.FLAG_ERROR,4,0xFFFFFFFF)
+
+def test_opcodes():
+    assert all(binheader.MODES[op] == mode for mode,op in binheader.OPCODES.items())
+    assert 0 not in binheader.MODES
+
+def test_json_frame():
+    tmp = json.dumps({"mode":"read"}).encode('ascii')
+    assert binheader.json_frame(tmp) == binheader.PROTO.pack(len(tmp)) + tmp
+    #The longest header that cannot be mistaken for MAGIC
+    tmp = b"{" + b" "*(binheader.MAGIC - 3) + b"}"
+    assert binheader.PROTO.unpack(binheader.json_frame(tmp)[:2]) == (binheader.MAGIC - 1,)
+    with pytest.raises(ValueError):
+        binheader.json_frame(tmp + b" ")
+
+def test_client_encoding():
+    dpclient = pytest.importorskip("dpclient")
+    msg = dpclient.encode_binary_request({"mode":"write","keepAlive":True},[0x24,5],9)
+    assert binheader.REQUEST.unpack(msg[2:2 + binheader.REQUEST.size]) == (2,binheader.FLAG_KEEP_ALIVE,0,2,0,9)
+    assert msg[2 + binheader.REQUEST.size:] == b"\x24\x00\x00\x00\x05\x00\x00\x00"
+    assert dpclient.encode_binary_request({"mode":"read","encoding":"zlib"},[0x24]) is None
+    assert dpclient.encode_binary_request({"mode":"history"}) is None
+    header = dpclient.binary_reply_header(binheader.pack_reply(1,5,binheader.FLAG_ERROR,3)[2:])
+    assert dpclient.finish_binary_reply(header,b"Oops!") == {"err":True,"errMsg":"Oops!","length":5,"opcode":1,"id":3}
@@ -0,0 +1,69 @@
+import random
+import struct
+
+import pytest
+
+import codec
+
+ENCODINGS = ["zlib","bz2","lzma","zlib+delta","zlib+shuffle","zlib+delta+shuffle","lzma+shuffle+delta"]
+LAYOUTS = [codec.layout(k) for k in range(5)]
+
+
+@pytest.fixture(params=["numpy","python"])
+def filters(request,monkeypatch):
+    #Runs a test with the NumPy filters and with the plain Python ones
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(codec,"np",None)
+    return request.param
+
+def sample(n,extra=0):
+    #Slowly varying 16-bit values that overflow when differenced, and a few extra bytes
+    rng = random.Random(n)
+    values = [int(20000*((-1)**(k // 50))) + rng.randrange(-300,300) for k in range(n)]
+    values = [((v + 32768) & 0xFFFF) - 32768 for v in values]
+    return struct.pack("<%dh" % n,*values) + bytes(range(extra))
+
+
+@pytest.mark.parametrize("encoding",ENCODINGS)
+@pytest.mark.parametrize("size,stride",LAYOUTS)
+def test_round_trip(filters,encoding,size,stride):
+    for data in (sample(1000),sample(1001,1),sample(3,3),b""):
+        encoded = codec.encode(data,encoding,size,stride)
+        assert codec.decode(encoded,encoding,size,stride) == data
+
+def test_filters(filters):
+    data = struct.pack("<5h",1,2,-32768,32767,5) + b"\x07"
+    assert codec.delta(data,2,1) == struct.pack("<5h",1,1,32766,-1,-32762) + b"\x07"
+    assert codec.delta(data,2,2) == struct.pack("<5h",1,2,-32769 + 65536,32765,32773 - 65536) + b"\x07"
+    assert codec.undelta(codec.delta(data,2,2),2,2) == data
+    assert codec.shuffle(b"abcdefg",2) == b"acebdfg"
+    assert codec.unshuffle(b"acebdfg",2) == b"abcdefg"
+
+def test_same_bytes(monkeypatch):
+    #Data encoded with NumPy can be decoded without it and the other way round
+    pytest.importorskip("numpy")
+    data = sample(999,2)
+    encoded = codec.encode(data,"zlib+delta+shuffle",4,2)
+    monkeypatch.setattr(codec,"np",None)
+    assert codec.encode(data,"zlib+delta+shuffle",4,2) == encoded
+    assert codec.decode(encoded,"zlib+delta+shuffle",4,2) == data
+
+def test_levels():
+    data = sample(1000)
+    assert len(codec.encode(data,"zlib",level=9)) <= len(codec.encode(data,"zlib",level=1)) < len(codec.encode(data,"zlib",level=0))
+
+@pytest.mark.parametrize("encoding,level",[
+    ("gzip",None),
+    ("zlib+zlib",None),
+    ("zlib+delta+delta",None),
+    ("delta",None),
+    ("",None),
+    (None,None),
+    ("zlib",10),
+    ("bz2",0),
+])
+def test_check(encoding,level):
+    with pytest.raises(ValueError):
+        codec.check(encoding,level)
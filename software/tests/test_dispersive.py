@@ -0,0 +1,166 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),"simulation"))
+
+import dispersive
+
+#
+# Settings of calculateNSensitivity.m on a smaller grid, with an aperture that cuts off the
+# outer part of the beam
+#
+R = np.linspace(0,1000e-6,200)
+N = np.array([1e4,1e6,1e7])
+WAISTS = np.array([400,100,25])*1e-6
+POWER = 100e-6
+FMOD = 2*np.pi*4e9
+SBFRAC = 0.05
+DETUNING = 2*np.pi*2000e6
+GAMMA = 2*np.pi*6e6
+WAVELENGTH = 780e-9
+APERTURE = 800e-6
+
+
+def trapz(y):
+    #MATLAB's trapz(y), with unit spacing
+    return np.sum((y[1:] + y[:-1])/2)
+
+
+class MatlabDispersiveMod:
+    #Direct transcription of dispersivemod.m, for one set of parameters
+    def __init__(self,waist,power,fmod,sbfrac,detuning,gamma,wavelength,aperture=np.inf):
+        self.waist = waist
+        self.power = power
+        self.fmod = fmod
+        self.sbfrac = sbfrac
+        self.detuning = detuning
+        self.gamma = gamma
+        self.k = 2*np.pi/wavelength
+        self.aperture = aperture
+
+    def intensity(self,r):
+        return 2*self.power/(np.pi*self.waist**2)*np.exp(-2*(r**2)/self.waist**2)
+
+    def saturation(self,r):
+        return self.intensity(r)/self.gamma*12*np.pi/(dispersive.HBAR*dispersive.C*self.k**3)
+
+    def excitedpop(self,r):
+        s = self.saturation(r)
+        sb = self.sbfrac*s
+        return (0.5*sb/(1 + sb*0)/(1 + 4*self.detuning**2/self.gamma**2 + sb*0)
+                + 0.5*s/(1 + s*0)/(1 + 4*(self.detuning + self.fmod)**2/self.gamma**2 + s*0)
+                + 0.5*sb/(1 + sb*0)/(1 + 4*(self.detuning + 2*self.fmod)**2/self.gamma**2 + sb*0))
+
+    def prepOverlap(self,r,n,order):
+        susc = -n*(3*np.pi/self.k**3*self.gamma)/(self.detuning + order*self.fmod + 1j*self.gamma/2)
+        return susc,r < self.aperture
+
+    def overlaps(self,r,n):
+        suscR,mask = self.prepOverlap(r,n,0)
+        suscC,_ = self.prepOverlap(r,n,1)
+        suscB,_ = self.prepOverlap(r,n,2)
+        dr = r[1] - r[0]
+        Sred = np.sqrt(self.sbfrac)*2*np.pi*dr*trapz(r*np.exp(1j*self.k/2*(suscR + suscC))*self.intensity(r)*mask)
+        Sblue = np.sqrt(self.sbfrac)*2*np.pi*dr*trapz(r*np.exp(1j*self.k/2*(suscB + suscC))*self.intensity(r)*mask)
+        return suscR,suscC,suscB,mask,Sred,Sblue
+
+    def signal(self,r,n):
+        Sred,Sblue = self.overlaps(r,n)[-2:]
+        I = np.abs(Sred)*np.cos(np.angle(Sred)) - np.abs(Sblue)*np.cos(np.angle(Sblue))
+        Q = -np.abs(Sred)*np.sin(np.angle(Sred)) + np.abs(Sblue)*np.sin(np.angle(Sblue))
+        return np.abs(Sred - Sblue),I,Q
+
+    def sensN(self,r,n,N):
+        suscR,suscC,suscB,mask,Sred,Sblue = self.overlaps(r,n)
+        dr = r[1] - r[0]
+        dSred = np.sqrt(self.sbfrac)*2*np.pi*dr*trapz(r*1j*self.k/2*(suscR + suscC)/N*np.exp(1j*self.k/2*(suscR + suscC))*self.intensity(r)*mask)
+        dSblue = np.sqrt(self.sbfrac)*2*np.pi*dr*trapz(r*1j*self.k/2*(suscB + suscC)/N*np.exp(1j*self.k/2*(suscB + suscC))*self.intensity(r)*mask)
+        S = np.abs(Sred - Sblue)
+        dS2 = 2*np.real(dSred*np.conj(Sred - Sblue) - dSblue*np.conj(Sred - Sblue))
+        return dS2/(2*S)
+
+    def scattpower(self,r,n):
+        dr = r[1] - r[0]
+        suscR,_ = self.prepOverlap(r,n,0)
+        suscC,_ = self.prepOverlap(r,n,1)
+        suscB,_ = self.prepOverlap(r,n,2)
+        P = (2*np.pi*dr*trapz(r*(self.sbfrac*np.exp(np.real(1j*self.k/2*suscR)) + np.exp(np.real(1j*self.k/2*suscC))
+                                 + self.sbfrac*np.exp(np.real(1j*self.k/2*suscB)))*self.intensity(r))
+             - 2*np.pi*dr*trapz(r*(1 + 2*self.sbfrac)*self.intensity(r)))
+        return -P
+
+
+@pytest.fixture(scope="module")
+def n0():
+    #Thermal cloud at 1 uK in a 160 Hz trap, as in calculateNSensitivity.m
+    s = np.sqrt(dispersive.KB*1e-6/(dispersive.M_RB*(2*np.pi*160)**2))
+    profile = 1/(2*np.pi*s**2)*np.exp(-R**2/(2*s**2))
+    assert np.allclose(dispersive.thermal_profile(R,1e-6,2*np.pi*160),profile,rtol=1e-14,atol=0)
+    return profile
+
+@pytest.fixture(scope="module")
+def reference(n0):
+    #Signal, sensN and scattpower of the transcription on the (N, waist) grid
+    out = dict((q,np.empty((len(N),len(WAISTS)))) for q in dispersive.QUANTITIES)
+    for j,waist in enumerate(WAISTS):
+        dp = MatlabDispersiveMod(waist,POWER,FMOD,SBFRAC,DETUNING,GAMMA,WAVELENGTH,APERTURE)
+        for i,atoms in enumerate(N):
+            out["signal"][i,j] = dp.signal(R,atoms*n0)[0]
+            out["sensN"][i,j] = dp.sensN(R,atoms*n0,atoms)
+            out["scattpower"][i,j] = dp.scattpower(R,atoms*n0)
+    return out
+
+
+def test_grid(n0,reference):
+    #Every grid point is evaluated in one call
+    dp = dispersive.DispersiveMod(WAISTS[None,:],POWER,FMOD,SBFRAC,DETUNING,GAMMA,WAVELENGTH,APERTURE)
+    n = N[:,None,None]*n0
+    result = dp.evaluate(R,n,N[:,None])
+    assert np.allclose(result["signal"],reference["signal"],rtol=1e-12,atol=0)
+    assert np.allclose(result["sensN"],reference["sensN"],rtol=1e-10,atol=0)
+    #The MATLAB form subtracts two nearly equal integrals
+    assert np.allclose(result["scattpower"],reference["scattpower"],rtol=1e-6,atol=0)
+
+def test_methods(n0):
+    ref = MatlabDispersiveMod(WAISTS[1],POWER,FMOD,SBFRAC,DETUNING,GAMMA,WAVELENGTH,APERTURE)
+    dp = dispersive.DispersiveMod(WAISTS[1],POWER,FMOD,SBFRAC,DETUNING,GAMMA,WAVELENGTH,APERTURE)
+    n = 1e6*n0
+    assert np.allclose(dp.intensity(R),ref.intensity(R),rtol=1e-14,atol=0)
+    assert np.allclose(dp.excitedpop(R),ref.excitedpop(R),rtol=1e-12,atol=0)
+    assert np.allclose(dp.scattphotons(R,1e-6),ref.excitedpop(R)*GAMMA*1e-6,rtol=1e-12,atol=0)
+    signal,I,Q = ref.signal(R,n)
+    assert dp.signal(R,n) == pytest.approx(signal,rel=1e-12)
+    assert dp.signal(R,n,iq=True) == (pytest.approx(I,rel=1e-12),pytest.approx(Q,rel=1e-12))
+    assert dp.sensN(R,n,1e6) == pytest.approx(ref.sensN(R,n,1e6),rel=1e-10)
+    with pytest.raises(ValueError):
+        dp.evaluate(R,n,quantities=("sensN",))
+
+@pytest.mark.parametrize("workers,chunk_elements",[(1,dispersive.CHUNK_ELEMENTS),(2,len(R))])
+def test_sweep(n0,reference,workers,chunk_elements):
+    #In one chunk in this process, and one grid point per chunk on two processes
+    result = dispersive.sweep(R,n0,*np.ix_(N,WAISTS),POWER,FMOD,SBFRAC,DETUNING,GAMMA,WAVELENGTH,APERTURE,
+                              workers=workers,chunk_elements=chunk_elements)
+    for q in dispersive.QUANTITIES:
+        assert result[q].shape == (len(N),len(WAISTS))
+        assert np.allclose(result[q],reference[q],rtol=1e-6 if q == "scattpower" else 1e-10,atol=0)
+
+def test_heating_rate(reference):
+    #dT in calculateNSensitivity.m
+    k = 2*np.pi/WAVELENGTH
+    dT = (reference["scattpower"]*dispersive.HBAR*k/(dispersive.M_RB*dispersive.C))/(3*N[:,None]*dispersive.KB)
+    assert np.allclose(dispersive.heating_rate(reference["scattpower"],N[:,None]),dT,rtol=1e-14,atol=0)
+
+def test_example():
+    #calculateNSensitivity.py gives the same values as the MATLAB classes at its corner points
+    import calculateNSensitivity as ex
+    values,dT = ex.calculate(workers=1)
+    assert values["signal"].shape == dT.shape == (len(ex.N),len(ex.WAISTS))
+    n0 = ex.N[-1]*dispersive.thermal_profile(ex.R,ex.T,ex.FREQ)
+    for k in (0,-1):
+        ref = MatlabDispersiveMod(ex.WAISTS[k],ex.POWER,ex.FMOD,ex.SBFRAC,ex.DETUNING,GAMMA,WAVELENGTH,ex.APERTURE)
+        assert values["signal"][-1,k] == pytest.approx(ref.signal(ex.R,n0)[0],rel=1e-10)
+        assert values["sensN"][-1,k] == pytest.approx(ref.sensN(ex.R,n0,ex.N[-1]),rel=1e-10)
@@ -0,0 +1,48 @@
+import json
+import struct
+import asyncio
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import dpclient
+
+
+class FakeClient:
+    def __init__(self):
+        self.writes = []
+
+    def write(self,addr,value):
+        self.writes.append((addr,value))
+
+
+def test_device_trigger():
+    c = FakeClient()
+    dev = dpclient.Device(c)
+    dev.start()
+    dev.reset()
+    assert c.writes == [(dpclient.TRIGGER_ADDR,1),(dpclient.TRIGGER_ADDR,0)]
+
+@pytest.mark.parametrize("reply",[b"",struct.pack("<H",3) + b"abc"],ids=["closed","malformed"])
+def test_async_client_fails_pending(reply):
+    #Requests waiting for a reply fail when the reader stops, as do later requests
+    async def handle(reader,writer):
+        await reader.readexactly(2)
+        writer.write(reply)
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(handle,"127.0.0.1",0)
+        port = server.sockets[0].getsockname()[1]
+        c = dpclient.AsyncClient("127.0.0.1",port)
+        try:
+            with pytest.raises(ConnectionError):
+                await asyncio.wait_for(c.read(0x24),5)
+            with pytest.raises(ConnectionError):
+                await asyncio.wait_for(c.read(0x24),5)
+        finally:
+            await c.close()
+            server.close()
+            await server.wait_closed()
+    asyncio.run(run())
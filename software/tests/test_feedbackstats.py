@@ -0,0 +1,120 @@
+import math
+import array
+import random
+
+import pytest
+
+import acquisition
+import registermap
+import feedbackstats
+
+TARGET = 16384/65535         #0.25 as stored in the register
+
+
+class FakeDevice:
+    #Parameter registers holding the feedback settings
+    def __init__(self,values):
+        self.regs = registermap.pack(values,dict((a,0) for a in registermap.PARAMETER_REGISTERS))
+
+    def read(self,addr):
+        return self.regs[addr]
+
+
+def make_shot(index,ratios):
+    #A shot with only ratio data, given as signed values scaled by 2^15
+    buffers = [None]*5
+    buffers[4] = array.array("I",[r & 0xFFFF for r in ratios])
+    return acquisition.Shot(index,float(index),[0,0,0,0,len(ratios)],buffers)
+
+
+def test_running_stats():
+    rng = random.Random(1)
+    xs = [rng.gauss(3,2) for n in range(1000)]
+    s = feedbackstats.RunningStats()
+    for x in xs:
+        s.add(x)
+    mean = sum(xs)/len(xs)
+    assert s.mean == pytest.approx(mean)
+    assert s.std() == pytest.approx(math.sqrt(sum((x - mean)**2 for x in xs)/(len(xs) - 1)))
+    assert (s.min,s.max) == (min(xs),max(xs))
+
+def test_running_stats_empty():
+    s = feedbackstats.RunningStats()
+    assert s.summary() == {"count":0,"mean":None,"std":None,"min":None,"max":None}
+    s.add(1.0)
+    assert s.std() is None
+
+def test_histogram():
+    h = feedbackstats.Histogram(0,1,4)
+    for x in (-0.5,0,0.3,0.99,1,2):
+        h.add(x)
+    assert h.counts == [1,1,0,1]
+    assert (h.underflow,h.overflow) == (1,2)
+    with pytest.raises(ValueError):
+        feedbackstats.Histogram(1,1,4)
+
+def test_allan_deviation():
+    #Compared with the overlapping Allan deviation computed from the whole record, with enough
+    #samples for the ring buffer to wrap around many times
+    rng = random.Random(2)
+    ys = [rng.gauss(0.5,0.01) + 1e-4*n for n in range(300)]
+    a = feedbackstats.AllanDeviation(8)
+    for y in ys:
+        a.add(y)
+    x = [0.0]
+    for y in ys:
+        x.append(x[-1] + y)
+    taus,adev = a.deviation()
+    assert taus == [1,2,4,8]
+    for m,dev in zip(taus,adev):
+        d = [x[k + 2*m] - 2*x[k + m] + x[k] for k in range(len(x) - 2*m)]
+        assert dev == pytest.approx(math.sqrt(sum(v*v for v in d)/(2*m*m*len(d))))
+
+def test_allan_deviation_short():
+    a = feedbackstats.AllanDeviation(8)
+    a.add(1.0)
+    assert a.summary() == {"tau":[],"adev":[],"terms":[]}
+    a.add(2.0)
+    assert a.deviation() == ([1],[pytest.approx(math.sqrt(0.5))])
+
+def test_ratio_abs():
+    assert feedbackstats.ratio_abs(0x1000) == 0x2000
+    assert feedbackstats.ratio_abs(-0x1000 & 0xFFFF) == 0x2000
+    assert feedbackstats.ratio_abs(0) == 0
+
+def test_follow():
+    #|2*ratio| goes 0x8000, 0x6000, 0x3000 against a target of 0x4000
+    words = [0x4000,0x3000,0x1800,0x1000]
+    stop,mw = feedbackstats.follow(words,0x4000,0,100)
+    assert stop == 2
+    assert mw == (((0x8000 - 0x4000) << 16)//0x8000*100 >> 16) + (((0x6000 - 0x4000) << 16)//0x6000*100 >> 16)
+    assert feedbackstats.follow(words[:2],0x4000,0,100)[0] is None
+    assert feedbackstats.follow(words,0x4000,0x7000,100) == (1,50)
+
+def test_feedback_stats():
+    #|2*ratio| goes 0x6000, 0x3000 against a target of 0x4000 in the first shot, and never
+    #reaches it in the second
+    stats = feedbackstats.FeedbackStats(FakeDevice({"enableFB":1,"target":0.25,"tol":0,"maxMWPulses":100}))
+    stats.add(make_shot(1,[0x3000,0x1800,0x1000]))
+    stats.add(make_shot(2,[0x3000,0x3000]))
+    snap = stats.snapshot()
+    assert (snap["shots"],snap["skipped"],snap["converged"]) == (2,0,1)
+    assert snap["last"] == {"shot":2,"error":pytest.approx(0.375 - TARGET),"mwPulses":66,"pulses":2,
+                            "ratio":0.375,"converged":False}
+    assert snap["error"]["mean"] == pytest.approx((0.1875 + 0.375)/2 - TARGET)
+    assert (snap["mwPulses"]["min"],snap["mwPulses"]["max"]) == (33,66)
+    assert snap["pulses"]["mean"] == 2
+    stats.reset()
+    assert stats.snapshot()["shots"] == 0
+
+def test_feedback_off():
+    stats = feedbackstats.FeedbackStats(FakeDevice({"enableFB":0}))
+    stats.add(make_shot(1,[0x3000]))
+    snap = stats.snapshot()
+    assert (snap["shots"],snap["skipped"],snap["last"]) == (1,1,None)
+
+def test_negative_ratio():
+    #The feedback compares |ratio| with the target, so the sign of the ratio does not matter
+    stats = feedbackstats.FeedbackStats(FakeDevice({"enableFB":1,"target":0.25,"tol":0,"maxMWPulses":100}))
+    stats.add(make_shot(1,[-0x3000,-0x1800]))
+    assert stats.snapshot()["last"]["error"] == pytest.approx(0.1875 - TARGET)
@@ -0,0 +1,75 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import fleet
+import simserver
+
+PULSES = 20
+SHOT = {"enableDP":1,"numpulses":PULSES,"period":20e-6,"width":384e-9,"samplesPerPulse":100,
+        "sumStart":10,"subStart":50,"sumWidth":30}
+
+
+@pytest.fixture(scope="module")
+def addresses(tmp_path_factory):
+    #Two simulated boards
+    procs,addresses = [],[]
+    log = str(tmp_path_factory.mktemp("fleet")/"server.log")
+    with open(log,"w") as f:
+        for n in range(2):
+            proc,port = simserver.start_server("appserver.py",[],f)
+            procs.append(proc)
+            addresses.append("127.0.0.1:{}".format(port))
+    yield addresses
+    for proc in procs:
+        proc.terminate()
+        proc.wait(10)
+
+@pytest.fixture
+def boards(addresses):
+    with fleet.Fleet(addresses) as f:
+        f.set(SHOT)
+        yield f
+
+
+def test_parse_address():
+    assert fleet.parse_address("rp1") == ("rp1",fleet.dpclient.DEFAULT_PORT)
+    assert fleet.parse_address("rp1:6667") == ("rp1",6667)
+    assert fleet.parse_address(("rp1",1)) == ("rp1",1)
+    with pytest.raises(ValueError):
+        fleet.Fleet([])
+
+def test_parameters(boards,addresses):
+    #The same values for every board, or values for each board
+    result = boards.get(["numpulses","sumWidth"])
+    assert list(result) == addresses
+    assert all(v == {"numpulses":PULSES,"sumWidth":30} for v in result.values())
+    assert set(result.latency) == set(addresses)
+    boards.set(dict((name,{"sumWidth":20 + n}) for n,name in enumerate(addresses)))
+    assert [v["sumWidth"] for v in boards.get(["sumWidth"]).values()] == [20,21]
+
+def test_errors(boards,addresses):
+    with pytest.raises(ValueError,match=addresses[0]):
+        boards.broadcast("read",0x00FFFFFC)
+    result = boards.call(lambda name: boards.clients[name].read(0x24 if name == addresses[0] else 0x00FFFFFC),check=False)
+    assert list(result) == addresses[:1]
+    assert list(result.errors) == addresses[1:]
+    with pytest.raises(ValueError):
+        result.check()
+
+def test_shots(boards,addresses):
+    shots = boards.shots(timeout=5)
+    try:
+        boards.start()
+        result = next(shots)
+    finally:
+        shots.close()
+    assert list(result) == addresses
+    assert min(result.latency.values()) == 0
+    assert all(len(buffers[4]) == PULSES for header,buffers in result.values())
+    assert boards.fetch_ratio(PULSES).stack().shape == (2,PULSES)
+    assert boards.fetch_integrated(1,PULSES).stack().shape == (2,PULSES,2)
+
+def test_wait_for_shot(boards):
+    result = boards.wait_for_shot(start=True)
+    assert all(header["counts"][4] == PULSES for header in result.values())
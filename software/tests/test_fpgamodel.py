@@ -0,0 +1,92 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import fpgamodel
+
+#
+# Hand-computed vectors for each stage of the FPGA signal chain
+#
+
+
+## QuickAvg
+def test_quick_avg():
+    adc = np.array([[1,2],[3,4],[5,-6],[7,-8]],dtype=np.int16)
+    assert fpgamodel.quick_avg(adc,1,2).tolist() == [[2,3],[6,-7]]
+    #Shifting rounds towards minus infinity
+    assert fpgamodel.quick_avg(np.array([[-1,1],[-2,2]]),1,1).tolist() == [[-2,1]]
+    #Without averaging the first samples after the trigger are kept
+    assert fpgamodel.quick_avg(adc,0,3).tolist() == [[1,2],[3,4],[5,-6]]
+
+def test_quick_avg_counter_wraps():
+    #The 8 bit counter wraps for log2Avgs = 9, so 256 samples are summed and shifted by 9
+    assert fpgamodel.num_avgs(9) == fpgamodel.num_avgs(8) == 256
+    adc = np.full((256,2),2,dtype=np.int16)
+    assert fpgamodel.quick_avg(adc,9,1).tolist() == [[1,1]]
+    assert fpgamodel.quick_avg(adc,8,1).tolist() == [[2,2]]
+
+def test_quick_avg_too_short():
+    with pytest.raises(ValueError):
+        fpgamodel.quick_avg(np.zeros((7,2),dtype=np.int16),2,2)
+
+
+## IntegrateADCData
+def test_integration_weights():
+    #Both windows include their end points, and the summation window takes priority
+    assert fpgamodel.integration_weights(8,1,3,2).tolist() == [0,1,1,1,-1,-1,0,0]
+    assert fpgamodel.integration_weights(8,1,3,2,use_preset_offsets=True).tolist() == [0,1,1,1,0,0,0,0]
+    with pytest.raises(ValueError):
+        fpgamodel.integration_weights(5,1,3,2)
+
+def test_integrate():
+    #Only bits 13 downto 0 of each sample are used, so 0x2000 is -8192
+    raw = np.stack((np.arange(8),np.full(8,0x2000)),axis=-1)[None]
+    assert fpgamodel.integrate(raw,1,3,2).tolist() == [[1 + 2 + 3 - 4 - 5,-8192]]
+    assert fpgamodel.integrate(raw,1,3,2,(5,-3),True).tolist() == [[6 - 3*5,-3*8192 + 3*3]]
+
+def test_integrate_wraps():
+    #2047 samples of 8191 overflow the 24 bit accumulator
+    raw = np.full((1,2048,2),8191)
+    assert fpgamodel.integrate(raw,0,0,2046,(0,0),True).tolist() == [[2047*8191 - 2**24]*2]
+
+
+## ComputeSignal
+@pytest.mark.parametrize("signal,ratio",[
+    ((3,1),16384),          #2/4
+    ((1,3),-16384),         #-2/4
+    ((3,5),-8192),          #-2/8
+    ((5,-2),10922),         #7/3, only the fraction is kept
+    ((-2,5),-10922),        #-7/3
+    ((5,-3),0),             #8/2
+    ((1,-1),0),             #The sum is zero
+])
+def test_compute_ratio(signal,ratio):
+    assert fpgamodel.compute_ratio(np.array([signal]),np.array([[1,1]])).tolist() == [ratio]
+
+def test_compute_ratio_fixed_aux():
+    #Only the lowest 24 bits of the fixed values are used
+    signal = np.array([[3,1]])
+    assert fpgamodel.compute_ratio(signal,fixed_aux=(1,1 + 2**24)).tolist() == [16384]
+    assert fpgamodel.compute_sum_diff(signal,np.array([[2,5]])) == (17,13)
+
+
+## Block RAM words
+def test_words():
+    assert fpgamodel.to_words(np.array([[[1,-1]]],dtype=np.int16)).tolist() == [0xFFFF0001]
+    assert fpgamodel.to_words(np.array([[-2,3]],dtype=np.int32)).tolist() == [0xFFFFFFFE,3]
+    assert fpgamodel.ratio_to_words([-1,2]).tolist() == [0xFFFF,2]
+
+def test_process_raw():
+    params = fpgamodel.ChainParameters(samplesPerPulse=8,sumStart=1,subStart=3,width=2)
+    raw_signal = np.stack((np.arange(8),np.full(8,1)),axis=-1)[None]
+    raw_aux = np.stack((np.full(8,1),np.full(8,1)),axis=-1)[None]
+    signal,aux,ratio = fpgamodel.process_raw(raw_signal,params,raw_aux)
+    assert (signal.tolist(),aux.tolist()) == ([[-3,1]],[[1,1]])
+    #(-3 - 1)/(-3 + 1) = 2 has no fractional part
+    assert ratio.tolist() == [0]
+    with pytest.raises(ValueError):
+        fpgamodel.process_raw(raw_signal,params)
+    params.useFixedAux,params.fixedAux = True,(1,3)
+    signal,aux,ratio = fpgamodel.process_raw(raw_signal,params)
+    #(-9 - 1)/(-9 + 1) = 1.25
+    assert aux is None and ratio.tolist() == [8192]
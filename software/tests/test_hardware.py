@@ -0,0 +1,49 @@
+import mmap
+
+import pytest
+
+import hardware
+
+
+@pytest.fixture
+def image(tmp_path):
+    filename = str(tmp_path/"mem.bin")
+    hardware.create_image(filename)
+    return filename
+
+
+def test_memory_device(image):
+    dev = hardware.MemoryDevice(image,0)
+    try:
+        dev.write(0x24,0x123456789)
+        assert dev.read(0x24) == 0x23456789
+        dev.write(hardware.FETCH_ADDR[4] + 8,7)
+        assert list(dev.read_block(hardware.FETCH_ADDR[4],3)) == [0,0,7]
+        assert bytes(dev.view_block(hardware.FETCH_ADDR[4] + 8,1)) == b"\x07\x00\x00\x00"
+        for addr in (0x26,0x00FFFFFC,0x07000000):
+            with pytest.raises(ValueError):
+                dev.read(addr)
+        with pytest.raises(ValueError):
+            dev.read_block(hardware.FETCH_ADDR[4],hardware.MAP_SIZE)
+    finally:
+        dev.close()
+
+def test_short_file(tmp_path):
+    #All regions are mapped when the device is opened
+    filename = str(tmp_path/"short.bin")
+    hardware.create_image(filename,regions=3)
+    with pytest.raises(OSError):
+        hardware.MemoryDevice(filename,0)
+
+def test_fallback(monkeypatch,image):
+    #/dev/mem can be opened but not mapped, as without the FPGA bitstream loaded
+    real_open = hardware.os.open
+    monkeypatch.setattr(hardware.os,"open",lambda filename,flags: real_open(image,flags))
+    def fail(*args,**kw):
+        raise OSError("Operation not permitted")
+    monkeypatch.setattr(mmap,"mmap",fail)
+    monkeypatch.setattr(hardware,"_device",None)
+    try:
+        assert isinstance(hardware.open_device(),hardware.MonitorDevice)
+    finally:
+        hardware.close_device()
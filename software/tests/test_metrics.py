@@ -0,0 +1,31 @@
+import metrics
+
+
+def test_unknown_modes():
+    m = metrics.Metrics()
+    m.request("read")
+    m.request("nope",True)
+    m.request(["nope"])
+    m.observe("parse","nope2",1e-3)
+    snap = m.snapshot()
+    assert snap["requests"] == {"read":1,"unknown":2}
+    assert snap["errors"] == {"unknown":1}
+    assert list(snap["latency"]) == ["unknown"]
+
+def test_escape():
+    assert metrics.escape('a"b\\c\nd') == 'a\\"b\\\\c\\nd'
+    m = metrics.Metrics()
+    m.request("read")
+    assert 'dpfeedback_requests_total{mode="read"} 1' in m.prometheus().splitlines()
+
+def test_disabled():
+    m = metrics.Metrics()
+    m.enabled = False
+    m.request("read")
+    m.observe("parse","read",1e-3)
+    m.received(10)
+    m.sent(10)
+    m.opened()
+    snap = m.snapshot()
+    assert (snap["requests"],snap["latency"],snap["bytesIn"],snap["bytesOut"]) == ({},{},0,0)
+    assert snap["activeConnections"] == 1
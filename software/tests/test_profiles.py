@@ -0,0 +1,47 @@
+import pytest
+
+import profiles
+import registermap
+
+NUMPULSES_ADDR = registermap.ADDR[registermap.index("numpulses")]
+
+
+def blank():
+    return dict((a,0) for a in registermap.PARAMETER_REGISTERS)
+
+
+def test_build():
+    regs = profiles.build(blank(),{0x24:5},{"numpulses":7})
+    assert regs[0x24] == 5
+    assert registermap.decode("numpulses",regs[NUMPULSES_ADDR]) == 7
+    assert profiles.diff(regs,blank()) == sorted([0x24,NUMPULSES_ADDR])
+    assert profiles.diff(regs,regs) == []
+
+@pytest.mark.parametrize("registers,values",[
+    (None,[1,2]),
+    (None,{"nope":1}),
+    (None,{"pulsesCollected2":1}),
+    ({0x01000000:1},None),
+    ({0x24:-1},None),
+    ({0x24:2**32},None),
+    ({"0x24":1},None),
+])
+def test_build_rejects(registers,values):
+    with pytest.raises(ValueError):
+        profiles.build(blank(),registers,values)
+
+def test_store(tmp_path):
+    filename = str(tmp_path/"profiles.json")
+    store = profiles.ProfileStore(filename)
+    store.save("a",profiles.build(blank(),values={"numpulses":3}))
+    with pytest.raises(ValueError):
+        store.save("b",{0x24:1})
+    with pytest.raises(ValueError):
+        store.save("",blank())
+    reloaded = profiles.ProfileStore(filename)
+    assert reloaded.names() == ["a"]
+    assert reloaded.get("a") == store.get("a")
+    reloaded.delete("a")
+    assert "a" not in profiles.ProfileStore(filename)
+    with pytest.raises(ValueError):
+        reloaded.get("a")
@@ -0,0 +1,133 @@
+import pytest
+
+import hardware
+import RedPitaya
+
+
+class FakeDevice:
+    #Registers in a dict, with a log of the accesses that reach the device
+    def __init__(self,values=None):
+        self.values = dict(values or {})
+        self.reads = []
+        self.writes = []
+
+    def read(self,addr):
+        if addr >= 0x01000000:
+            raise ValueError("Bus error")
+        self.reads.append(addr)
+        return self.values.get(addr,0)
+
+    def write(self,addr,value):
+        if addr >= 0x01000000:
+            raise ValueError("Bus error")
+        self.writes.append((addr,value))
+        self.values[addr] = value
+
+
+@pytest.fixture
+def dev(monkeypatch):
+    dev = FakeDevice({0x08:0x12345678,0x24:7})
+    monkeypatch.setattr(hardware,"_device",dev)
+    return dev
+
+
+def test_read_cached(dev):
+    regs = RedPitaya.RegisterFile()
+    assert regs.read(0x08) == 0x12345678
+    dev.values[0x08] = 1
+    assert regs.read(0x08) == 0x12345678
+    assert dev.reads == [0x08]
+    regs.sync()
+    assert regs.read(0x08) == 1
+    regs.invalidate(0x08)
+    regs.read(0x08)
+    assert dev.reads == [0x08,0x08,0x08]
+
+def test_write_through(dev):
+    regs = RedPitaya.RegisterFile()
+    regs.write(0x24,-1)
+    assert dev.writes == [(0x24,0xFFFFFFFF)]
+    assert not regs.isDirty(0x24)
+    assert regs.read(0x24) == 0xFFFFFFFF
+    assert dev.reads == []
+
+def test_deferred(dev):
+    #Each changed word is written once, when the block ends
+    regs = RedPitaya.RegisterFile()
+    with regs.deferred():
+        regs.write(0x24,1)
+        regs.write(0x08,2)
+        regs.write(0x24,3)
+        assert dev.writes == []
+        assert regs.isDirty(0x24)
+    assert dev.writes == [(0x08,2),(0x24,3)]
+    assert regs.autoFlush
+    regs.write(0x24,4)
+    assert dev.writes[-1] == (0x24,4)
+
+def test_no_auto_flush(dev):
+    regs = RedPitaya.RegisterFile(autoFlush=False)
+    regs.write(0x24,1)
+    regs.write(0x08,2)
+    regs.flush(0x24)
+    assert dev.writes == [(0x24,1)]
+    regs.invalidate()
+    regs.flush()
+    assert dev.writes == [(0x24,1)]
+    assert regs.read(0x08) == 0x12345678
+
+def test_volatile(dev):
+    regs = RedPitaya.RegisterFile()
+    regs.markVolatile(0x00)
+    with regs.deferred():
+        regs.write(0x00,1)
+        assert dev.writes == [(0x00,1)]
+    regs.read(0x00)
+    regs.read(0x00)
+    assert dev.reads == [0x00,0x00]
+
+def test_device_errors(dev):
+    regs = RedPitaya.RegisterFile()
+    with pytest.raises(ValueError,match="0x41000000"):
+        regs.read(0x01000000)
+    with pytest.raises(ValueError,match="0x41000000"):
+        regs.write(0x01000000,1)
+
+def test_parameters_share_registers(dev):
+    #Two fields of one register are combined into a single write
+    regs = RedPitaya.RegisterFile()
+    low = RedPitaya.Parameter(0x24,[0,10],regs)
+    high = RedPitaya.Parameter(0x24,[11,21],regs)
+    with regs.deferred():
+        low.value = 10
+        high.value = 150
+    assert dev.writes == [(0x24,10 | (150 << 11))]
+    assert (low.value,high.value) == (10,150)
+    assert dev.reads == [0x24]
+
+def test_parameter_defaults(dev):
+    #A parameter made without a register file still reads volatile registers every time
+    trig = RedPitaya.Parameter.fromMap("pulseTrig")
+    trig.value
+    trig.value
+    assert dev.reads == [0x00,0x00]
+    numpulses = RedPitaya.Parameter.fromMap("numpulses")
+    numpulses.value
+    numpulses.value
+    assert dev.reads == [0x00,0x00,0x08]
+
+def test_configuration(dev):
+    cfg = RedPitaya.Configuration()
+    cfg.set("numpulses",100)
+    assert dev.values[0x08] == (100 << 16) | 0x5678
+    assert cfg.get("numpulses") == 100
+    #Values that do not fit are truncated with a warning
+    with pytest.warns(UserWarning):
+        cfg.set("numpulses",2**16 + 1)
+    assert cfg.get("numpulses") == 1
+    with pytest.raises(ValueError):
+        cfg.set("pulsesCollected2",1)
+    #The trigger is never cached
+    cfg.pulseTrig()
+    cfg.pulseTrig()
+    assert dev.writes[-2:] == [(0x00,1),(0x00,1)]
@@ -0,0 +1,77 @@
+import pytest
+
+import registermap
+
+#
+# The values set by DPFeedback.setDefaults, and the words that DPFeedback.m writes for them.
+# tol is a register value here, DPFeedback.m computes it as (1 + 0.05)*target*(2^16 - 1)
+#
+DEFAULTS = {"enableDP":1,"enableFB":0,"useFixedAux":0,"width":1e-6,"numpulses":50,"period":5e-6,
+            "shutterDelay":2.5e-3,"auxDelay":2.5e-3,"useAdditionalPulses":0,"additionalPulses":5,
+            "delayAux":1.75e-6,"samplesPerPulse":250,"log2Avgs":0,"sumStart":10,"subStart":150,
+            "sumWidth":50,"offsets0":0,"offsets1":0,"usePresetOffsets":0,"fixedAux0":1,"fixedAux1":1,
+            "maxMWPulses":5000,"tol":6881,"mwNumPulses":1000,"mwPulseWidth":2e-6,"mwPulsePeriod":50e-6}
+WORDS = {0x04:1,0x08:(50 << 16) | 125,0x0C:625,0x10:312500,0x14:312500,0x18:5,0x1C:250 << 14,
+         0x20:219,0x24:10 | (150 << 11) | (50 << 22),0x28:0,0x2C:1,0x30:1,0x34:5000,0x38:6881,
+         0x3C:250 | (1000 << 16),0x40:6250}
+
+
+def blank():
+    return dict((a,0) for a in registermap.PARAMETER_REGISTERS)
+
+
+def test_defaults():
+    regs = registermap.pack(DEFAULTS,blank())
+    assert regs == WORDS
+    values = registermap.unpack(DEFAULTS,regs)
+    assert values["delayAux"] == 219/registermap.CLK
+    del values["delayAux"]
+    assert values == dict((n,pytest.approx(v)) for n,v in DEFAULTS.items() if n != "delayAux")
+
+def test_ties():
+    #DPFeedback.m rounds half away from zero: 500 ns is 62.5 clock cycles and 0.1 is 6553.5/65535
+    regs = registermap.pack({"delaySignal":500e-9,"samplesPerPulse":250,"target":0.1,"maxMWPulses":5000},blank())
+    assert regs[0x1C] == 63 | (250 << 14)
+    assert regs[0x34] == 5000 | (6554 << 16)
+    assert registermap.encode("offsets0",-2.5) == -3 & 0x3FFF
+    assert [registermap.decode("pulsesCollected0",x) for x in (0,1,4,5)] == [0,1,2,3]
+
+def test_fields_do_not_overlap():
+    for addr in registermap.REGISTERS:
+        used = 0
+        for k in range(len(registermap.NAMES)):
+            if registermap.ADDR[k] == addr:
+                bits = registermap.MASK[k] << registermap.SHIFT[k]
+                assert used & bits == 0
+                used |= bits
+        assert used <= 0xFFFFFFFF
+
+def test_tables():
+    assert registermap.registers_for(["sumWidth","numpulses","sumStart"]) == [0x08,0x24]
+    assert 0x00 in registermap.VOLATILE and 0x00 not in registermap.PARAMETER_REGISTERS
+    assert registermap.READONLY == frozenset(range(0x01000000,0x01000014,4))
+    assert registermap.PARAMETER_REGISTERS == tuple(range(0x04,0x44,4))
+
+def test_fields():
+    reg = registermap.set_field("subStart",150,0xFFFFFFFF)
+    assert reg == 0xFFFFFFFF & ~(0x7FF << 11) | (150 << 11)
+    assert registermap.get_field("subStart",reg) == 150
+    with pytest.raises(ValueError):
+        registermap.set_field("subStart",2048)
+    with pytest.raises(ValueError):
+        registermap.set_field("subStart",-1)
+
+def test_signed():
+    reg = registermap.encode("offsets0",-1,registermap.encode("offsets1",-8192))
+    assert reg == 0x3FFF | (0x2000 << 14)
+    assert registermap.decode("offsets0",reg) == -1
+    assert registermap.decode("offsets1",reg) == -8192
+    assert registermap.decode("offsets0",8191) == 8191
+
+def test_rejects():
+    with pytest.raises(ValueError):
+        registermap.index("nope")
+    with pytest.raises(ValueError):
+        registermap.pack({"pulsesCollected2":1},{0x01000010:0})
+    with pytest.raises(ValueError):
+        registermap.encode("numpulses",2**16)
@@ -0,0 +1,79 @@
+import pytest
+
+import hardware
+import appcontroller
+import sequencer
+
+
+class FakeDevice:
+    def __init__(self):
+        self.values = {}
+
+    def read(self,addr):
+        return self.values.get(addr,0)
+
+    def write(self,addr,value):
+        self.values[addr] = value
+
+
+class FakeWatcher:
+    #Records what a sequence registers, and how often it is woken
+    def __init__(self):
+        self.woken = 0
+        self.listeners = []
+        self.pollers = []
+
+    def add_listener(self,fn,raw=False):
+        self.listeners.append(fn)
+
+    def remove_listener(self,fn,raw=False):
+        self.listeners.remove(fn)
+
+    def add_poller(self,fn):
+        self.pollers.append(fn)
+
+    def remove_poller(self,fn):
+        self.pollers.remove(fn)
+
+    def wake(self):
+        self.woken += 1
+
+
+@pytest.fixture
+def watcher(monkeypatch):
+    monkeypatch.setattr(hardware,"_device",FakeDevice())
+    watcher = FakeWatcher()
+    monkeypatch.setattr(appcontroller,"_watcher",watcher)
+    return watcher
+
+
+def test_trigger_wakes_watcher(watcher):
+    sent = []
+    seq = sequencer.Sequence([{"op":"write","addr":0x24,"values":[5,6]},{"op":"write","addr":appcontroller.TRIGGER_ADDR,"value":1},
+                              {"op":"read","addr":[0x24]}],send=sent.append)
+    seq.start(watcher)
+    seq.on_poll(0)
+    assert watcher.woken == 2
+    assert [r["done"] for r in sent] == [False,True]
+    assert list(sent[-1]["data"]) == [6]
+    assert watcher.pollers == []
+
+@pytest.mark.parametrize("step",[
+    {"op":"write","addr":"0x24","value":1},
+    {"op":"write","addr":0x24,"value":"1"},
+    {"op":"write","addr":0x24,"value":-1},
+    {"op":"write","addr":0x24,"values":5},
+    {"op":"write","addr":0x24,"values":[1,None]},
+    {"op":"write","addr":0x24,"value":1,"mask":"1"},
+    {"op":"read","addr":[]},
+    {"op":"read","addr":[0x24,"0x28"]},
+    {"op":"wait","timeout":"5"},
+    {"op":"fetch","fetchType":4,"numFetch":"10"},
+])
+def test_rejects(step):
+    with pytest.raises(ValueError):
+        sequencer.Sequence([step])
+
+def test_rejects_iterations():
+    with pytest.raises(ValueError):
+        sequencer.Sequence([{"op":"read","addr":0x24}],"2")
@@ -0,0 +1,298 @@
+import os
+import time
+import select
+import asyncio
+import socket
+import threading
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import binheader
+import dpclient
+import simserver
+
+#
+# Round trips through appserver.py and appserver_async.py with a simulated device. Each server
+# is started once for the module, and its output is kept so that errors logged by the server
+# fail the tests
+#
+SERVERS = ["appserver.py","appserver_async.py"]
+TRIGGER_ADDR = 0x00
+REGISTER_ADDR = 0x24        #integrateRegs(0), as in benchmark.py
+PULSES = 50
+#The light is on for the first 48 samples of each pulse, which covers the summation window
+SHOT = {"enableDP":1,"numpulses":PULSES,"period":20e-6,"width":384e-9,"samplesPerPulse":100,"log2Avgs":0,
+        "sumStart":10,"subStart":50,"sumWidth":30}
+DECAY = 200                 #Pulses over which the simulated signal decays, see simulator.SimulatedDevice
+
+
+@pytest.fixture(scope="module",params=SERVERS)
+def server(request,tmp_path_factory):
+    #Returns (port, log file) of a running server
+    tmp = tmp_path_factory.mktemp(os.path.splitext(request.param)[0])
+    log = str(tmp/"server.log")
+    options = ["--history-shots","20"]
+    options += ["--profiles",str(tmp/"profiles.json")]
+    options += ["--feedback-stats"]
+    with open(log,"w") as f:
+        proc,port = simserver.start_server(request.param,options,f)
+    yield port,log
+    proc.terminate()
+    proc.wait(10)
+
+@pytest.fixture(params=[False,True],ids=["json","binary"])
+def client(request,server):
+    c = dpclient.Client("127.0.0.1",server[0],binary=request.param)
+    dpclient.Device(c).set(SHOT)
+    yield c
+    c.close()
+    assert simserver.server_errors(server[1]) == []
+
+
+def take_shot(client):
+    #Starts a shot and waits until the server has found it
+    return client.wait_for_shot(start=True)
+
+
+## Registers and memory
+def test_read_write(client):
+    client.write(REGISTER_ADDR,1234)
+    assert client.read(REGISTER_ADDR) == 1234
+
+def test_batches(client):
+    addrs = [REGISTER_ADDR,REGISTER_ADDR + 4]
+    client.write_batch(addrs,[11,22])
+    assert list(client.read_batch(addrs)) == [11,22]
+
+def test_parameters(client):
+    dev = dpclient.Device(client)
+    assert dev.get(["numpulses","period"]) == {"numpulses":PULSES,"period":pytest.approx(20e-6)}
+    dev.sumWidth = 31
+    assert dev.sumWidth == 31 and dev.sumStart == 10
+    with pytest.raises(ValueError):
+        dev.set({"numpulses":2**16})
+
+def test_fetch(client):
+    header = take_shot(client)
+    assert header["counts"][4] == PULSES
+    assert len(client.fetch(4,PULSES)) == PULSES
+    assert len(client.fetch(1,2*PULSES,encoding="zlib")) == 2*PULSES
+    assert np.array_equal(client.fetch(0,1000,encoding="zlib+delta+shuffle"),client.fetch(0,1000))
+
+def test_read_error(client):
+    with pytest.raises(ValueError):
+        client.read(0x00FFFFFC)
+
+@pytest.mark.parametrize("header,data",[
+    ({"mode":"read"},[]),
+    ({"mode":"write"},[REGISTER_ADDR]),
+    ({"mode":"fetch data","fetchType":"4","numFetch":10},[]),
+    ({"mode":"history","maxShots":"2"},[]),
+    ({"mode":"history","since":[1]},[]),
+    ({"mode":"find transition","start":"100"},[]),
+    ({"mode":"find transition","quantity":["signal"]},[]),
+])
+def test_malformed_request(client,header,data):
+    #Refused with an error reply, which the client fixture checks is not logged as an error
+    if client.binary and "fetchType" in header:
+        pytest.skip("the binary header only holds numbers")
+    with pytest.raises(ValueError):
+        client.request(header,data)
+    assert client.read(REGISTER_ADDR) >= 0
+
+def test_error_keeps_connection(client):
+    #Error replies go back on the same connection, which is returned to the pool
+    with pytest.raises(ValueError):
+        client.read(0x00FFFFFC)
+    with client.connection() as conn:
+        first = conn
+    with pytest.raises(ValueError):
+        client.read(0x00FFFFFC)
+    with client.connection() as conn:
+        assert conn is first
+        assert int(dpclient.words(conn.request({"mode":"read"},[REGISTER_ADDR])[1])[0]) >= 0
+
+@pytest.mark.parametrize("binary",[False,True],ids=["json","binary"])
+def test_async_client(server,binary):
+    async def run():
+        c = dpclient.AsyncClient("127.0.0.1",server[0],binary=binary)
+        try:
+            addrs = [REGISTER_ADDR + 4*k for k in range(4)]
+            await asyncio.gather(*[c.write(a,k + 1) for k,a in enumerate(addrs)])
+            assert await asyncio.gather(*[c.read(a) for a in addrs]) == [1,2,3,4]
+            assert list(await c.read_batch(addrs)) == [1,2,3,4]
+            with pytest.raises(ValueError):
+                await c.read(0x00FFFFFC)
+            header = await c.wait_for_shot(start=True)
+            assert len(await c.fetch(4,header["counts"][4])) == header["counts"][4]
+        finally:
+            await c.close()
+    asyncio.run(run())
+    assert simserver.server_errors(server[1]) == []
+
+def test_unknown_opcode(server):
+    conn = dpclient.Connection("127.0.0.1",server[0],binary=True)
+    try:
+        conn.sock.sendall(binheader.pack_request(99,0,binheader.FLAG_KEEP_ALIVE,request_id=7))
+        conn.pending += 1
+        with pytest.raises(ValueError):
+            conn.receive()
+        conn.request({"mode":"write"},[REGISTER_ADDR,5])
+        assert int(dpclient.words(conn.request({"mode":"read"},[REGISTER_ADDR])[1])[0]) == 5
+    finally:
+        conn.close()
+
+def test_close_between_requests(server):
+    #Closing a keep-alive connection between requests is not an error
+    for n in range(5):
+        conn = dpclient.Connection("127.0.0.1",server[0])
+        conn.request({"mode":"read"},[REGISTER_ADDR])
+        conn.close()
+    time.sleep(0.2)
+    assert simserver.server_errors(server[1]) == []
+
+
+## Shots
+def test_shots(client):
+    shots = client.shots()
+    try:
+        client.write(TRIGGER_ADDR,1)
+        first,buffers = next(shots)
+        client.write(TRIGGER_ADDR,1)
+        second,buffers = next(shots)
+    finally:
+        shots.close()
+    assert second["shot"] == first["shot"] + 1
+    assert len(buffers[4]) == PULSES and 0 not in buffers
+
+def test_wait_for_shot(client):
+    last = take_shot(client)["shot"]
+    #A shot that has already ended is returned straight away
+    assert client.wait_for_shot(timeout=0.5,after=last - 1)["shot"] == last
+    with pytest.raises(ValueError):
+        client.wait_for_shot(timeout=0.2)
+
+def test_write_batch_trigger_wakes_waiter(client):
+    #A trigger written in a batch starts a shot that a waiting client is told about
+    after = take_shot(client)["shot"]
+    done = []
+    waiter = threading.Thread(target=lambda: done.append(client.wait_for_shot(timeout=5,after=after)))
+    waiter.start()
+    time.sleep(0.2)
+    client.write_batch([TRIGGER_ADDR],[1])
+    waiter.join(10)
+    assert done and done[0]["shot"] > after
+
+def test_disconnect_while_waiting(server):
+    c = dpclient.Client("127.0.0.1",server[0])
+    conn = dpclient.Connection("127.0.0.1",server[0])
+    conn.send({"mode":"wait for shot","timeout":30})
+    time.sleep(0.2)
+    before = c.request({"mode":"stats"})[0]["stats"]["activeConnections"]
+    conn.close()
+    time.sleep(0.3)
+    assert c.request({"mode":"stats"})[0]["stats"]["activeConnections"] == before - 1
+    c.close()
+
+def test_slow_subscriber(client,server):
+    #A subscriber that does not read cannot make the server queue more than it can send, and
+    #still gets the shots taken once it catches up
+    dpclient.Device(client).set({"numpulses":160})
+    conn = dpclient.Connection("127.0.0.1",server[0],None)
+    try:
+        conn.request({"mode":"subscribe","raw":True})
+        for n in range(150):
+            take_shot(client)
+        assert client.read(REGISTER_ADDR) >= 0
+        conn.sock.settimeout(10)
+        while select.select([conn.sock],[],[],1)[0]:
+            conn.receive_message()
+        last = take_shot(client)["shot"]
+        while True:
+            header,data = conn.receive_message()
+            if header.get("shot") == last:
+                break
+        assert len(data) == sum(header["lengths"])
+    finally:
+        conn.close()
+
+def test_close_with_unread_shots(client,server):
+    #Closing with data still unread resets the connection, which is not an error either
+    conn = dpclient.Connection("127.0.0.1",server[0],None)
+    conn.request({"mode":"subscribe","raw":True})
+    for n in range(3):
+        take_shot(client)
+    conn.close()
+    take_shot(client)
+    time.sleep(0.2)
+    assert simserver.server_errors(server[1]) == []
+
+def test_history(client):
+    for n in range(3):
+        last = take_shot(client)["shot"]
+    shots = client.history(first=last - 2)
+    assert [header["shot"] for header,buffers in shots] == [last - 2,last - 1,last]
+    header,buffers = shots[-1]
+    assert len(buffers[4]) == PULSES
+    assert [header["shot"] for header,buffers in client.history(first=last - 2,maxShots=1)] == [last - 2]
+
+def test_fetch_decoded(client):
+    take_shot(client)
+    values,dt = client.fetch_decoded("ratio")
+    assert values.shape == (PULSES,)
+    assert dt == pytest.approx(20e-6)
+    values,dt = client.fetch_decoded("signal")
+    assert values.shape == (PULSES,2)
+    assert np.all(values[:,1] > 1000)
+
+def test_find_transition(client):
+    #The signal on the first channel decays as 0.5 + 0.5*exp(-k/DECAY) with pulse k, and is
+    #halfway between its first and last values at k0
+    pulses = 400
+    dpclient.Device(client).set({"numpulses":pulses})
+    take_shot(client)
+    k0 = -DECAY*np.log((1 + np.exp(-(pulses - 1)/DECAY))/2)
+    freq,err = client.find_transition(start=100.0,step=0.5,quantity="signal")
+    assert freq == pytest.approx(100 + 0.5*k0,abs=3)
+    assert 0 < err < 3
+    take_shot(client)
+    shots,freq,err = client.find_transition(start=100.0,step=0.5,quantity="signal",maxShots=2)
+    assert len(shots) == len(freq) == len(err) == 2
+    with pytest.raises(ValueError):
+        client.find_transition(method="nope")
+
+def test_feedback_stats(client):
+    dev = dpclient.Device(client)
+    dev.set({"enableFB":1,"target":0.2,"maxMWPulses":100})
+    try:
+        client.feedback_stats(reset=True)
+        for n in range(3):
+            take_shot(client)
+        stats = client.feedback_stats()
+    finally:
+        dev.enableFB = 0
+    assert stats["shots"] == 3
+    assert stats["error"]["count"] == 3 - stats["skipped"]
+    assert stats["last"] is None or stats["last"]["error"] <= 1
+
+def test_profiles(client):
+    client.save_profile("short",values={"numpulses":7})
+    assert client.activate_profile("short") == [dpclient.registermap.ADDR[dpclient.registermap.index("numpulses")]]
+    assert dpclient.Device(client).numpulses == 7
+    assert client.activate_profile("short") == []
+    assert "short" in client.profiles(values=False)
+    with pytest.raises(ValueError):
+        client.save_profile("bad",values=[1,2])
+    with pytest.raises(ValueError):
+        client.save_profile("bad",values={"nope":1})
+    client.delete_profile("short")
+    assert "short" not in client.profiles(values=False)
+
+def test_sequence(client):
+    steps = [{"op":"write","addr":REGISTER_ADDR,"values":[1,2,3]},{"op":"write","addr":TRIGGER_ADDR,"value":1},
+             {"op":"wait"},{"op":"fetch","fetchType":4,"numFetch":PULSES}]
+    results = list(client.sequence(steps))
+    assert len(results) == 3
+    assert results[-1][0]["done"]
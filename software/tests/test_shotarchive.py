@@ -0,0 +1,90 @@
+import os
+import array
+
+import pytest
+
+import acquisition
+import shotarchive
+
+
+class FakeDevice:
+    #Parameter registers whose values can be changed between shots
+    def __init__(self):
+        self.offset = 0
+
+    def read(self,addr):
+        return addr + self.offset
+
+
+def make_shot(index,words=10):
+    buffers = [array.array("I",[1000*index + k])*words for k in range(5)]
+    return acquisition.Shot(index,100.0 + index,[words]*5,buffers)
+
+
+def test_write_read(tmp_path):
+    directory = str(tmp_path)
+    dev = FakeDevice()
+    writer = shotarchive.ArchiveWriter(directory,device=dev)
+    for n in range(1,4):
+        writer.add(make_shot(n))
+    dev.offset = 1
+    writer.add(make_shot(4))
+    writer.close()
+    reader = shotarchive.ArchiveReader(directory)
+    assert [e.index for e in reader.entries] == [1,2,3,4]
+    assert [e.index for e in reader.select(first=2,last=3)] == [2,3]
+    assert [e.index for e in reader.select(since=102.5)] == [3,4]
+    assert [e.index for e in reader.select(until=101)] == [1]
+    entry = reader.entries[2]
+    assert entry.time == 103.0
+    for k in acquisition.PROCESSED_TYPES:
+        assert reader.view(entry,k).tolist() == [3000 + k]*10
+    #Raw buffers are only stored when asked for
+    assert all(reader.view(entry,k) is None for k in acquisition.RAW_TYPES)
+    #The registers are stored once for each set of values
+    registers = reader.registers()
+    assert len(registers) == 2
+    assert registers[entry.registers] == dict((a,a) for a in shotarchive.REGISTER_ADDR)
+    assert registers[reader.entries[3].registers] == dict((a,a + 1) for a in shotarchive.REGISTER_ADDR)
+    reader.close()
+
+def test_segments(tmp_path):
+    #Shots that do not fit go in a new segment, and each writer starts its own
+    directory = str(tmp_path)
+    writer = shotarchive.ArchiveWriter(directory,segment_bytes=4096,raw=True,device=FakeDevice())
+    for n in range(1,5):
+        writer.add(make_shot(n,100))
+    writer.close()
+    writer = shotarchive.ArchiveWriter(directory,segment_bytes=4096,device=FakeDevice())
+    writer.add(make_shot(5,2000))
+    writer.close()
+    assert shotarchive.segment_numbers(directory) == [1,2,3]
+    #Unused space is given back when a segment is closed, and a shot larger than a segment
+    #gets a segment of its own
+    assert os.path.getsize(shotarchive.segment_name(directory,1,"dat")) == 2*5*4*100
+    assert os.path.getsize(shotarchive.segment_name(directory,3,"dat")) == 3*4*2000
+    reader = shotarchive.ArchiveReader(directory)
+    assert [e.segment for e in reader.entries] == [1,1,2,2,3]
+    assert reader.view(reader.entries[1],0).tolist() == [2000]*100
+    assert reader.view(reader.entries[4],4).tolist() == [5004]*2000
+    assert len(reader.registers()) == 1
+    reader.close()
+
+def test_read_while_writing(tmp_path):
+    directory = str(tmp_path)
+    writer = shotarchive.ArchiveWriter(directory,device=FakeDevice())
+    writer.add(make_shot(1))
+    reader = shotarchive.ArchiveReader(directory)
+    assert len(reader.entries) == 1
+    first = reader.view(reader.entries[0],1)
+    writer.add(make_shot(2))
+    assert reader.refresh() == 2
+    assert reader.view(reader.entries[1],1).tolist() == [2001]*10
+    assert first.tolist() == [1001]*10
+    writer.close()
+    del first
+    reader.close()
+
+def test_segment_size(tmp_path):
+    with pytest.raises(ValueError):
+        shotarchive.ArchiveWriter(str(tmp_path),segment_bytes=1000)
@@ -0,0 +1,70 @@
+import array
+import threading
+
+import pytest
+
+import acquisition
+import shothistory
+
+
+def make_shot(index,words=10):
+    buffers = [array.array("I",[index])*words for k in range(5)]
+    return acquisition.Shot(index,100.0 + index,[words]*5,buffers)
+
+
+def test_select():
+    h = shothistory.ShotHistory(max_shots=100)
+    for n in range(10):
+        h.add(make_shot(n))
+    assert (h.first(),h.last(),len(h)) == (0,9,10)
+    assert [s.index for s in h.select(first=3,last=5)] == [3,4,5]
+    assert [s.index for s in h.select(since=107.5)] == [8,9]
+    assert [s.index for s in h.select(first=2,max_shots=2)] == [2,3]
+    assert h.select(first=20) == []
+
+def test_raw_dropped():
+    h = shothistory.ShotHistory()
+    shot = make_shot(0)
+    h.add(shot)
+    stored = h.select()[0]
+    assert all(stored.buffers[k] is None for k in acquisition.RAW_TYPES)
+    assert stored.buffers[4] == shot.buffers[4]
+    assert h.nbytes == 4*10*len(acquisition.PROCESSED_TYPES)
+
+def test_evict_by_count():
+    h = shothistory.ShotHistory(max_shots=4)
+    for n in range(50):
+        h.add(make_shot(n))
+    assert [s.index for s in h.select()] == [46,47,48,49]
+    assert h.nbytes == 4*4*10*len(acquisition.PROCESSED_TYPES)
+
+def test_evict_by_bytes():
+    h = shothistory.ShotHistory(max_bytes=500,raw=True)
+    for n in range(5):
+        h.add(make_shot(n))
+    assert [s.index for s in h.select()] == [3,4]
+    h.add(make_shot(5,1000))
+    assert [s.index for s in h.select()] == [5]
+
+def test_invalid_limits():
+    with pytest.raises(ValueError):
+        shothistory.ShotHistory(max_shots=0)
+
+def test_concurrent_readers():
+    h = shothistory.ShotHistory(max_shots=8)
+    errors = []
+    def read():
+        try:
+            for n in range(2000):
+                shots = h.select(first=h.first())
+                assert [s.index for s in shots] == sorted(s.index for s in shots)
+        except Exception as e:
+            errors.append(e)
+    readers = [threading.Thread(target=read) for n in range(3)]
+    for t in readers:
+        t.start()
+    for n in range(5000):
+        h.add(make_shot(n,1))
+    for t in readers:
+        t.join()
+    assert errors == []
@@ -0,0 +1,84 @@
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import hardware
+import fpgamodel
+import simulator
+
+PULSES = 20
+SAMPLES = 100
+COUNTER_ADDR = 0x01000000
+
+
+def configure(dev,pulses=PULSES,width=48):
+    #enableDP, numpulses and width, period, samplesPerPulse, and the integration windows,
+    #with the bit ranges in DPFeedback.m
+    dev.write(0x04,1)
+    dev.write(0x08,(pulses << 16) | width)
+    dev.write(0x0C,2500)
+    dev.write(0x1C,SAMPLES << 14)
+    dev.write(0x24,10 | (50 << 11) | (30 << 22))
+
+def wait_for_data(dev,timeout=2):
+    end = time.time() + timeout
+    while dev.read(COUNTER_ADDR + 16) == 0:
+        assert time.time() < end
+        time.sleep(0.001)
+
+def block(dev,fetch_type,num,dtype):
+    return np.frombuffer(dev.view_block(hardware.FETCH_ADDR[fetch_type],num),dtype=dtype)
+
+
+def test_registers():
+    dev = simulator.SimulatedDevice()
+    dev.write(0x24,-1)
+    assert dev.read(0x24) == 0xFFFFFFFF
+    dev.write(0x00,2)
+    assert dev.read(0x00) == 0
+    for addr in (0x02,0x00FFFFFC,0x01000100,0x07000000):
+        with pytest.raises(ValueError):
+            dev.read(addr)
+    with pytest.raises(ValueError):
+        dev.write(COUNTER_ADDR,1)
+    with pytest.raises(ValueError):
+        dev.view_block(hardware.FETCH_ADDR[4],simulator.MEM_WORDS[4] + 1)
+
+def test_shot():
+    dev = simulator.SimulatedDevice(seed=1,decay=5)
+    configure(dev)
+    dev.write(0x00,1)
+    #The data appears once the pulses and the shutter hold-off would have finished
+    assert [dev.read(COUNTER_ADDR + 4*k) for k in range(5)] == [0]*5
+    wait_for_data(dev)
+    assert [dev.read(COUNTER_ADDR + 4*k) for k in range(5)] == [PULSES*SAMPLES,2*PULSES,PULSES*SAMPLES,2*PULSES,PULSES]
+    assert dev.shots == 1
+    #The processed data is what the FPGA would compute from the raw data
+    raw_signal = block(dev,0,PULSES*SAMPLES,"<i2").reshape(PULSES,SAMPLES,2)
+    raw_aux = block(dev,2,PULSES*SAMPLES,"<i2").reshape(PULSES,SAMPLES,2)
+    params = fpgamodel.ChainParameters(samplesPerPulse=SAMPLES,sumStart=10,subStart=50,width=30)
+    signal,aux,ratio = fpgamodel.process_raw(raw_signal,params,raw_aux)
+    assert np.array_equal(block(dev,1,2*PULSES,"<i4").reshape(PULSES,2),signal)
+    assert np.array_equal(block(dev,3,2*PULSES,"<i4").reshape(PULSES,2),aux)
+    assert np.array_equal(block(dev,4,PULSES,"<u4").astype("<u2").view("<i2"),ratio)
+    #The light is on for the first 48 samples, and the signal on the first channel decays
+    #to half from one pulse to the next over 5 pulses
+    assert np.all(raw_signal[:,:40,1] > 1000) and np.all(np.abs(raw_signal[:,60:,:]) < 200)
+    assert signal[-1,0]/signal[0,0] == pytest.approx(0.5,abs=0.05)
+    assert signal[-1,1]/signal[0,1] == pytest.approx(1,abs=0.05)
+
+def test_reset():
+    #Writing the trigger without bit 0 clears the memories, and nothing is taken unless enabled
+    dev = simulator.SimulatedDevice()
+    configure(dev)
+    dev.write(0x00,1)
+    wait_for_data(dev)
+    dev.write(0x00,2)
+    assert dev.read(COUNTER_ADDR + 16) == 0
+    dev.write(0x04,0)
+    dev.write(0x00,1)
+    time.sleep(0.02)
+    assert dev.read(COUNTER_ADDR + 16) == 0
+    assert dev.shots == 1
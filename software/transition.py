@@ -0,0 +1,194 @@
+import warnings
+
+import numpy as np
+
+import dpdata
+
+#
+# Finds the position of a transition in ramp scans, where the frequency changes by the same
+# step from one pulse to the next. Traces are given as an array of size (shots, pulses), and
+# every shot is handled at once. Shorter traces are padded with NaN, which is ignored:
+#   midpoint:   the first sample past the level halfway between the minimum and maximum, as
+#               checkStatus.c did, refined by linear interpolation between neighbouring pulses
+#   lorentzian, gaussian: least-squares fit of a peak or dip
+#   step:       least-squares fit of a logistic edge, whose centre is the midpoint crossing
+# Positions are in pulses and are converted to frequencies by find()
+#
+METHODS = ("midpoint","lorentzian","gaussian","step")
+EDGES = ("falling","rising")
+TRACES = {"ratio":4,"signal":1,"aux":3}     #Quantity -> fetchType holding it
+MAX_ITERATIONS = 100
+
+
+def trace(buffers,quantity="ratio",channel=0):
+    #Returns the per-pulse values of a quantity from block RAM contents indexed by fetchType,
+    #such as Shot.buffers. Integrated data has two channels. Missing buffers give an empty trace
+    buf = buffers[TRACES[quantity]]
+    if buf is None:
+        return np.zeros(0)
+    if quantity == "ratio":
+        return dpdata.decode_ratio(buf)
+    return dpdata.decode_integrated(buf)[:,channel].astype(float)
+
+def stack(traces):
+    #Combines traces of different lengths into one array, padded with NaN
+    n = max([2] + [len(t) for t in traces])
+    y = np.full((len(traces),n),np.nan)
+    for k,t in enumerate(traces):
+        y[k,:len(t)] = t
+    return y
+
+def crossing(y,level,edge="falling"):
+    #Fractional index at which each trace first reaches level, interpolated linearly between
+    #the samples either side, or NaN if it never does. level has one value for each trace
+    y = np.atleast_2d(y)
+    level = np.asarray(level,dtype=float)[...,None]
+    with np.errstate(invalid="ignore"):
+        past = y <= level if edge == "falling" else y >= level
+    found = past.any(axis=-1)
+    i = np.argmax(past,axis=-1)
+    prev = np.take_along_axis(y,np.maximum(i - 1,0)[...,None],axis=-1)[...,0]
+    cur = np.take_along_axis(y,i[...,None],axis=-1)[...,0]
+    with np.errstate(invalid="ignore",divide="ignore"):
+        frac = np.where(i > 0,(prev - level[...,0])/(prev - cur),1.0)
+    pos = i - 1 + np.clip(np.nan_to_num(frac,nan=1.0),0,1)
+    return np.where(found,pos,np.nan)
+
+def noise(y):
+    #Robust estimate of the noise on each trace from the differences between neighbouring pulses
+    d = np.diff(y,axis=-1)
+    mad = np.nanmedian(np.abs(d - np.nanmedian(d,axis=-1)[...,None]),axis=-1)
+    return 1.4826*mad/np.sqrt(2)
+
+def midpoint(y,edge="falling"):
+    #Crossing of the level halfway between the minimum and maximum of each trace. The
+    #uncertainty is the noise divided by the slope between the two samples either side
+    y = np.atleast_2d(y)
+    level = (np.nanmin(y,axis=-1) + np.nanmax(y,axis=-1))/2
+    pos = crossing(y,level,edge)
+    i = np.clip(np.nan_to_num(np.ceil(pos),nan=1).astype(int),1,y.shape[-1] - 1)
+    slope = np.abs(np.take_along_axis(y,i[...,None],axis=-1) - np.take_along_axis(y,i[...,None] - 1,axis=-1))[...,0]
+    with np.errstate(divide="ignore",invalid="ignore"):
+        return pos,noise(y)/slope
+
+
+#######################################################################################################
+#####################################  Lineshape fits  ################################################
+#######################################################################################################
+
+#
+# Each model is a function of x and the parameters (offset, amplitude, centre, width), with p
+# of size (shots, 4), returning the values and the Jacobian with respect to the parameters
+#
+def _lorentzian(x,p):
+    o,a,c,w = (p[:,k,None] for k in range(4))
+    u = (x - c)/w
+    L = 1/(1 + u**2)
+    dc = a*2*u/w*L**2
+    return o + a*L,np.stack((np.ones_like(L),L,dc,dc*u),axis=-1)
+
+def _gaussian(x,p):
+    o,a,c,w = (p[:,k,None] for k in range(4))
+    u = (x - c)/w
+    G = np.exp(-u**2/2)
+    dc = a*G*u/w
+    return o + a*G,np.stack((np.ones_like(G),G,dc,dc*u),axis=-1)
+
+def _step(x,p):
+    o,a,c,w = (p[:,k,None] for k in range(4))
+    u = np.clip((x - c)/w,-700,700)
+    E = 1/(1 + np.exp(u))
+    dc = a*E*(1 - E)/w
+    return o + a*E,np.stack((np.ones_like(E),E,dc,dc*u),axis=-1)
+
+MODELS = {"lorentzian":_lorentzian,"gaussian":_gaussian,"step":_step}
+
+def initial_guess(y,model,edge="falling"):
+    #Starting parameters from the extremes, the crossings and the number of pulses above half
+    #height, in units of pulses
+    n = y.shape[-1]
+    lo,hi = np.nanmin(y,axis=-1),np.nanmax(y,axis=-1)
+    if model == "step":
+        high,low = (hi,lo) if edge == "falling" else (lo,hi)
+        c = crossing(y,(lo + hi)/2,edge)
+        c = np.where(np.isnan(c),n/2,c)
+        quarter = crossing(y,high + (low - high)/4,edge)
+        three = crossing(y,high + 3*(low - high)/4,edge)
+        w = np.nan_to_num(np.abs(three - quarter)/(2*np.log(3)),nan=1.0)
+        return np.stack((low,high - low,c,np.maximum(w,0.5)),axis=-1)
+    base = np.nanmedian(y,axis=-1)
+    dip = base - lo > hi - base
+    a = np.where(dip,lo - base,hi - base)
+    with np.errstate(invalid="ignore"):
+        c = np.where(dip,np.nanargmin(y,axis=-1),np.nanargmax(y,axis=-1)).astype(float)
+        fwhm = np.sum(np.abs(y - base[...,None]) > np.abs(a)[...,None]/2,axis=-1)
+    w = fwhm/2 if model == "lorentzian" else fwhm/(2*np.sqrt(2*np.log(2)))
+    return np.stack((base,a,c,np.maximum(w,0.5)),axis=-1)
+
+def fit(y,model="lorentzian",edge="falling",p0=None,iterations=MAX_ITERATIONS,tol=1e-10):
+    #Levenberg-Marquardt fit of the model to every trace at once, with x the pulse index.
+    #Returns the parameters and their standard errors, both of size (shots, 4). NaN values
+    #in y are left out of the fit, and traces with too few values give NaN
+    if model not in MODELS:
+        raise ValueError("Model must be one of {}".format(", ".join(MODELS)))
+    fn = MODELS[model]
+    y = np.atleast_2d(np.asarray(y,dtype=float))
+    x = np.arange(y.shape[-1],dtype=float)
+    valid = np.isfinite(y)
+    weight = valid.astype(float)
+    y = np.where(valid,y,0)
+    p = initial_guess(np.where(valid,y,np.nan),model,edge) if p0 is None else np.array(p0,dtype=float,ndmin=2)
+    p = np.nan_to_num(p)
+    r = (y - fn(x,p)[0])*weight
+    cost = np.sum(r**2,axis=-1)
+    lam = np.full(len(y),1e-3)
+    for k in range(iterations):
+        J = fn(x,p)[1]*weight[...,None]
+        A = np.einsum("sni,snj->sij",J,J)
+        g = np.einsum("sni,sn->si",J,r)
+        D = np.diagonal(A,axis1=1,axis2=2)
+        D = np.maximum(D,1e-12*np.max(D,axis=-1,keepdims=True) + 1e-300)
+        M = A + lam[:,None,None]*(D[:,:,None]*np.eye(4))
+        step = np.einsum("sij,sj->si",np.linalg.pinv(M),g)
+        trial = p + step
+        with np.errstate(over="ignore",invalid="ignore"):
+            r_trial = (y - fn(x,trial)[0])*weight
+            cost_trial = np.sum(r_trial**2,axis=-1)
+        better = cost_trial < cost
+        done = (better & (cost - cost_trial <= tol*cost)) | (~better & (lam > 1e10)) | (cost == 0)
+        p[better] = trial[better]
+        r[better] = r_trial[better]
+        cost = np.where(better,cost_trial,cost)
+        lam = np.where(better,lam/10,lam*10)
+        if np.all(done):
+            break
+    J = fn(x,p)[1]*weight[...,None]
+    dof = np.maximum(valid.sum(axis=-1) - 4,1)
+    cov = np.linalg.pinv(np.einsum("sni,snj->sij",J,J))*(cost/dof)[:,None,None]
+    err = np.sqrt(np.abs(np.diagonal(cov,axis1=1,axis2=2)))
+    p[:,3] = np.abs(p[:,3])
+    p[valid.sum(axis=-1) <= 4] = np.nan
+    err[valid.sum(axis=-1) <= 4] = np.nan
+    return p,err
+
+def find(y,method="midpoint",edge="falling",start=0.0,step=1.0):
+    #Returns the frequency of the transition in each trace and its uncertainty, with pulse k
+    #at frequency start + k*step
+    if method not in METHODS:
+        raise ValueError("Method must be one of {}".format(", ".join(METHODS)))
+    if edge not in EDGES:
+        raise ValueError("Edge must be 'falling' or 'rising'")
+    y = np.atleast_2d(np.asarray(y,dtype=float))
+    with warnings.catch_warnings():
+        #Empty traces give NaN
+        warnings.simplefilter("ignore",RuntimeWarning)
+        if method == "midpoint":
+            pos,err = midpoint(y,edge)
+        else:
+            p,e = fit(y,method,edge)
+            #An edge or line narrower than a pulse only places the centre between two pulses
+            pos,err = p[:,2],np.where(p[:,3] < 1,np.maximum(e[:,2],1/np.sqrt(12)),e[:,2])
+            #A centre outside the scan is not a transition that was found
+            outside = ~((pos >= 0) & (pos <= np.isfinite(y).sum(axis=-1) - 1))
+            pos,err = np.where(outside,np.nan,pos),np.where(outside,np.nan,err)
+    return start + step*pos,abs(step)*err